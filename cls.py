@@ -8,8 +8,9 @@ from torch.utils.data import DataLoader
 import torch.backends.cudnn as cudnn
 from sklearn.metrics import confusion_matrix
 import drn
-from utils import quadratic_weighted_kappa, AverageMeter
+from utils import ConfusionMeter, AverageMeter, apply_cut_points, default_cut_points, cross_fit_cut_points, save_cut_points, load_cut_points, prefetch
 from data import *
+from logit_store import LogitWriter
 
 
 def parse_args():
@@ -32,10 +33,16 @@ def parse_args():
 	parser.add_argument('--display', default=10, type=int, help='The frequency of printing log')
 	parser.add_argument('--seed', default=111, type=int, help='Random seed to use')
 	parser.add_argument('--dthreads', default=4, type=int, help='The number of threads for data loader to use')
+	parser.add_argument('--prefetch', default=0, type=int, help='The number of batches to load and copy to the GPU ahead on a background thread, 0 disables')
 	parser.add_argument('--baseline', action='store_true', help='Enable baseline augmentation')
+	parser.add_argument('--batchaug', action='store_true', help='Run the non-baseline flip/color/lighting augmentation on whole batches in collate; not the same augmentation as the per-sample PILColorJitter, the blur and sharpness filters always run before the color steps')
 	parser.add_argument('--balance', action='store_true', help='Enable weight-balanced loss')
+	parser.add_argument('--undersample', action='store_true', help='Undersample the classes instead of weighting the loss, balanced by the --balance weights_initial at first and annealed back to the natural class frequencies at its weights_ratio')
+	parser.add_argument('--mix', nargs='+', default=None, help='Train on registered splits mixed per batch instead of --dataset, name:ratio pairs, e.g. kaggle_train:3 zhizhen_train:1')
 	parser.add_argument('--tencrop', action='store_true', help='Enable ten-crop test')
 	parser.add_argument('--cls2reg', action='store_true', help='Use regression instead of classification')
+	parser.add_argument('--fitcuts', action='store_true', help='Fit the cls2reg cut points on the validation set and store them next to the weights')
+	parser.add_argument('--cutfolds', default=5, type=int, help='The folds the --fitcuts kappa is cross-fitted over')
 	parser.add_argument('--scratch', action='store_true', help='Enable from-the-scatch training')
 	return parser.parse_args()
 
@@ -105,10 +112,11 @@ class cls_model(nn.Module):
 		return x
 
 
-def cls_train(train_data_loader, model, criterion, optimizer, epoch, display):
+def cls_train(train_data_loader, model, criterion, optimizer, epoch, display, cut_points=None):
 	model.train()
-	tot_pred = np.array([], dtype=int)
-	tot_label = np.array([], dtype=int)
+	if cut_points is None:
+		cut_points = default_cut_points()
+	confusion = ConfusionMeter()
 	batch_time = AverageMeter()
 	data_time = AverageMeter()
 	losses = AverageMeter()
@@ -122,12 +130,14 @@ def cls_train(train_data_loader, model, criterion, optimizer, epoch, display):
 		loss.backward()
 		optimizer.step()
 		batch_time.update(time.time() - end)
-		_, pred = torch.max(final, 1)
-		pred = pred.cpu().data.numpy().squeeze()
+		if final.size(1) == 1:
+			pred = apply_cut_points(final.cpu().data.numpy().ravel(), cut_points)
+		else:
+			_, pred = torch.max(final, 1)
+			pred = pred.cpu().data.numpy().squeeze()
 		label = label.cpu().numpy().squeeze()
-		tot_pred = np.append(tot_pred, pred)
-		tot_label = np.append(tot_label, label)
-		kappa = quadratic_weighted_kappa(tot_label, tot_pred)
+		confusion.update(label, pred)
+		kappa = confusion.kappa()
 		losses.update(loss.data[0], image.size(0))
 		end = time.time()
 		if num_iter % display == 0:
@@ -141,37 +151,53 @@ def cls_train(train_data_loader, model, criterion, optimizer, epoch, display):
 	return logger
 
 
-def cls_val(eval_data_loader, model, criterion, ten_crop_data_loader):
+def cls_val(eval_data_loader, model, criterion, cut_points=None, store=None):
 	model.eval()
-	tot_pred = np.array([], dtype=int)
-	tot_label = np.array([], dtype=int)
+	tot_pred = []
+	tot_label = []
+	tot_score = []
+	if cut_points is None:
+		cut_points = default_cut_points()
+	confusion = ConfusionMeter()
 	losses = AverageMeter()
 	batch_time = AverageMeter()
 	data_time = AverageMeter()
 	end = time.time()
 	for num_iter, (image, label) in enumerate(eval_data_loader):
 		data_time.update(time.time() - end)
-		final = model(Variable(image, requires_grad=False, volatile=True))
-		if ten_crop_data_loader:
-			for cropped_data_loader in ten_crop_data_loader:
-				cropped_image = next(cropped_data_loader)
-				final += model(Variable(cropped_image, requires_grad=False, volatile=True))
-			final /= 11
+		if image.dim() == 5:
+			# ten-crop stacks (batch, views, 3, h, w): one forward pass over every view, outputs averaged per image
+			final = model(Variable(image.view(-1, *image.size()[2:]), requires_grad=False, volatile=True))
+			final = final.view(image.size(0), image.size(1), -1).mean(1)
+		else:
+			final = model(Variable(image, requires_grad=False, volatile=True))
 		loss = criterion(final, Variable(label.cuda()))
-		_, pred = torch.max(final, 1)
-		pred = pred.cpu().data.numpy().squeeze()
+		if store is not None:
+			store.update({'dr': final.cpu().data.numpy()}, {'dr': label.cpu().numpy()})
+		if final.size(1) == 1:
+			# cls2reg: a single regression output, levels come from the cut points
+			score = final.cpu().data.numpy().ravel()
+			pred = apply_cut_points(score, cut_points)
+			tot_score.append(score)
+		else:
+			_, pred = torch.max(final, 1)
+			pred = pred.cpu().data.numpy().squeeze()
 		label = label.cpu().numpy().squeeze()
-		tot_pred = np.append(tot_pred, pred)
-		tot_label = np.append(tot_label, label)
+		tot_pred.append(pred)
+		tot_label.append(label)
+		confusion.update(label, pred)
 		losses.update(loss.data[0], image.size(0))
-		kappa = quadratic_weighted_kappa(tot_label, tot_pred)
+		kappa = confusion.kappa()
 		batch_time.update(time.time() - end)
 		end = time.time()
 		print('Eval: [{0}/{1}]\t' 'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
 		      'Data {data_time.avg:.3f}\t' 'Loss {loss.avg:.4f}\t'  'Kappa {kappa:.4f}\t'
 		      .format(num_iter, len(eval_data_loader), batch_time=batch_time, data_time=data_time, loss=losses, kappa=kappa))
 
-	return kappa, tot_pred, tot_label
+	tot_pred = np.hstack(tot_pred)
+	tot_label = np.hstack(tot_label)
+	tot_score = np.hstack(tot_score) if tot_score else None
+	return kappa, tot_pred, tot_label, tot_score
 
 
 class Cls2Reg(nn.Module):
@@ -181,7 +207,7 @@ class Cls2Reg(nn.Module):
 		#self.loss = nn.MSELoss(size_average=size_average).cuda()
 
 	def forward(self, final, label):
-		return self.loss(final, label.float())
+		return self.loss(final.view(-1), label.float())
 
 
 def main():
@@ -216,10 +242,23 @@ def main():
 
 	if opt.phase == 'train':
 		print('===> Training model')
-		train_data_loader = DataLoader(dataset=globals()[opt.dataset + 'ClsTrain'](crop_size=opt.crop, scale_size=opt.size, baseline=opt.baseline),
-		                               num_workers=opt.threads, batch_size=opt.batch, shuffle=True, pin_memory=True)
+		if opt.mix:
+			if opt.undersample or opt.batchaug:
+				raise Exception('--mix does not combine with --undersample or --batchaug')
+			names, ratios = zip(*[(source.split(':')[0], float(source.split(':')[1])) for source in opt.mix])
+			train_set = MixedClsDataSet(names, crop_size=opt.crop, scale_size=opt.size, train=True, baseline=opt.baseline)
+			train_sampler = MixedSourceSampler(train_set, ratios, seed=opt.seed)
+		else:
+			train_set = globals()[opt.dataset + 'ClsTrain'](crop_size=opt.crop, scale_size=opt.size, baseline=opt.baseline, batch_augment=opt.batchaug)
+			train_sampler = ScheduledClassSampler(train_set.label.numpy(), w_i, w_r, opt.seed) if opt.undersample else None
+		cut_points = load_cut_points(opt.weight) if opt.cls2reg else None
+		train_data_loader = prefetch(DataLoader(dataset=train_set, num_workers=opt.threads, batch_size=opt.batch, shuffle=train_sampler is None,
+		                                        sampler=train_sampler, pin_memory=True, collate_fn=train_set.collate_fn), opt.prefetch)
 		for epoch in range(opt.epoch):
-			if opt.balance:
+			if train_sampler is not None:
+				train_sampler.set_epoch(epoch)
+				print('===> ' + train_sampler.describe())
+			if opt.balance and not opt.undersample:
 				w_epoch = torch.from_numpy(w_i*w_r**epoch + w_f*(1-w_r**epoch))
 				criterion = nn.CrossEntropyLoss(weight=w_epoch).cuda()
 			if epoch < opt.fix:
@@ -231,7 +270,12 @@ def main():
 					lr = opt.lr * (0.1 ** (epoch//opt.step))
 					#lr = max((1 - float(epoch - opt.fix) / (opt.epoch - opt.fix)) ** 0.9 * opt.lr, 1e-6)
 			optimizer = optim.SGD([{'params': model.base.parameters()}, {'params': model.cls.parameters()}], lr=lr, momentum=opt.mom, weight_decay=opt.wd, nesterov=True)
-			logger = cls_train(train_data_loader, torch.nn.DataParallel(model).cuda(), criterion, optimizer, epoch, opt.display)
+			logger = cls_train(train_data_loader, torch.nn.DataParallel(model).cuda(), criterion, optimizer, epoch, opt.display, cut_points)
+			if opt.prefetch:
+				logger.append('Prefetch: {}'.format(train_data_loader.stats()))
+				print('===> ' + logger[-1])
+			if train_sampler is not None:
+				logger.insert(0, train_sampler.describe())
 			torch.save(model.cpu().state_dict(), os.path.join(output_dir, opt.dataset + '_cls_' + opt.model + '_%03d' % epoch + '.pth'))
 			print('===> ' + output_dir + '/' + opt.dataset + '_cls_' + opt.model + '_%03d' % epoch + '.pth')
 			if not os.path.isfile(os.path.join(output_dir, 'train.log')):
@@ -243,21 +287,30 @@ def main():
 	elif opt.phase == 'val':
 		if opt.weight:
 			print('===> Evaluating model')
-			val_data_loader = DataLoader(dataset=globals()[opt.dataset + 'ClsVal'](crop_size=opt.crop, scale_size=opt.size),
+			val_data_loader = DataLoader(dataset=globals()[opt.dataset + 'ClsVal'](crop_size=opt.crop, scale_size=opt.size, ten_crop=opt.tencrop),
 			                             num_workers=opt.threads, batch_size=opt.batch, shuffle=False, pin_memory=False)
-			ten_crop_data_loader = []
-			if opt.tencrop:
-				for crop_idx in range(10):
-					ten_crop_data_loader.append(iter(DataLoader(dataset=globals()[opt.dataset + 'ClsValTenCrop'](crop_idx, opt.crop, opt.size),
-					                                            num_workers=opt.threads, batch_size=opt.batch, shuffle=False, pin_memory=False)))
-			kappa, pred, label = cls_val(val_data_loader, torch.nn.DataParallel(model).cuda(), criterion, ten_crop_data_loader)
+			cut_points = load_cut_points(opt.weight) if opt.cls2reg else None
+			store = LogitWriter(os.path.join(output_dir, 'logits'))
+			kappa, pred, label, score = cls_val(val_data_loader, torch.nn.DataParallel(model).cuda(), criterion, cut_points, store)
+			store.close([os.path.basename(image) for image in val_data_loader.dataset.image])
+			if opt.cls2reg and opt.fitcuts:
+				# the kappa and confusion matrix reported grade every image with cut points fitted on the other folds
+				cut_points, pred, kappa = cross_fit_cut_points(score, label, folds=opt.cutfolds)
+				save_cut_points(opt.weight, cut_points, kappa=kappa, folds=opt.cutfolds)
+				print('===> Kappa cross-fitted over %d folds' % opt.cutfolds)
+			if opt.cls2reg:
+				print('===> Cut points: ' + ', '.join('%.4f' % c for c in (default_cut_points() if cut_points is None else cut_points)))
 			print('===> Kappa: %.4f' % kappa)
 			print('===> Confusion Matrix:')
 			print(confusion_matrix(label, pred))
 			with open(os.path.join(output_dir, 'val.log'), 'w') as fp:
 				fp.write(str(opt)+'\n')
 				fp.write('\n===> Kappa: %.4f' % kappa)
-			np.save(os.path.join(output_dir, 'results.npy'), pred, label, confusion_matrix(label, pred))
+				if opt.cls2reg and opt.fitcuts:
+					fp.write(' (cross-fitted over %d folds)' % opt.cutfolds)
+				if opt.cls2reg:
+					fp.write('\n===> Cut points: ' + ', '.join('%.4f' % c for c in (default_cut_points() if cut_points is None else cut_points)))
+			np.savez(os.path.join(output_dir, 'results.npz'), pred=pred, label=label, confusion=confusion_matrix(label, pred))
 
 		else:
 			raise Exception('No weights found')
@@ -8,8 +8,9 @@ from torch.utils.data import DataLoader
 import torch.backends.cudnn as cudnn
 from sklearn.metrics import confusion_matrix
 import drn
-from utils import quadratic_weighted_kappa, AverageMeter
+from utils import ConfusionMeter, AverageMeter
 from data import *
+from logit_store import LogitWriter
 
 import pandas as pd
 
@@ -108,8 +109,7 @@ class cls_model(nn.Module):
 
 def cls_train(train_data_loader, model, criterion, optimizer, epoch, display):
 	model.train()
-	tot_pred = np.array([], dtype=int)
-	tot_label = np.array([], dtype=int)
+	confusion = ConfusionMeter()
 	batch_time = AverageMeter()
 	data_time = AverageMeter()
 	losses = AverageMeter()
@@ -126,9 +126,8 @@ def cls_train(train_data_loader, model, criterion, optimizer, epoch, display):
 		_, pred = torch.max(final, 1)
 		pred = pred.cpu().data.numpy().squeeze()
 		label = label.cpu().numpy().squeeze()
-		tot_pred = np.append(tot_pred, pred)
-		tot_label = np.append(tot_label, label)
-		kappa = quadratic_weighted_kappa(tot_label, tot_pred)
+		confusion.update(label, pred)
+		kappa = confusion.kappa()
 		losses.update(loss.data[0], image.size(0))
 		end = time.time()
 		if num_iter % display == 0:
@@ -142,12 +141,13 @@ def cls_train(train_data_loader, model, criterion, optimizer, epoch, display):
 	return logger
 
 
-def cls_val(eval_data_loader, model, criterion, ten_crop_data_loader):
+def cls_val(eval_data_loader, model, criterion, ten_crop_data_loader, store=None):
 	model.eval()
-	tot_pred = np.array([], dtype=int)
-	tot_label = np.array([], dtype=int)
-	tot_image = np.array([])
-	tot_prop = np.array([])
+	tot_pred = []
+	tot_label = []
+	confusion = ConfusionMeter()
+	tot_image = []
+	tot_prop = []
 	losses = AverageMeter()
 	batch_time = AverageMeter()
 	data_time = AverageMeter()
@@ -161,28 +161,32 @@ def cls_val(eval_data_loader, model, criterion, ten_crop_data_loader):
 				final += model(Variable(cropped_image, requires_grad=False, volatile=True))
 			final /= 11
 		loss = criterion(final, Variable(label.cuda()))
+		if store is not None:
+			store.update({'dr': final.cpu().data.numpy()}, {'dr': label.cpu().numpy()})
 		_, pred = torch.max(final, 1)
 		pred = pred.cpu().data.numpy().squeeze()
 		label = label.cpu().numpy().squeeze()
-		tot_pred = np.append(tot_pred, pred)
-		tot_label = np.append(tot_label, label)
-		tot_image = np.append(tot_image, name)
+		tot_pred.append(pred)
+		tot_label.append(label)
+		confusion.update(label, pred)
+		tot_image.extend(name)
 		m = torch.nn.Softmax()
 		prop = m(final).data.cpu().numpy()
 		prop = [str(p) for p in prop]
-		tot_prop = np.append(tot_prop, prop)
+		tot_prop.extend(prop)
 		losses.update(loss.data[0], image.size(0))
-		kappa = quadratic_weighted_kappa(tot_label, tot_pred)
+		kappa = confusion.kappa()
 		batch_time.update(time.time() - end)
 		end = time.time()
 		print('Eval: [{0}/{1}]\t' 'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
 		      'Data {data_time.avg:.3f}\t' 'Loss {loss.avg:.4f}\t'  'Kappa {kappa:.4f}\t'
 		      .format(num_iter, len(eval_data_loader), batch_time=batch_time, data_time=data_time, loss=losses, kappa=kappa))
+	tot_pred = np.hstack(tot_pred)
+	tot_label = np.hstack(tot_label)
 	data = np.column_stack((tot_image, tot_label, tot_pred, tot_prop))
 	df = pd.DataFrame(data, columns=['images', 'gt_level', 'pred_level', 'cls_propbality'])
 	df.to_csv('./classification_result.csv')
 
-
 	return kappa, tot_pred, tot_label
 
 
@@ -230,7 +234,7 @@ def main():
 		print('===> Training model')
 		train_data_loader = DataLoader(dataset=globals()[opt.dataset + 'ClsTrain1'](crop_size=opt.crop, scale_size=opt.size, baseline=opt.baseline),
 		                               num_workers=opt.threads, batch_size=opt.batch, shuffle=True, pin_memory=True)
-		val_data_loader1 = DataLoader(dataset=globals()[opt.dataset + 'ClsVal1'](crop_size=opt.crop, scale_size=opt.size),
+		val_data_loader1 = DataLoader(dataset=globals()[opt.dataset + 'ClsVal1'](crop_size=opt.crop, scale_size=opt.size, return_name=True),
 									 num_workers=opt.threads, batch_size=opt.batch, shuffle=False, pin_memory=False)
 		kappa_best = 0
 		for epoch in range(opt.epoch):
@@ -265,21 +269,23 @@ def main():
 	elif opt.phase == 'val':
 		if opt.weight:
 			print('===> Evaluating model')
-			val_data_loader = DataLoader(dataset=globals()[opt.dataset + 'ClsVal'](crop_size=opt.crop, scale_size=opt.size),
+			val_data_loader = DataLoader(dataset=globals()[opt.dataset + 'ClsVal'](crop_size=opt.crop, scale_size=opt.size, return_name=True),
 			                             num_workers=opt.threads, batch_size=opt.batch, shuffle=False, pin_memory=False)
 			ten_crop_data_loader = []
 			if opt.tencrop:
 				for crop_idx in range(10):
 					ten_crop_data_loader.append(iter(DataLoader(dataset=globals()[opt.dataset + 'ClsValTenCrop'](crop_idx, opt.crop, opt.size),
 					                                            num_workers=opt.threads, batch_size=opt.batch, shuffle=False, pin_memory=False)))
-			kappa, pred, label = cls_val(val_data_loader, torch.nn.DataParallel(model).cuda(), criterion, ten_crop_data_loader)
+			store = LogitWriter(os.path.join(output_dir, 'logits'))
+			kappa, pred, label = cls_val(val_data_loader, torch.nn.DataParallel(model).cuda(), criterion, ten_crop_data_loader, store)
+			store.close([os.path.basename(image) for image in val_data_loader.dataset.image])
 			print('===> Kappa: %.4f' % kappa)
 			print('===> Confusion Matrix:')
 			print(confusion_matrix(label, pred))
 			with open(os.path.join(output_dir, 'val.log'), 'w') as fp:
 				fp.write(str(opt)+'\n')
 				fp.write('\n===> Kappa: %.4f' % kappa)
-			np.save(os.path.join(output_dir, 'results.npy'), pred, label, confusion_matrix(label, pred))
+			np.savez(os.path.join(output_dir, 'results.npz'), pred=pred, label=label, confusion=confusion_matrix(label, pred))
 
 		else:
 			raise Exception('No weights found')
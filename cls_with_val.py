@@ -8,8 +8,9 @@ from torch.utils.data import DataLoader
 import torch.backends.cudnn as cudnn
 from sklearn.metrics import confusion_matrix
 import drn
-from utils import quadratic_weighted_kappa, AverageMeter
+from utils import ConfusionMeter, AverageMeter, prefetch
 from data import *
+from logit_store import LogitWriter
 
 
 def parse_args():
@@ -32,11 +33,18 @@ def parse_args():
 	parser.add_argument('--display', default=10, type=int, help='The frequency of printing log')
 	parser.add_argument('--seed', default=111, type=int, help='Random seed to use')
 	parser.add_argument('--threads', default=4, type=int, help='The number of threads for data loader to use')
+	parser.add_argument('--prefetch', default=0, type=int, help='The number of batches to load and copy to the GPU ahead on a background thread, 0 disables')
 	parser.add_argument('--baseline', action='store_true', help='Enable baseline augmentation')
+	parser.add_argument('--batchaug', action='store_true', help='Run the non-baseline flip/color/lighting augmentation on whole batches in collate; not the same augmentation as the per-sample PILColorJitter, the blur and sharpness filters always run before the color steps')
 	parser.add_argument('--balance', action='store_true', help='Enable weight-balanced loss')
+	parser.add_argument('--undersample', action='store_true', help='Undersample the classes instead of weighting the loss, balanced by the --balance weights_initial at first and annealed back to the natural class frequencies at its weights_ratio')
 	parser.add_argument('--tencrop', action='store_true', help='Enable ten-crop test')
 	parser.add_argument('--cls2reg', action='store_true', help='Use regression instead of classification')
 	parser.add_argument('--scratch', action='store_true', help='Enable from-the-scatch training')
+	parser.add_argument('--cache', default=0, type=float, help='GB of shared memory for decoded validation images, 0 disables the cache')
+	parser.add_argument('--progressive', default=None, help='Progressive resizing, comma separated epoch:size:crop stages, e.g. 0:128:112,10:256:224,30:512:448; '
+	                    'the batch grows as (crop / stage crop)^2, validation stays at --size and --crop')
+	parser.add_argument('--target', default=None, type=float, help='Report the wall time until the validation kappa first reaches this value')
 	return parser.parse_args()
 
 
@@ -60,39 +68,32 @@ class cls_model(nn.Module):
 		super(cls_model, self).__init__()
 		if name == 'drn26':
 			base_model = drn.drn26()
-			featmap = inmap // 8
 			planes = 512
 		elif name == 'drn42':
 			base_model = drn.drn42()
-			featmap = inmap // 8
 			planes = 512
 		elif name == 'rsn152':
 			base_model = torchvision.models.resnet152()
-			featmap = inmap // 32
 			planes = 2048
 		elif name == 'rsn101':
 			base_model = torchvision.models.resnet101()
-			featmap = inmap // 32
 			planes = 2048
 		elif name == 'rsn50':
 			base_model = torchvision.models.resnet50()
-			featmap = inmap // 32
 			planes = 2048
 		elif name == 'rsn34':
 			base_model = torchvision.models.resnet34()
-			featmap = inmap // 32
 			planes = 512
 		elif name == 'rsn18':
 			base_model = torchvision.models.resnet18()
-			featmap = inmap // 32
 			planes = 512
 		if not scratch:
 			base_model.load_state_dict(torch.load('pretrained/' + name + '.pth'))
 		self.base = nn.Sequential(*list(base_model.children())[:-2])
 		if cls2reg:
-			cls = nn.Sequential(nn.AvgPool2d(featmap), nn.Conv2d(planes, 1, kernel_size=1, stride=1, padding=0, bias=True))
+			cls = nn.Sequential(nn.AdaptiveAvgPool2d(1), nn.Conv2d(planes, 1, kernel_size=1, stride=1, padding=0, bias=True))
 		else:
-		  cls = nn.Sequential(nn.AvgPool2d(featmap), nn.Conv2d(planes, classes, kernel_size=1, stride=1, padding=0, bias=True))
+		  cls = nn.Sequential(nn.AdaptiveAvgPool2d(1), nn.Conv2d(planes, classes, kernel_size=1, stride=1, padding=0, bias=True))
 		initialize_cls_weights(cls)
 		self.cls = cls
 		if weights:
@@ -107,8 +108,7 @@ class cls_model(nn.Module):
 
 def cls_train(train_data_loader, model, criterion, optimizer, epoch, display):
 	model.train()
-	tot_pred = np.array([], dtype=int)
-	tot_label = np.array([], dtype=int)
+	confusion = ConfusionMeter()
 	batch_time = AverageMeter()
 	data_time = AverageMeter()
 	losses = AverageMeter()
@@ -125,9 +125,8 @@ def cls_train(train_data_loader, model, criterion, optimizer, epoch, display):
 		_, pred = torch.max(final, 1)
 		pred = pred.cpu().data.numpy().squeeze()
 		label = label.cpu().numpy().squeeze()
-		tot_pred = np.append(tot_pred, pred)
-		tot_label = np.append(tot_label, label)
-		kappa = quadratic_weighted_kappa(tot_label, tot_pred)
+		confusion.update(label, pred)
+		kappa = confusion.kappa()
 		losses.update(loss.data[0], image.size(0))
 		end = time.time()
 		if num_iter % display == 0:
@@ -141,36 +140,42 @@ def cls_train(train_data_loader, model, criterion, optimizer, epoch, display):
 	return logger
 
 
-def cls_val(eval_data_loader, model, criterion, ten_crop_data_loader):
+def cls_val(eval_data_loader, model, criterion, store=None):
 	model.eval()
-	tot_pred = np.array([], dtype=int)
-	tot_label = np.array([], dtype=int)
+	tot_pred = []
+	tot_label = []
+	confusion = ConfusionMeter()
 	losses = AverageMeter()
 	batch_time = AverageMeter()
 	data_time = AverageMeter()
 	end = time.time()
 	for num_iter, (image, label) in enumerate(eval_data_loader):
 		data_time.update(time.time() - end)
-		final = model(Variable(image, requires_grad=False, volatile=True))
-		if ten_crop_data_loader:
-			for cropped_data_loader in ten_crop_data_loader:
-				cropped_image = next(cropped_data_loader)
-				final += model(Variable(cropped_image, requires_grad=False, volatile=True))
-			final /= 11
+		if image.dim() == 5:
+			# ten-crop stacks (batch, views, 3, h, w): one forward pass over every view, outputs averaged per image
+			final = model(Variable(image.view(-1, *image.size()[2:]), requires_grad=False, volatile=True))
+			final = final.view(image.size(0), image.size(1), -1).mean(1)
+		else:
+			final = model(Variable(image, requires_grad=False, volatile=True))
 		loss = criterion(final, Variable(label.cuda()))
+		if store is not None:
+			store.update({'dr': final.cpu().data.numpy()}, {'dr': label.cpu().numpy()})
 		_, pred = torch.max(final, 1)
 		pred = pred.cpu().data.numpy().squeeze()
 		label = label.cpu().numpy().squeeze()
-		tot_pred = np.append(tot_pred, pred)
-		tot_label = np.append(tot_label, label)
+		tot_pred.append(pred)
+		tot_label.append(label)
+		confusion.update(label, pred)
 		losses.update(loss.data[0], image.size(0))
-		kappa = quadratic_weighted_kappa(tot_label, tot_pred)
+		kappa = confusion.kappa()
 		batch_time.update(time.time() - end)
 		end = time.time()
 		print('Eval: [{0}/{1}]\t' 'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
 		      'Data {data_time.avg:.3f}\t' 'Loss {loss.avg:.4f}\t'  'Kappa {kappa:.4f}\t'
 		      .format(num_iter, len(eval_data_loader), batch_time=batch_time, data_time=data_time, loss=losses, kappa=kappa))
 
+	tot_pred = np.hstack(tot_pred)
+	tot_label = np.hstack(tot_label)
 	return kappa, tot_pred, tot_label
 
 
@@ -184,6 +189,26 @@ class Cls2Reg(nn.Module):
 		return self.loss(final, label.float())
 
 
+def progressive_schedule(spec, size, crop, batch):
+	"""
+	The (first epoch, size, crop, batch) stages of a --progressive spec, sorted by epoch; the images of a stage are
+	the <id>_<size>.png of the pyramid and the batch keeps the pixels per step of --batch at --crop.
+	Without a spec the whole run is one stage at --size, --crop and --batch.
+	"""
+	if not spec:
+		return [(0, size, crop, batch)]
+	stages = []
+	for stage in spec.split(','):
+		epoch, stage_size, stage_crop = [int(v) for v in stage.split(':')]
+		if stage_size not in [128, 256, 512, 1024] or stage_crop > stage_size:
+			raise Exception('Invalid progressive stage: {}'.format(stage))
+		stages.append((epoch, stage_size, stage_crop, max(1, int(batch * (float(crop) / stage_crop) ** 2))))
+	stages.sort()
+	if stages[0][0] != 0:
+		raise Exception('The progressive schedule should start at epoch 0')
+	return stages
+
+
 def main():
 	print('===> Parsing options')
 	opt = parse_args()
@@ -216,13 +241,27 @@ def main():
 
 	if opt.phase == 'train':
 		print('===> Training model')
-		train_data_loader = DataLoader(dataset=globals()[opt.dataset + 'ClsTrain1'](crop_size=opt.crop, scale_size=opt.size, baseline=opt.baseline),
-		                               num_workers=opt.threads, batch_size=opt.batch, shuffle=True, pin_memory=True)
-		val_data_loader1 = DataLoader(dataset=globals()[opt.dataset + 'ClsVal1'](crop_size=opt.crop, scale_size=opt.size),
-									 num_workers=opt.threads, batch_size=opt.batch, shuffle=False, pin_memory=False)
+		stages = progressive_schedule(opt.progressive, opt.size, opt.crop, opt.batch)
+		train_sampler = None
+		val_data_loader1 = prefetch(DataLoader(dataset=globals()[opt.dataset + 'ClsVal1'](crop_size=opt.crop, scale_size=opt.size, cache_bytes=int(opt.cache * (1 << 30))),
+									 num_workers=opt.threads, batch_size=opt.batch, shuffle=False, pin_memory=False), opt.prefetch)
 		kappa_best = 0
+		target_epoch = None
+		start = time.time()
 		for epoch in range(opt.epoch):
-			if opt.balance:
+			stage = [st for st in stages if st[0] <= epoch][-1]
+			if stage[0] == epoch:
+				_, size, crop, batch = stage
+				print('===> Training at size {} crop {} batch {}'.format(size, crop, batch))
+				train_set = globals()[opt.dataset + 'ClsTrain1'](crop_size=crop, scale_size=size, baseline=opt.baseline, batch_augment=opt.batchaug)
+				if opt.undersample and train_sampler is None:
+					train_sampler = ScheduledClassSampler(train_set.label.numpy(), w_i, w_r, opt.seed)
+				train_data_loader = prefetch(DataLoader(dataset=train_set, num_workers=opt.threads, batch_size=batch, shuffle=train_sampler is None,
+				                                        sampler=train_sampler, pin_memory=True, collate_fn=train_set.collate_fn), opt.prefetch)
+			if train_sampler is not None:
+				train_sampler.set_epoch(epoch)
+				print('===> ' + train_sampler.describe())
+			elif opt.balance:
 				w_epoch = torch.from_numpy(w_i*w_r**epoch + w_f*(1-w_r**epoch))
 				criterion = nn.CrossEntropyLoss(weight=w_epoch).cuda()
 			if epoch < opt.fix:
@@ -235,9 +274,21 @@ def main():
 					#lr = max((1 - float(epoch - opt.fix) / (opt.epoch - opt.fix)) ** 0.9 * opt.lr, 1e-6)
 			optimizer = optim.SGD([{'params': model.base.parameters()}, {'params': model.cls.parameters()}], lr=lr, momentum=opt.mom, weight_decay=opt.wd, nesterov=True)
 			logger = cls_train(train_data_loader, torch.nn.DataParallel(model).cuda(), criterion, optimizer, epoch, opt.display)
-			ten_crop_data_loader = []
-			kappa, pred, label = cls_val(val_data_loader1, torch.nn.DataParallel(model).cuda(), criterion,
-										 ten_crop_data_loader)
+			if opt.prefetch:
+				logger.append('Prefetch: {}'.format(train_data_loader.stats()))
+				print('===> ' + logger[-1])
+			if train_sampler is not None:
+				logger.insert(0, train_sampler.describe())
+			kappa, pred, label = cls_val(val_data_loader1, torch.nn.DataParallel(model).cuda(), criterion)
+			if val_data_loader1.dataset.cache is not None:
+				print('===> Val image cache: {}'.format(val_data_loader1.dataset.cache.stats()))
+			elapsed = time.time() - start
+			logger.append('Epoch: [{0}]\t' 'Size {1}\t' 'Crop {2}\t' 'Batch {3}\t' 'Elapsed {4:.1f}\t' 'Val Kappa {5:.4f}\t'
+			              .format(epoch, size, crop, batch, elapsed, kappa))
+			if opt.target is not None and target_epoch is None and kappa >= opt.target:
+				target_epoch = epoch
+				logger.append('Target kappa {0:.4f} reached at epoch {1} after {2:.1f}s'.format(opt.target, epoch, elapsed))
+				print('===> ' + logger[-1])
 			if kappa > kappa_best:
 				kappa_best = kappa
 				torch.save(model.cpu().state_dict(), os.path.join(output_dir, opt.dataset + '_cls_' + opt.model + '_%03d' % epoch + '_best.pth'))
@@ -249,25 +300,24 @@ def main():
 					fp.write(str(opt) + '\n\n')
 			with open(os.path.join(output_dir, 'train.log'), 'a') as fp:
 				fp.write('\n' + '\n'.join(logger))
+		if opt.target is not None and target_epoch is None:
+			print('===> Target kappa {0:.4f} not reached in {1:.1f}s'.format(opt.target, time.time() - start))
 
 	elif opt.phase == 'val':
 		if opt.weight:
 			print('===> Evaluating model')
-			val_data_loader = DataLoader(dataset=globals()[opt.dataset + 'ClsVal'](crop_size=opt.crop, scale_size=opt.size),
+			val_data_loader = DataLoader(dataset=globals()[opt.dataset + 'ClsVal'](crop_size=opt.crop, scale_size=opt.size, ten_crop=opt.tencrop),
 			                             num_workers=opt.threads, batch_size=opt.batch, shuffle=False, pin_memory=False)
-			ten_crop_data_loader = []
-			if opt.tencrop:
-				for crop_idx in range(10):
-					ten_crop_data_loader.append(iter(DataLoader(dataset=globals()[opt.dataset + 'ClsValTenCrop'](crop_idx, opt.crop, opt.size),
-					                                            num_workers=opt.threads, batch_size=opt.batch, shuffle=False, pin_memory=False)))
-			kappa, pred, label = cls_val(val_data_loader, torch.nn.DataParallel(model).cuda(), criterion, ten_crop_data_loader)
+			store = LogitWriter(os.path.join(output_dir, 'logits'))
+			kappa, pred, label = cls_val(val_data_loader, torch.nn.DataParallel(model).cuda(), criterion, store)
+			store.close([os.path.basename(image) for image in val_data_loader.dataset.image])
 			print('===> Kappa: %.4f' % kappa)
 			print('===> Confusion Matrix:')
 			print(confusion_matrix(label, pred))
 			with open(os.path.join(output_dir, 'val.log'), 'w') as fp:
 				fp.write(str(opt)+'\n')
 				fp.write('\n===> Kappa: %.4f' % kappa)
-			np.save(os.path.join(output_dir, 'results.npy'), pred, label, confusion_matrix(label, pred))
+			np.savez(os.path.join(output_dir, 'results.npz'), pred=pred, label=label, confusion=confusion_matrix(label, pred))
 
 		else:
 			raise Exception('No weights found')
@@ -1,272 +1,300 @@
 import json
 import torch.utils.data
 import numpy as np
-from PIL import Image
-from utils import TenCrop, HorizontalFlip, Affine, ColorJitter, Lighting, PILColorJitter
+from utils import TenCrop, TenCropStack, HorizontalFlip, Affine, ColorJitter, Lighting, PILColorJitter, LabelTable, ToByteTensor, BatchAugment
+from torch.utils.data.dataloader import default_collate
 import torchvision.transforms as transforms
 import os
-
-
-class kaggleClsTrain(torch.utils.data.Dataset):
-	def __init__(self, crop_size, scale_size, baseline):
-		super(kaggleClsTrain, self).__init__()
-		self.image = ['data/kaggle/train_images/' + line.strip() + '_' + str(scale_size) + '.png' for line in open('data/kaggle/train_images.txt', 'r')]
-		self.label = torch.from_numpy(np.array(np.loadtxt('data/kaggle/train_labels.txt'), np.int))
-		with open('data/kaggle/info.json', 'r') as fp:
+from image_cache import SharedImageCache, open_image
+
+'''
+Every classification split is one registry entry: the image root, the image list (a txt with one id per line
+plus a txt of labels, or a dataset csv and its label column) and the info.json with the color statistics.
+Images are <root>/<id>_<scale_size>.png. The lists and the statistics are read once per process and shared by
+every dataset built on them; the kaggleCls* names used with --dataset are thin constructors of ClsDataSet.
+'''
+DATASETS = {
+	'kaggle_train': {'root': 'data/kaggle/train_images', 'images': 'data/kaggle/train_images.txt',
+	                 'labels': 'data/kaggle/train_labels.txt', 'info': 'data/kaggle/info.json'},
+	'kaggle_val': {'root': 'data/kaggle/val_images', 'images': 'data/kaggle/val_images.txt',
+	               'labels': 'data/kaggle/val_labels.txt', 'info': 'data/kaggle/info.json'},
+	'kaggle1_train': {'root': 'data/kaggle1/train_images/train', 'images': 'data/kaggle1/train_images/train/train_images.txt',
+	                  'labels': 'data/kaggle1/train_images/train/train_labels.txt', 'info': 'data/kaggle/info.json'},
+	'kaggle1_val': {'root': 'data/kaggle1/train_images/val', 'images': 'data/kaggle1/train_images/val/val_images.txt',
+	                'labels': 'data/kaggle1/train_images/val/val_labels.txt', 'info': 'data/kaggle/info.json'},
+	'zhizhen_train': {'root': 'data/zhizhen/train', 'images': 'data/zhizhen/train/train_images.txt',
+	                  'labels': 'data/zhizhen/train/train_labels.txt', 'info': 'data/zhizhen/info.json'},
+	'zhizhen_val': {'root': 'data/zhizhen/val', 'images': 'data/zhizhen/val/val_images.txt',
+	                'labels': 'data/zhizhen/val/val_labels.txt', 'info': 'data/zhizhen/info.json'},
+	'zhizhen_test': {'root': 'data/zhizhen/test', 'images': 'data/zhizhen/test/val_images.txt',
+	                 'labels': 'data/zhizhen/test/val_labels.txt', 'info': 'data/zhizhen/info.json'},
+}
+
+_lists = {}
+_infos = {}
+
+
+def register_dataset(name, root, info, images=None, labels=None, csv=None, column=None):
+	"""Adds a split read from txt lists (images, labels) or from a dataset csv and one of its label columns"""
+	DATASETS[name] = {'root': root, 'info': info, 'images': images, 'labels': labels, 'csv': csv, 'column': column}
+
+
+def dataset_list(name):
+	"""(ids, labels) of a registered split, labels is an int64 tensor or None"""
+	if name not in _lists:
+		entry = DATASETS[name]
+		if entry.get('csv'):
+			table = LabelTable(entry['csv'])
+			ids = [image.decode('utf-8') for image in table.ids]
+			label = table.labels[:, table.columns.index(entry['column']) - 1]
+		else:
+			ids = [line.strip() for line in open(entry['images'], 'r')]
+			label = np.loadtxt(entry['labels']) if entry.get('labels') else None
+		if label is not None:
+			label = torch.from_numpy(np.array(label, np.int64))
+			if len(ids) != len(label):
+				raise Exception("The number of images and labels should be the same.")
+		_lists[name] = (ids, label)
+	return _lists[name]
+
+
+def dataset_info(path):
+	"""The info.json statistics as tensors: mean and std scaled to [0, 1], eigval and eigvec"""
+	if path not in _infos:
+		with open(path, 'r') as fp:
 			info = json.load(fp)
-		mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
-		std_values = torch.from_numpy(np.array(info['std'], dtype=np.float32) / 255)
-		eigen_values = torch.from_numpy(np.array(info['eigval'], dtype=np.float32))
-		eigen_vectors = torch.from_numpy(np.array(info['eigvec'], dtype=np.float32))
-		if baseline:
+		_infos[path] = {
+			'mean': torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255),
+			'std': torch.from_numpy(np.array(info['std'], dtype=np.float32) / 255),
+			'eigval': torch.from_numpy(np.array(info['eigval'], dtype=np.float32)),
+			'eigvec': torch.from_numpy(np.array(info['eigvec'], dtype=np.float32)),
+		}
+	return _infos[path]
+
+
+class ClsDataSet(torch.utils.data.Dataset):
+	"""
+	A registered split with the train (baseline or full augmentation), center crop val or one of the ten
+	crops (crop_idx) transforms. Ten-crop datasets return the image only, the others (image, label).
+	With ten_crop a val dataset returns every test view of an image at once, (11, 3, crop_size, crop_size), see TenCropStack.
+	With batch_augment the full training augmentation stops at the crop and returns uint8 images; the flip, color
+	jitter, lighting and normalization run on the whole batch in collate_fn, which the DataLoader has to use.
+	With a manifest (see manifest.py) every image is checked to exist at scale_size x scale_size up front.
+	With return_name a labelled dataset returns (image, label, image file name).
+	"""
+
+	def __init__(self, name, crop_size, scale_size, train=False, baseline=False, crop_idx=None, cache_bytes=0, batch_augment=False,
+	             ten_crop=False, manifest=None, return_name=False):
+		super(ClsDataSet, self).__init__()
+		self.return_name = return_name
+		entry = DATASETS[name]
+		ids, self.label = dataset_list(name)
+		self.image = [os.path.join(entry['root'], i + '_' + str(scale_size) + '.png') for i in ids]
+		if manifest is not None:
+			bad = [path for path in self.image if manifest.dimensions(path) != (scale_size, scale_size)]
+			if bad:
+				raise Exception('{} of {} images are missing or not {}x{}, e.g. {}'.format(len(bad), len(self.image), scale_size, scale_size, bad[0]))
+		info = dataset_info(entry['info'])
+		self.collate_fn = default_collate
+		if crop_idx is not None:
+			self.label = None
+			self.transform = transforms.Compose([
+				TenCrop(crop_idx // 2, crop_size, scale_size),
+				HorizontalFlip(crop_idx % 2),
+				transforms.ToTensor(),
+				transforms.Normalize(mean=info['mean'], std=info['std']),
+			])
+		elif train and baseline:
 			self.transform = transforms.Compose([
 				transforms.RandomCrop(crop_size),
 				transforms.RandomHorizontalFlip(),
 				transforms.ToTensor(),
-				transforms.Normalize(mean=mean_values, std=std_values),
+				transforms.Normalize(mean=info['mean'], std=info['std']),
 			])
-		else:
+		elif train and batch_augment:
+			self.transform = transforms.Compose([
+				transforms.RandomSizedCrop(crop_size),
+				ToByteTensor(),
+			])
+			self.collate_fn = BatchAugment(info['mean'], info['std'], info['eigval'], info['eigvec'], alphastd=0.1).collate
+		elif train:
 			self.transform = transforms.Compose([
 				transforms.RandomSizedCrop(crop_size),
 				transforms.RandomHorizontalFlip(),
 				PILColorJitter(),
 				transforms.ToTensor(),
 				#ColorJitter(),
-				Lighting(alphastd=0.1, eigval=eigen_values, eigvec=eigen_vectors),
+				Lighting(alphastd=0.1, eigval=info['eigval'], eigvec=info['eigvec']),
 				#Affine(rotation_range=180, translation_range=None, shear_range=None, zoom_range=None),
-				transforms.Normalize(mean=mean_values, std=std_values),
+				transforms.Normalize(mean=info['mean'], std=info['std']),
+			])
+		elif ten_crop:
+			self.transform = TenCropStack(crop_size, scale_size, info['mean'], info['std'])
+		else:
+			self.transform = transforms.Compose([
+				transforms.Scale(scale_size),
+				transforms.CenterCrop(crop_size),
+				transforms.ToTensor(),
+				transforms.Normalize(mean=info['mean'], std=info['std']),
 			])
+		# decoded images shared by the loader workers and kept across epochs
+		self.cache = SharedImageCache(len(self.image), cache_bytes, (scale_size, scale_size, 3)) if cache_bytes > 0 else None
 
 	def __getitem__(self, index):
-		return self.transform(Image.open(self.image[index])), self.label[index]
+		image = self.transform(open_image(self.image[index], self.cache, index))
+		if self.label is None:
+			return image
+		if self.return_name:
+			return image, self.label[index], os.path.basename(self.image[index])
+		return image, self.label[index]
 
 	def __len__(self):
-		if len(self.image) != len(self.label):
-			raise Exception("The number of images and labels should be the same.")
-		return len(self.label)
+		return len(self.image)
 
 
-class kaggleClsVal(torch.utils.data.Dataset):
-	def __init__(self, crop_size, scale_size):
-		super(kaggleClsVal, self).__init__()
-		self.image = ['data/kaggle/val_images/' + line.strip() + '_' + str(scale_size) + '.png' for line in open('data/kaggle/val_images.txt', 'r')]
-		self.label = torch.from_numpy(np.array(np.loadtxt('data/kaggle/val_labels.txt'), np.int))
-		with open('data/kaggle/info.json', 'r') as fp:
-			info = json.load(fp)
-		mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
-		std_values = torch.from_numpy(np.array(info['std'], dtype=np.float32) / 255)
-		self.transform = transforms.Compose([
-			transforms.Scale(scale_size),
-			transforms.CenterCrop(crop_size),
-			transforms.ToTensor(),
-			transforms.Normalize(mean=mean_values, std=std_values),
-		])
+def kaggleClsTrain(crop_size, scale_size, baseline, batch_augment=False):
+	return ClsDataSet('kaggle_train', crop_size, scale_size, train=True, baseline=baseline, batch_augment=batch_augment)
 
-	def __getitem__(self, index):
-		return self.transform(Image.open(self.image[index])), self.label[index]
 
-	def __len__(self):
-		if len(self.image) != len(self.label):
-			raise Exception("The number of images and labels should be the same.")
-		return len(self.label)
+def kaggleClsVal(crop_size, scale_size, cache_bytes=0, ten_crop=False, return_name=False):
+	return ClsDataSet('kaggle_val', crop_size, scale_size, cache_bytes=cache_bytes, ten_crop=ten_crop, return_name=return_name)
 
 
-class kaggleClsValTenCrop(torch.utils.data.Dataset):
-	def __init__(self, crop_idx, crop_size, scale_size):
-		super(kaggleClsValTenCrop, self).__init__()
-		self.image = ['data/kaggle/val_images/' + line.strip() + '_' + str(scale_size) + '.png' for line in open('data/kaggle/val_images.txt', 'r')]
-		with open('data/kaggle/info.json', 'r') as fp:
-			info = json.load(fp)
-		mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
-		std_values = torch.from_numpy(np.array(info['std'], dtype=np.float32) / 255)
-		self.transform = transforms.Compose([
-			TenCrop(crop_idx // 2, crop_size, scale_size),
-			HorizontalFlip(crop_idx % 2),
-			transforms.ToTensor(),
-			transforms.Normalize(mean=mean_values, std=std_values),
-		])
+def kaggleClsValTenCrop(crop_idx, crop_size, scale_size):
+	return ClsDataSet('kaggle_val', crop_size, scale_size, crop_idx=crop_idx)
 
-	def __getitem__(self, index):
-		return self.transform(Image.open(self.image[index]))
 
-	def __len__(self):
-		return len(self.image)
+def kaggleClsTrain1(crop_size, scale_size, baseline, batch_augment=False):
+	return ClsDataSet('kaggle1_train', crop_size, scale_size, train=True, baseline=baseline, batch_augment=batch_augment)
 
 
-class kaggleClsTrain1(torch.utils.data.Dataset):
-	def __init__(self, crop_size, scale_size, baseline):
-		super(kaggleClsTrain1, self).__init__()
-		self.image = ['data/kaggle1/train_images/train/' + line.strip() + '_' + str(scale_size) + '.png' for line in open('data/kaggle1/train_images/train/train_images.txt', 'r')]
-		self.label = torch.from_numpy(np.array(np.loadtxt('data/kaggle1/train_images/train/train_labels.txt'), np.int))
-		with open('data/kaggle/info.json', 'r') as fp:
-			info = json.load(fp)
-		mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
-		std_values = torch.from_numpy(np.array(info['std'], dtype=np.float32) / 255)
-		eigen_values = torch.from_numpy(np.array(info['eigval'], dtype=np.float32))
-		eigen_vectors = torch.from_numpy(np.array(info['eigvec'], dtype=np.float32))
-		if baseline:
-			self.transform = transforms.Compose([
-				transforms.RandomCrop(crop_size),
-				transforms.RandomHorizontalFlip(),
-				transforms.ToTensor(),
-				transforms.Normalize(mean=mean_values, std=std_values),
-			])
-		else:
-			self.transform = transforms.Compose([
-				transforms.RandomSizedCrop(crop_size),
-				transforms.RandomHorizontalFlip(),
-				PILColorJitter(),
-				transforms.ToTensor(),
-				#ColorJitter(),
-				Lighting(alphastd=0.1, eigval=eigen_values, eigvec=eigen_vectors),
-				#Affine(rotation_range=180, translation_range=None, shear_range=None, zoom_range=None),
-				transforms.Normalize(mean=mean_values, std=std_values),
-			])
+def kaggleClsVal1(crop_size, scale_size, cache_bytes=0, ten_crop=False, return_name=False):
+	return ClsDataSet('kaggle1_val', crop_size, scale_size, cache_bytes=cache_bytes, ten_crop=ten_crop, return_name=return_name)
 
-	def __getitem__(self, index):
-		return self.transform(Image.open(self.image[index])), self.label[index]
 
-	def __len__(self):
-		if len(self.image) != len(self.label):
-			raise Exception("The number of images and labels should be the same.")
-		return len(self.label)
+def kaggleClsTrain_ZZ(crop_size, scale_size, baseline, batch_augment=False):
+	return ClsDataSet('zhizhen_train', crop_size, scale_size, train=True, baseline=baseline, batch_augment=batch_augment)
 
 
-class kaggleClsVal1(torch.utils.data.Dataset):
-	def __init__(self, crop_size, scale_size):
-		super(kaggleClsVal1, self).__init__()
-		self.image = ['data/kaggle1/train_images/val/' + line.strip() + '_' + str(scale_size) + '.png' for line in open('data/kaggle1/train_images/val/val_images.txt', 'r')]
-		self.label = torch.from_numpy(np.array(np.loadtxt('data/kaggle1/train_images/val/val_labels.txt'), np.int))
-		with open('data/kaggle/info.json', 'r') as fp:
-			info = json.load(fp)
-		mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
-		std_values = torch.from_numpy(np.array(info['std'], dtype=np.float32) / 255)
-		self.transform = transforms.Compose([
-			transforms.Scale(scale_size),
-			transforms.CenterCrop(crop_size),
-			transforms.ToTensor(),
-			transforms.Normalize(mean=mean_values, std=std_values),
-		])
+def kaggleClsVal_ZZ(crop_size, scale_size, cache_bytes=0, ten_crop=False):
+	return ClsDataSet('zhizhen_val', crop_size, scale_size, cache_bytes=cache_bytes, ten_crop=ten_crop)
 
-	def __getitem__(self, index):
-		return self.transform(Image.open(self.image[index])), self.label[index]
 
-	def __len__(self):
-		if len(self.image) != len(self.label):
-			raise Exception("The number of images and labels should be the same.")
-		return len(self.label)
+def kaggleClsTest_ZZ(crop_size, scale_size, cache_bytes=0, ten_crop=False):
+	return ClsDataSet('zhizhen_test', crop_size, scale_size, cache_bytes=cache_bytes, ten_crop=ten_crop)
 
 
-class kaggleClsTrain_ZZ(torch.utils.data.Dataset):
-	def __init__(self, crop_size, scale_size, baseline):
-		super(kaggleClsTrain_ZZ, self).__init__()
-		self.image = ['data/zhizhen/train/' + line.strip() + '_' + str(scale_size) + '.png' for line in open('data/zhizhen/train/train_images.txt', 'r')]
-		self.label = torch.from_numpy(np.array(np.loadtxt('data/zhizhen/train/train_labels.txt'), np.int))
-		with open('data/zhizhen/info.json', 'r') as fp:
-			info = json.load(fp)
-		mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
-		std_values = torch.from_numpy(np.array(info['std'], dtype=np.float32) / 255)
-		eigen_values = torch.from_numpy(np.array(info['eigval'], dtype=np.float32))
-		eigen_vectors = torch.from_numpy(np.array(info['eigvec'], dtype=np.float32))
-		if baseline:
-			self.transform = transforms.Compose([
-				transforms.RandomCrop(crop_size),
-				transforms.RandomHorizontalFlip(),
-				transforms.ToTensor(),
-				transforms.Normalize(mean=mean_values, std=std_values),
-			])
-		else:
-			self.transform = transforms.Compose([
-				transforms.RandomSizedCrop(crop_size),
-				transforms.RandomHorizontalFlip(),
-				PILColorJitter(),
-				transforms.ToTensor(),
-				#ColorJitter(),
-				Lighting(alphastd=0.1, eigval=eigen_values, eigvec=eigen_vectors),
-				#Affine(rotation_range=180, translation_range=None, shear_range=None, zoom_range=None),
-				transforms.Normalize(mean=mean_values, std=std_values),
-			])
+class ScheduledClassSampler(torch.utils.data.Sampler):
+	"""
+	Class-balanced undersampling annealed back to natural sampling: class c keeps the fraction
+	rate_c = initial_c * ratio^e + (1 - ratio^e) of its images at epoch e, where initial_c is
+	weights_initial_c / max(weights_initial), the --balance starting weights. Early epochs are short and
+	balanced (few grade 0 images), the rates then decay towards 1 at the --balance weights_ratio, so late
+	epochs draw every image, at the natural class frequencies. The per-class counts of an epoch are fixed,
+	the images drawn for them change with the epoch.
+	"""
 
-	def __getitem__(self, index):
-		return self.transform(Image.open(self.image[index])), self.label[index]
+	def __init__(self, labels, weights_initial, weights_ratio, seed=0):
+		self.labels = np.asarray(labels, dtype=np.int64)
+		self.weights_initial = np.asarray(weights_initial, dtype=np.float64)
+		self.weights_ratio = float(weights_ratio)
+		self.seed = seed
+		self.indices = [np.nonzero(self.labels == c)[0] for c in range(len(self.weights_initial))]
+		self.epoch = 0
 
-	def __len__(self):
-		if len(self.image) != len(self.label):
-			raise Exception("The number of images and labels should be the same.")
-		return len(self.label)
-
-class kaggleClsVal_ZZ(torch.utils.data.Dataset):
-	def __init__(self, crop_size, scale_size):
-		super(kaggleClsVal_ZZ, self).__init__()
-		self.image = ['data/zhizhen/val/' + line.strip() + '_' + str(scale_size) + '.png' for line in open('data/zhizhen/val/val_images.txt', 'r')]
-		self.label = torch.from_numpy(np.array(np.loadtxt('data/zhizhen/val/val_labels.txt'), np.int))
-		with open('data/zhizhen/info.json', 'r') as fp:
-			info = json.load(fp)
-		mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
-		std_values = torch.from_numpy(np.array(info['std'], dtype=np.float32) / 255)
-		self.transform = transforms.Compose([
-			transforms.Scale(scale_size),
-			transforms.CenterCrop(crop_size),
-			transforms.ToTensor(),
-			transforms.Normalize(mean=mean_values, std=std_values),
-		])
+	def set_epoch(self, epoch):
+		self.epoch = epoch
 
-	def __getitem__(self, index):
-		return self.transform(Image.open(self.image[index])), self.label[index]
+	def rates(self, epoch=None):
+		decay = self.weights_ratio ** (self.epoch if epoch is None else epoch)
+		return self.weights_initial / self.weights_initial.max() * decay + (1 - decay)
 
-	def __len__(self):
-		if len(self.image) != len(self.label):
-			raise Exception("The number of images and labels should be the same.")
-		return len(self.label)
+	def counts(self, epoch=None):
+		return [int(round(rate * len(index))) for rate, index in zip(self.rates(epoch), self.indices)]
 
+	def __iter__(self):
+		rng = np.random.RandomState(self.seed + self.epoch)
+		chosen = [rng.permutation(index)[:count] for index, count in zip(self.indices, self.counts())]
+		return iter(rng.permutation(np.concatenate(chosen)).tolist())
 
-class kaggleClsTest_ZZ(torch.utils.data.Dataset):
-	def __init__(self, crop_size, scale_size):
-		super(kaggleClsTest_ZZ, self).__init__()
-		self.image = ['data/zhizhen/test/' + line.strip() + '_' + str(scale_size) + '.png' for line in open('data/zhizhen/test/val_images.txt', 'r')]
-		self.label = torch.from_numpy(np.array(np.loadtxt('data/zhizhen/test/val_labels.txt'), np.int))
-		with open('data/zhizhen/info.json', 'r') as fp:
-			info = json.load(fp)
-		mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
-		std_values = torch.from_numpy(np.array(info['std'], dtype=np.float32) / 255)
-		self.transform = transforms.Compose([
-			transforms.Scale(scale_size),
-			transforms.CenterCrop(crop_size),
-			transforms.ToTensor(),
-			transforms.Normalize(mean=mean_values, std=std_values),
-		])
+	def __len__(self):
+		return sum(self.counts())
+
+	def describe(self):
+		counts = self.counts()
+		return 'Epoch: [{0}] sampled {1} of {2} images ({3:.1f}%), per class {4}'.format(
+			self.epoch, sum(counts), len(self.labels), 100.0 * sum(counts) / len(self.labels),
+			' '.join('{}/{}'.format(count, len(index)) for count, index in zip(counts, self.indices)))
+
+
+class MixedClsDataSet(torch.utils.data.Dataset):
+	"""
+	Several registered splits behind one index, each with its own images, labels and info.json normalization:
+	index i is sample i - offsets[s] of source s. Sampled with MixedSourceSampler the sources are mixed per batch
+	without merging list files or copying images. Sources outside DATASETS are added with register_dataset first,
+	e.g. the dme csvs of data/dme/extract_dr_dme_flags_train_val_test.py with column='dr_level' and the root
+	of their <id>_<scale_size>.png images.
+	"""
+
+	def __init__(self, names, crop_size, scale_size, train=False, baseline=False):
+		super(MixedClsDataSet, self).__init__()
+		self.names = list(names)
+		self.sources = [ClsDataSet(name, crop_size, scale_size, train=train, baseline=baseline) for name in self.names]
+		self.sizes = [len(source) for source in self.sources]
+		self.offsets = np.cumsum([0] + self.sizes)
+		self.label = torch.cat([source.label for source in self.sources])
+		self.collate_fn = default_collate
 
 	def __getitem__(self, index):
-		return self.transform(Image.open(self.image[index])), self.label[index]
+		source = int(np.searchsorted(self.offsets, index, side='right')) - 1
+		return self.sources[source][int(index - self.offsets[source])]
 
 	def __len__(self):
-		if len(self.image) != len(self.label):
-			raise Exception("The number of images and labels should be the same.")
-		return len(self.label)
-
-
-
-
-class kaggleClsVal(torch.utils.data.Dataset):
-	def __init__(self, crop_size, scale_size):
-		super(kaggleClsVal, self).__init__()
-		self.image = ['data/kaggle/val_images/' + line.strip() + '_' + str(scale_size) + '.png' for line in open('data/kaggle/val_images.txt', 'r')]
-		self.label = torch.from_numpy(np.array(np.loadtxt('data/kaggle/val_labels.txt'), np.int))
-		with open('data/kaggle/info.json', 'r') as fp:
-			info = json.load(fp)
-		mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
-		std_values = torch.from_numpy(np.array(info['std'], dtype=np.float32) / 255)
-		self.transform = transforms.Compose([
-			transforms.Scale(scale_size),
-			transforms.CenterCrop(crop_size),
-			transforms.ToTensor(),
-			transforms.Normalize(mean=mean_values, std=std_values),
-		])
-
-	def __getitem__(self, index):
-		return self.transform(Image.open(self.image[index])), self.label[index], os.path.basename(self.image[index])
+		return int(self.offsets[-1])
+
+
+class MixedSourceSampler(torch.utils.data.Sampler):
+	"""
+	Epochs of num_samples indices of a MixedClsDataSet (its length by default) with source s drawing the share
+	ratios[s] / sum(ratios) of them, shuffled together. A source smaller than its share is repeated, each pass in a
+	new order; the draw changes with set_epoch and describe() reports the per-source counts.
+	"""
+
+	def __init__(self, dataset, ratios, num_samples=None, seed=0):
+		if len(ratios) != len(dataset.sizes):
+			raise Exception('One sampling ratio per source is needed')
+		ratios = np.asarray(ratios, dtype=np.float64)
+		for name, size, ratio in zip(dataset.names, dataset.sizes, ratios):
+			if size == 0:
+				raise Exception('Source {} has no images to sample from'.format(name))
+			if not ratio > 0 or not np.isfinite(ratio):
+				raise Exception('Source {} needs a positive sampling ratio, got {}'.format(name, ratio))
+		self.names = dataset.names
+		self.sizes = dataset.sizes
+		self.offsets = dataset.offsets
+		self.num_samples = len(dataset) if num_samples is None else num_samples
+		self.counts = [int(round(share * self.num_samples)) for share in ratios / ratios.sum()]
+		for name, ratio, count in zip(self.names, ratios, self.counts):
+			if count == 0:
+				raise Exception('Source {} gets no images: its ratio {} is too small a share of {} samples per epoch'.format(
+					name, ratio, self.num_samples))
+		self.seed = seed
+		self.epoch = 0
+
+	def set_epoch(self, epoch):
+		self.epoch = epoch
+
+	def __iter__(self):
+		rng = np.random.RandomState(self.seed + self.epoch)
+		chosen = []
+		for offset, size, count in zip(self.offsets, self.sizes, self.counts):
+			passes = [rng.permutation(size) for _ in range(-(-count // size))]
+			chosen.append(offset + np.concatenate(passes)[:count])
+		return iter(rng.permutation(np.concatenate(chosen)).tolist())
 
 	def __len__(self):
-		if len(self.image) != len(self.label):
-			raise Exception("The number of images and labels should be the same.")
-		return len(self.label)
\ No newline at end of file
+		return sum(self.counts)
+
+	def describe(self):
+		return 'Epoch: [{0}] sampled {1} images, per source {2}'.format(self.epoch, sum(self.counts), ' '.join(
+			'{}:{}/{}'.format(name, count, size) for name, count, size in zip(self.names, self.counts, self.sizes)))
@@ -1,9 +1,12 @@
+import sys
+sys.path.append('../../')
 from PIL import Image
+from image_decode import load_image
 scale_sizes = [1024, 512, 256, 128]
 #image_paths = ['train_images/' + line.strip() for line in open('train_images.txt', 'r')]
 image_paths = ['val_images/' + line.strip() for line in open('val_images.txt', 'r')]
 for index in range(len(image_paths)):
-	image = Image.open(image_paths[index] + '.jpeg').convert('RGB')
+	image = load_image(image_paths[index] + '.jpeg')
 	w, h = image.size
 	tw, th = (min(w, h), min(w, h))
 	image = image.crop((w // 2 - tw // 2, h // 2 - th // 2, w // 2 + tw // 2, h // 2 + th // 2))
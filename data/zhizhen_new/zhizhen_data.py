@@ -1,3 +1,5 @@
+import sys
+sys.path.append('../../')
 import os
 import argparse
 
@@ -5,7 +7,7 @@ import shutil
 
 import pandas as pd
 
-from glob import glob
+from manifest import ImageManifest
 
 from sklearn.cross_validation import train_test_split
 
@@ -22,6 +24,7 @@ def parse_args():
     parser.add_argument('--csvtrain_bin', default='train_bin.csv')
     parser.add_argument('--csvval_bin', default='val_bin.csv')
     parser.add_argument('--csvtest_bin', default='test_bin.csv')
+    parser.add_argument('--manifest', default=None, help='The image manifest, <root>/manifest.db by default')
     parser.add_argument('--valratio', type=float, default=0.1)
     parser.add_argument('--testratio', type=float, default=0.2)
 
@@ -37,6 +40,10 @@ os.makedirs(new_folder, exist_ok=True)
 
 assert os.path.isdir(new_folder)
 
+manifest = ImageManifest(args.manifest or os.path.join(args.root, 'manifest.db'))
+manifest.refresh('./NormalData', hash=False)
+manifest.refresh(os.path.join(args.root, '512'), hash=False)
+
 images_list = []
 dr_list = []
 dme_list = []
@@ -56,7 +63,7 @@ with open('/home/weidong/code/github/DiabeticRetinopathy_solution/data/zhizhen_n
         # shutil.copy(os.path.join(args.root, '{0}/{1}'.format(dr_level, vec[0])), new_folder)
         print('copy from {0} to {1}'.format(os.path.join(args.root, '{0}/{1}'.format(dr_level, vec[0])),new_folder))
 
-normal_list = glob('./NormalData/*.jpg')
+normal_list = manifest.files('./NormalData', '.jpg')
 for index in normal_list:
     images_list.append(os.path.basename(index))
     dr_list.append(0)
@@ -77,22 +84,15 @@ assert len(images_list) == len(dr_list) == len(dme_list)
 
 print('before: {}'.format(len(images_list)))
 
-all_list = glob(os.path.join(args.root, '512/*.png'))
-all_list = [os.path.basename(index).replace('_512.png', '') for index in all_list]
-
-err_list = []
+all_set = manifest.names(os.path.join(args.root, '512'))
 
-for i, index in enumerate(images_list):
-    if index in all_list:
-        continue
-    err_list.append(i)
+keep = [i for i, index in enumerate(images_list) if index + '_512.png' in all_set]
 
-print('err list len: {}'.format(len(err_list)))
+print('err list len: {}'.format(len(images_list) - len(keep)))
 
-for index in err_list:
-    images_list.remove(images_list[index])
-    dr_list.remove(dr_list[index])
-    dme_list.remove(dme_list[index])
+images_list = [images_list[i] for i in keep]
+dr_list = [dr_list[i] for i in keep]
+dme_list = [dme_list[i] for i in keep]
 
 assert len(images_list) == len(dr_list) == len(dme_list)
 
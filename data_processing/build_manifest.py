@@ -0,0 +1,41 @@
+import sys
+sys.path.append('../')
+import time
+import argparse
+
+from manifest import ImageManifest
+
+'''
+Builds or refreshes the image manifest (path, size, mtime, dimensions, md5) of one or more image roots, only
+the files changed since the last run are read again:
+
+python build_manifest.py --db ../data/zhizhen_new/LabelImages/manifest.db --root ../data/zhizhen_new/LabelImages/512 ../data/zhizhen_new/NormalData
+python build_manifest.py --db ../web_service/kaggle/manifest.db --root ../web_service/kaggle --nohash
+'''
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='index image roots into a sqlite manifest')
+    parser.add_argument('--db', required=True, help='The sqlite manifest')
+    parser.add_argument('--root', nargs='+', required=True, help='The image roots to index, searched recursively')
+    parser.add_argument('--nohash', action='store_true', help='Skip the content hashes')
+    parser.add_argument('--duplicates', action='store_true', help='Print the files with identical content')
+    return parser.parse_args()
+
+
+def main():
+    opt = parse_args()
+    manifest = ImageManifest(opt.db)
+    for root in opt.root:
+        start = time.time()
+        added, updated, removed = manifest.refresh(root, hash=not opt.nohash)
+        print('====> {}: {} added, {} updated, {} removed in {:.2f}s'.format(root, added, updated, removed, time.time() - start))
+    print('====> {} files in {}'.format(len(manifest), opt.db))
+    if opt.duplicates:
+        for paths in manifest.duplicates():
+            print('\t'.join(paths))
+    manifest.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,8 @@
+import sys
+sys.path.append('../')
 from PIL import Image
 import os
+from image_decode import load_image
 
 # scale_sizes = [1024, 512, 256, 128]
 scale_sizes = [512]
@@ -9,7 +12,7 @@ def scale_image(root, imglist, threadid):
     print(imglist)
     for index in imglist:
         try:
-            image = Image.open(os.path.join(root, '{}.jpg'.format(index)))
+            image = load_image(os.path.join(root, '{}.jpg'.format(index)))
             w, h = image.size
             tw, th = (min(w, h), min(w, h))
             image = image.crop((w // 2 - tw // 2, h // 2 - th // 2, w // 2 + tw // 2, h // 2 + th // 2))
@@ -0,0 +1,58 @@
+import sys
+sys.path.append('../')
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+from packed_images import write_packed_images
+from image_decode import decode_image
+
+'''
+Packs the <id>_<size>.png images written by data_preprocessing_scale.py into uint8 memmap shards:
+
+python pack_images.py --root ../data/kaggle/train_images --list ../data/kaggle/train_images.txt --output ../data/kaggle/packed_train_512
+python pack_images.py --root /data/zhizhen/512 --list train.csv --output /data/zhizhen/packed_512
+
+With --ahe_root every record also holds the <id>_<size>_ahe.png image of the multi-channel datasets, 6 channels:
+
+python pack_images.py --root /data/zhizhen/512 --ahe_root /data/zhizhen/512_ahe --list train.csv --output /data/zhizhen/packed_512_ahe
+'''
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='pack pre-resized images into memmap shards')
+    parser.add_argument('--root', required=True, help='The directory of the <id>_<size>.png images')
+    parser.add_argument('--list', required=True, help='A txt with one id per line, or a csv whose first column is the id')
+    parser.add_argument('--ahe_root', default=None, help='The directory of the <id>_<size>_ahe.png images to pack alongside')
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--size', default=512, type=int)
+    parser.add_argument('--shard', default=4096, type=int, help='The number of images per shard')
+    return parser.parse_args()
+
+
+def read_ids(path):
+    if path.endswith('.csv'):
+        return [str(i) for i in pd.read_csv(path, index_col=0).iloc[:, 0]]
+    return [line.strip() for line in open(path, 'r') if line.strip()]
+
+
+def load_image(opt, image_id):
+    image = decode_image(os.path.join(opt.root, image_id + '_' + str(opt.size) + '.png'))
+    if opt.ahe_root is None:
+        return image
+    ahe = decode_image(os.path.join(opt.ahe_root, image_id + '_' + str(opt.size) + '_ahe.png'))
+    return np.concatenate([image, ahe], 2)
+
+
+def main():
+    opt = parse_args()
+    ids = read_ids(opt.list)
+    channels = 3 if opt.ahe_root is None else 6
+    print('====> packing {} images of {}px, {} channels into {}'.format(len(ids), opt.size, channels, opt.output))
+    write_packed_images(opt.output, ids, lambda image_id: load_image(opt, image_id), opt.size, opt.shard, channels)
+    print('====> done')
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,7 @@ import torch.backends.cudnn as cudnn
 from sklearn.metrics import confusion_matrix
 import drn
 from utils import quadratic_weighted_kappa, AverageMeter
+from image_decode import load_image
 from data import *
 
 from torchvision.utils import make_grid, save_image
@@ -62,7 +63,7 @@ class kaggleClsTrain(torch.utils.data.Dataset):
 			])
 
 	def __getitem__(self, index):
-		return self.transform(Image.open(self.image[index])), self.label[index]
+		return self.transform(load_image(self.image[index])), self.label[index]
 
 	def __len__(self):
 		if len(self.image) != len(self.label):
@@ -0,0 +1,83 @@
+import sys
+sys.path.append('../')
+import time
+import argparse
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+
+from utils import PILColorJitter, Lighting, ToByteTensor, BatchAugment
+
+'''
+Per-sample PIL augmentation (RandomHorizontalFlip, PILColorJitter, ToTensor, Lighting, Normalize) against
+BatchAugment on the stacked uint8 batch: images/sec, and the per-channel mean/std and gradient statistics of
+the two outputs on the same image. BatchAugment runs the blur and sharpness filters before the color steps
+and clips once, where PILColorJitter runs all five in a random order, so they agree only roughly.
+
+python batch_augment_benchmark.py --size 448 --batch 32
+'''
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='per-sample PIL vs batched tensor augmentation')
+    parser.add_argument('--image', default=None, help='An image to augment, a synthetic fundus-like image when not given')
+    parser.add_argument('--size', default=448, type=int)
+    parser.add_argument('--batch', default=32, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--samples', default=1000, type=int, help='The number of augmented copies to compare statistics on')
+    parser.add_argument('--seed', default=111, type=int)
+    return parser.parse_args()
+
+
+def synthetic_image(size, seed):
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:size, 0:size]
+    disc = ((x - size / 2.0) ** 2 + (y - size / 2.0) ** 2 < (size / 2.0) ** 2)
+    base = np.stack([disc * (150 + 60 * np.sin(x / 20.0)), disc * (70 + 30 * np.cos(y / 15.0)), disc * 30.0], -1)
+    return Image.fromarray(np.clip(base + rng.randint(0, 12, size=base.shape), 0, 255).astype(np.uint8))
+
+
+def statistics(batch):
+    grad = (batch[:, :, :, 1:] - batch[:, :, :, :-1]).abs().mean(3).mean(2).mean(1)
+    return batch.mean(3).mean(2).mean(0), batch.view(batch.size(0), 3, -1).std(2).mean(0), grad.mean().view(1)
+
+
+def main():
+    opt = parse_args()
+    torch.manual_seed(opt.seed)
+    np.random.seed(opt.seed)
+    image = Image.open(opt.image).convert('RGB').resize((opt.size, opt.size)) if opt.image else synthetic_image(opt.size, opt.seed)
+    mean, std = [0.45, 0.3, 0.2], [0.25, 0.18, 0.12]
+    eigval = torch.FloatTensor([0.2175, 0.0188, 0.0045])
+    eigvec = torch.FloatTensor([[-0.5675, 0.7192, 0.4009], [-0.5808, -0.0045, -0.8140], [-0.5836, -0.6948, 0.4203]])
+    per_sample = transforms.Compose([
+        transforms.RandomHorizontalFlip(),
+        PILColorJitter(),
+        transforms.ToTensor(),
+        Lighting(alphastd=0.1, eigval=eigval, eigvec=eigvec),
+        transforms.Normalize(mean=mean, std=std),
+    ])
+    augment = BatchAugment(mean, std, eigval, eigvec, alphastd=0.1)
+    to_byte = ToByteTensor()
+
+    start = time.time()
+    for _ in range(opt.repeat):
+        torch.stack([per_sample(image) for _ in range(opt.batch)])
+    pil = opt.repeat * opt.batch / (time.time() - start)
+    start = time.time()
+    for _ in range(opt.repeat):
+        augment.collate([(to_byte(image), 0) for _ in range(opt.batch)])
+    batched = opt.repeat * opt.batch / (time.time() - start)
+    print('per-sample PIL:\t{:.1f} images/sec'.format(pil))
+    print('batch augment:\t{:.1f} images/sec\tspeedup {:.2f}x'.format(batched, batched / pil))
+
+    small = image.resize((128, 128))
+    reference = statistics(torch.stack([per_sample(small) for _ in range(opt.samples)]))
+    result = statistics(augment(to_byte(small).unsqueeze(0).expand(opt.samples, 3, 128, 128).contiguous()))
+    for name, a, b in zip(['channel mean', 'channel std', 'gradient'], reference, result):
+        print('{}:\tPIL {}\tbatch {}'.format(name, np.round(a.numpy(), 3), np.round(b.numpy(), 3)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import sys
+sys.path.append('../')
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from PIL import Image
+
+from image_decode import decode_image, available_backends
+
+'''
+Decode time per image of every installed backend of image_decode, per file type of a sample directory, and
+the largest pixel difference to the PIL decode (0 for png, small for jpeg where the IDCTs differ):
+
+python decode_benchmark.py --root ../data/kaggle/train_images --num 200
+python decode_benchmark.py          # synthetic 512px png and 3000px jpeg images
+'''
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='decode ms/image per backend')
+    parser.add_argument('--root', default=None, help='A directory of images, synthetic images when not given')
+    parser.add_argument('--num', default=100, type=int, help='The number of images per file type')
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--seed', default=111, type=int)
+    return parser.parse_args()
+
+
+def synthetic_images(root, num, seed):
+    # fundus-like disc plus noise: 512px png like the pyramids, 3000px jpeg like the originals
+    rng = np.random.RandomState(seed)
+    for size, ext in [(512, '.png'), (3000, '.jpeg')]:
+        y, x = np.mgrid[0:size, 0:size]
+        disc = ((x - size / 2.0) ** 2 + (y - size / 2.0) ** 2 < (size / 2.0) ** 2)
+        base = np.stack([disc * (150 + 60 * np.sin(x / 20.0)), disc * (70 + 30 * np.cos(y / 15.0)), disc * 30.0], -1)
+        for i in range(num):
+            image = np.clip(base + rng.randint(0, 12, size=base.shape), 0, 255).astype(np.uint8)
+            Image.fromarray(image).save(os.path.join(root, '%d_%d%s' % (i, size, ext)), quality=95)
+
+
+def main():
+    opt = parse_args()
+    tmp = None
+    root = opt.root
+    if root is None:
+        tmp = tempfile.mkdtemp()
+        root = tmp
+        synthetic_images(root, min(opt.num, 10), opt.seed)
+    try:
+        groups = {}
+        for name in sorted(os.listdir(root)):
+            ext = os.path.splitext(name)[1].lower().replace('.jpg', '.jpeg')
+            if ext in ('.png', '.jpeg', '.tif', '.tiff', '.bmp') and len(groups.get(ext, [])) < opt.num:
+                groups.setdefault(ext, []).append(os.path.join(root, name))
+        backends = available_backends()
+        print('backends: {}'.format(', '.join(backends)))
+        for ext, paths in sorted(groups.items()):
+            # the file bytes are read up front, only the decode is timed
+            data = [open(path, 'rb').read() for path in paths]
+            reference = [decode_image(d, 'pil') for d in data]
+            for backend in backends:
+                start = time.time()
+                for _ in range(opt.repeat):
+                    for d in data:
+                        decode_image(d, backend)
+                ms = 1000.0 * (time.time() - start) / (opt.repeat * len(data))
+                diff = max(int(np.abs(decode_image(d, backend).astype(np.int16) - r).max()) for d, r in zip(data, reference))
+                print('{}\t{} images\t{:<10}\t{:.2f} ms/image\tmax diff to pil {}'.format(ext, len(data), backend, ms, diff))
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import sys
+sys.path.append('../')
+sys.path.append('../result_analysis')
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from experiment_index import SCHEMA, parse_log, index_runs, best_per_model
+
+'''
+Checks that result_analysis/experiment_index.py keeps the heads of a multi-task train.log apart: a
+train.log excerpt of paper_data/single_channel_multi_task_cls_concatenate_roc.py (the progress, Eval and
+referable summary lines eval_bin writes after every epoch) is parsed and indexed. It fails when the
+[DR/DME/MIX binary cls] rows collide, a metric name with digits is cut, or a summary line after an Eval
+block is not filed as val:
+
+python experiment_index_check.py
+'''
+
+TRAIN_LOG = '''Namespace(batch=32, crop=448, dataset='kaggle', epoch=2, exp='roc', model='rsn34', phase='train', size=512)
+
+Epoch: [0][0/100]\tTime 1.203 (1.203)\tData 0.512\t Loss 2.1034\tDR_Loss 1.5021\tDME_Loss 0.6013\tDR_Kappa 0.1021\tDR_Accuracy 0.5312\tDME_Kappa 0.0512\tDME_Accuracy 0.7188\t
+Epoch: [0][99/100]\tTime 0.402 (0.455)\tData 0.011\t Loss 1.2034\tDR_Loss 0.9021\tDME_Loss 0.3013\tDR_Kappa 0.4021\tDR_Accuracy 0.6312\tDME_Kappa 0.3512\tDME_Accuracy 0.8188\t
+Eval: [0/20]\tTime 0.301 (0.301)\tData 0.101\t Loss 1.1034\tDR_Loss 0.8021\tDME_Loss 0.3013\tTo_Treat_Loss 0.2512\tDR_Kappa 0.5021\tDR_Accuracy 0.6512\tDME_Kappa 0.4512\tDME_Accuracy 0.8288\tTo_Treat_Accuray 0.8512\t
+Eval: [19/20]\tTime 0.301 (0.305)\tData 0.001\t Loss 1.0034\tDR_Loss 0.7021\tDME_Loss 0.3013\tTo_Treat_Loss 0.2212\tDR_Kappa 0.5521\tDR_Accuracy 0.6612\tDME_Kappa 0.4812\tDME_Accuracy 0.8388\tTo_Treat_Accuray 0.8612\t
+
+binary cls accuracy: 0.8612\tsensitivity: 0.7512\t specificity: 0.9012\tf1 score: 0.7712
+
+[DR binary cls]: acc: 0.9000\tsensitivity: 0.8000\tspecificity: 0.9500\tf1 score: 0.8500
+
+[DME binary cls]: acc: 0.1000\tsensitivity: 0.2000\tspecificity: 0.3000\tf1 score: 0.4000
+
+[MIX binary cls]: acc: 0.5000\tsensitivity: 0.6000\tspecificity: 0.7000\tf1 score: 0.6500
+dr < 2 and dme >0 count is: 3
+pred dme 0 count is: 512
+label dme 0 count is: 498
+
+[DR bootstrap 95% CI, 1000 resamples]: kappa: 0.5521 (0.5012-0.6013)
+Epoch: [1][0/100]\tTime 0.402 (0.402)\tData 0.011\t Loss 0.9034\tDR_Loss 0.7021\tDME_Loss 0.2013\tDR_Kappa 0.6021\tDR_Accuracy 0.7312\tDME_Kappa 0.5512\tDME_Accuracy 0.8588\t
+'''
+
+EXPECTED = {
+    ('val', 0, 'dr', 'binary_cls_acc'): 0.9,
+    ('val', 0, 'dme', 'binary_cls_acc'): 0.1,
+    ('val', 0, 'mix', 'binary_cls_acc'): 0.5,
+    ('val', 0, 'dr', 'binary_cls_f1_score'): 0.85,
+    ('val', 0, 'dme', 'binary_cls_f1_score'): 0.4,
+    ('val', 0, 'mix', 'binary_cls_sensitivity'): 0.6,
+    ('val', 0, '', 'f1_score'): 0.7712,
+    ('val', 0, 'dr', 'bootstrap_ci_resamples_kappa'): 0.5521,
+    ('val', 0, 'dr', 'kappa'): 0.5521,
+    ('val', 0, 'to_treat', 'accuray'): 0.8612,
+    ('train', 0, 'dr', 'kappa'): 0.4021,
+    ('train', 1, 'dme', 'kappa'): 0.5512,
+}
+
+
+def main():
+    tmp = tempfile.mkdtemp()
+    try:
+        run_dir = os.path.join(tmp, 'kaggle_cls_train_20180101120000_rsn34_roc')
+        os.makedirs(run_dir)
+        with open(os.path.join(run_dir, 'train.log'), 'w') as fp:
+            fp.write(TRAIN_LOG)
+        options, values = parse_log(os.path.join(run_dir, 'train.log'), 'train')
+        failures = ['{}: expected {}, got {}'.format(key, value, values.get(key)) for key, value in sorted(EXPECTED.items())
+                    if values.get(key) is None or abs(values[key] - value) > 1e-6]
+        if options.get('model') != 'rsn34':
+            failures.append('options: {}'.format(options))
+        if any(metric in ('score', 'acc') for _, _, _, metric in values):
+            failures.append('metrics filed without their tag: {}'.format(sorted(k for k in values if k[3] in ('score', 'acc'))))
+
+        conn = sqlite3.connect(':memory:')
+        conn.executescript(SCHEMA)
+        index_runs(conn, [tmp])
+        rows = conn.execute("SELECT head, value FROM metrics WHERE phase = 'val' AND metric = 'binary_cls_acc' ORDER BY head").fetchall()
+        if rows != [('dme', 0.1), ('dr', 0.9), ('mix', 0.5)]:
+            failures.append('indexed binary_cls_acc rows: {}'.format(rows))
+        best = best_per_model(conn, 'dr_binary_cls_acc', 'val')
+        if [value for _, value, _, _ in best] != [0.9]:
+            failures.append('best dr_binary_cls_acc: {}'.format(best))
+        conn.close()
+
+        for failure in failures:
+            print(failure)
+        if failures:
+            raise Exception('experiment_index parsed the multi-head train.log wrongly')
+        print('====> {} metrics parsed, heads kept apart'.format(len(values)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import sys
+sys.path.append('../')
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from PIL import Image
+
+from image_decode import decode_image, load_square, available_backends
+
+'''
+Reduced-resolution JPEG decode of the full-size fundus originals: the ms/image of the full decode plus center
+crop and resize the inference datasets used before, against load_square() which decodes at the JPEG DCT scale
+1/2, 1/4 or 1/8 nearest the target first, and the pixel difference between the two outputs. Exits with an
+error when the mean difference passes --max_mean_diff. jpeg_draft_check.py is the per-image correctness check
+(short side at least the target, difference to the full decode):
+
+python jpeg_draft_benchmark.py --root ../data/zhizhen_new/NormalData --num 100 --size 512
+python jpeg_draft_benchmark.py          # synthetic 3000-5000px jpeg images
+'''
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='full vs reduced jpeg decode, ms/image and pixel difference')
+    parser.add_argument('--root', default=None, help='A directory of jpeg images, synthetic images when not given')
+    parser.add_argument('--num', default=20, type=int, help='The number of images')
+    parser.add_argument('--size', default=[512, 224], type=int, nargs='+', help='The output sizes')
+    parser.add_argument('--repeat', default=2, type=int)
+    parser.add_argument('--max_mean_diff', default=2.0, type=float, help='The bound on the mean absolute difference')
+    parser.add_argument('--seed', default=111, type=int)
+    return parser.parse_args()
+
+
+def synthetic_images(root, num, seed):
+    # fundus-like disc on a black border with vessels and noise, at the camera resolutions of the originals
+    rng = np.random.RandomState(seed)
+    for i in range(num):
+        w, h = [(3000, 2000), (3888, 2592), (4928, 3264)][i % 3]
+        y, x = np.mgrid[0:h, 0:w].astype(np.float32)
+        r = np.sqrt((x - w / 2.0) ** 2 + (y - h / 2.0) ** 2) / (h / 2.0)
+        disc = (r < 1) * (1 - 0.4 * r)
+        vessels = 1 - 0.3 * (np.abs(np.sin(x / 37.0 + 3 * np.sin(y / 150.0))) < 0.05)
+        base = np.stack([disc * vessels * 190, disc * vessels * 90, disc * 35], -1)
+        image = np.clip(base + rng.randint(0, 8, size=base.shape), 0, 255).astype(np.uint8)
+        Image.fromarray(image).save(os.path.join(root, '%d.jpeg' % i), quality=95)
+
+
+def full_square(data, size):
+    # the previous _scale_image: decode at full resolution, crop the centered square, then resize
+    image = Image.fromarray(decode_image(data, 'pil'))
+    w, h = image.size
+    t = min(w, h)
+    image = image.crop((w // 2 - t // 2, h // 2 - t // 2, w // 2 + t // 2, h // 2 + t // 2))
+    return image.resize((size, size), Image.LANCZOS if t > size else Image.BICUBIC)
+
+
+def timed(function, data, size, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        for d in data:
+            function(d, size)
+    return 1000.0 * (time.time() - start) / (repeat * len(data))
+
+
+def main():
+    opt = parse_args()
+    tmp = None
+    root = opt.root
+    if root is None:
+        tmp = tempfile.mkdtemp()
+        root = tmp
+        synthetic_images(root, min(opt.num, 6), opt.seed)
+    try:
+        paths = [os.path.join(root, name) for name in sorted(os.listdir(root))
+                 if name.lower().endswith(('.jpg', '.jpeg'))][:opt.num]
+        # the file bytes are read up front, only decode, crop and resize are timed
+        data = [open(path, 'rb').read() for path in paths]
+        print('backends: {}, {} images'.format(', '.join(available_backends()), len(data)))
+        failed = False
+        for backend in available_backends():
+            for size in opt.size:
+                reduced = lambda d, s: load_square(d, s, backend)
+                full_ms = timed(full_square, data, size, opt.repeat)
+                reduced_ms = timed(reduced, data, size, opt.repeat)
+                diffs = np.concatenate([np.abs(np.asarray(full_square(d, size), dtype=np.int16) -
+                                               np.asarray(reduced(d, size), dtype=np.int16)).ravel() for d in data])
+                mean = diffs.mean()
+                failed = failed or mean > opt.max_mean_diff
+                print('{:<10}\t{}px\tfull {:.1f} ms/image\treduced {:.1f} ms/image\tx{:.1f}\tdiff mean {:.2f} p99 {} max {}'.format(
+                    backend, size, full_ms, reduced_ms, full_ms / reduced_ms, mean, int(np.percentile(diffs, 99)), diffs.max()))
+        if failed:
+            raise Exception('Reduced decode differs from the full decode by more than {} on average'.format(opt.max_mean_diff))
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import sys
+sys.path.append('../')
+import io
+import argparse
+import numpy as np
+from PIL import Image
+
+from image_decode import decode_image, load_image, load_square, available_backends
+
+'''
+Correctness of the reduced-resolution JPEG decode (decode_image/load_image with min_size, load_square) the
+datasets and the web service rely on, per installed backend:
+  - the short side of the reduced decode is never below min_size (below the image's own short side, an image
+    smaller than min_size is decoded as it is);
+  - the reduced decode resized to min_size on the short side matches the full decode resized the same way
+    within --max_mean_diff mean and --max_p99_diff 99th percentile absolute difference;
+  - load_square of the bytes matches the full decode cropped and resized the same way.
+Image sizes cover each DCT scale boundary, odd sizes and portrait images. Exits with an error on a failure:
+
+python jpeg_draft_check.py
+python jpeg_draft_check.py --min_size 512 448 224 --max_mean_diff 2.0
+'''
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='reduced jpeg decode: short side and difference to the full decode')
+    parser.add_argument('--min_size', default=[512, 224], type=int, nargs='+', help='The min_size values to check')
+    parser.add_argument('--max_mean_diff', default=2.0, type=float, help='The bound on the mean absolute difference')
+    parser.add_argument('--max_p99_diff', default=24, type=int, help='The bound on the 99th percentile absolute difference')
+    parser.add_argument('--seed', default=111, type=int)
+    return parser.parse_args()
+
+
+def synthetic_jpeg(w, h, rng):
+    # fundus-like disc with vessels and noise, encoded as the camera originals are
+    y, x = np.mgrid[0:h, 0:w].astype(np.float32)
+    r = np.sqrt((x - w / 2.0) ** 2 + (y - h / 2.0) ** 2) / (min(w, h) / 2.0)
+    disc = (r < 1) * (1 - 0.4 * r)
+    vessels = 1 - 0.3 * (np.abs(np.sin(x / 37.0 + 3 * np.sin(y / 150.0))) < 0.05)
+    base = np.stack([disc * vessels * 190, disc * vessels * 90, disc * 35], -1)
+    image = np.clip(base + rng.randint(0, 8, size=base.shape), 0, 255).astype(np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(image).save(buf, 'JPEG', quality=95)
+    return buf.getvalue()
+
+
+def resize_short(image, size):
+    w, h = image.size
+    if w < h:
+        return image.resize((size, int(round(size * h / float(w)))), Image.LANCZOS)
+    return image.resize((int(round(size * w / float(h))), size), Image.LANCZOS)
+
+
+def difference(a, b):
+    diff = np.abs(np.asarray(a, dtype=np.int16) - np.asarray(b, dtype=np.int16))
+    return diff.mean(), int(np.percentile(diff, 99))
+
+
+def image_sizes(min_size):
+    # just above and below each scale boundary, odd and portrait sizes, and an image smaller than min_size
+    sizes = []
+    for factor in (2, 4, 8):
+        sizes += [(factor * min_size + 101, factor * min_size), (factor * min_size + 57, factor * min_size - 1)]
+    return sizes + [(3000, 2000), (2592, 3888), (min_size + 33, min_size - 17)]
+
+
+def main():
+    opt = parse_args()
+    rng = np.random.RandomState(opt.seed)
+    failures = []
+    for min_size in opt.min_size:
+        images = [(size, synthetic_jpeg(size[0], size[1], rng)) for size in image_sizes(min_size)]
+        for backend in available_backends():
+            for (w, h), data in images:
+                full = Image.fromarray(decode_image(data, backend))
+                reduced = load_image(data, backend, min_size=min_size)
+                short = min(reduced.size)
+                expected = min(min_size, w, h)
+                # both to the size of the resized full decode, the reduced one can be a pixel wider or taller
+                target = resize_short(full, expected)
+                mean, p99 = difference(reduced.resize(target.size, Image.LANCZOS), target)
+                square_mean, square_p99 = difference(load_square(data, min_size, backend), load_square(full, min_size))
+                ok = short >= expected and max(mean, square_mean) <= opt.max_mean_diff and \
+                    max(p99, square_p99) <= opt.max_p99_diff
+                print('{:<10}\tmin_size {}\t{}x{} -> {}x{}\tdiff mean {:.2f} p99 {}\tsquare diff mean {:.2f} p99 {}\t{}'.format(
+                    backend, min_size, w, h, reduced.size[0], reduced.size[1], mean, p99, square_mean, square_p99,
+                    'ok' if ok else 'FAILED'))
+                if not ok:
+                    failures.append((backend, min_size, w, h))
+    if failures:
+        raise Exception('Reduced decode check failed for {}'.format(
+            ', '.join('{} min_size {} {}x{}'.format(*failure) for failure in failures)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import sys
+sys.path.append('../')
+import time
+import argparse
+import numpy as np
+
+from utils import quadratic_weighted_kappa, quadratic_weighted_kappa_batch, kappa_confusion_matrix
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='quadratic weighted kappa micro-benchmark')
+    parser.add_argument('--num', default=100000, type=int, help='The number of ratings')
+    parser.add_argument('--members', default=16, type=int, help='The number of prediction vectors for the batched form')
+    parser.add_argument('--seed', default=111, type=int)
+    return parser.parse_args()
+
+
+# the pure-python implementation utils.py used before, kept here as the reference
+def loop_confusion_matrix(rater_a, rater_b, min_rating, max_rating):
+    num_ratings = int(max_rating - min_rating + 1)
+    conf_mat = [[0 for i in range(num_ratings)]
+                for j in range(num_ratings)]
+    for a, b in zip(rater_a, rater_b):
+        conf_mat[a - min_rating][b - min_rating] += 1
+    return conf_mat
+
+
+def loop_histogram(ratings, min_rating, max_rating):
+    num_ratings = int(max_rating - min_rating + 1)
+    hist_ratings = [0 for x in range(num_ratings)]
+    for r in ratings:
+        hist_ratings[r - min_rating] += 1
+    return hist_ratings
+
+
+def loop_quadratic_weighted_kappa(rater_a, rater_b, min_rating=0, max_rating=4):
+    rater_a = np.round(np.clip(rater_a, min_rating, max_rating)).astype(int).ravel()
+    rater_b = np.round(np.clip(rater_b, min_rating, max_rating)).astype(int).ravel()
+    conf_mat = loop_confusion_matrix(rater_a, rater_b, min_rating, max_rating)
+    num_ratings = len(conf_mat)
+    num_scored_items = float(len(rater_a))
+    hist_rater_a = loop_histogram(rater_a, min_rating, max_rating)
+    hist_rater_b = loop_histogram(rater_b, min_rating, max_rating)
+    numerator = 0.0
+    denominator = 0.0
+    for i in range(num_ratings):
+        for j in range(num_ratings):
+            expected_count = (hist_rater_a[i] * hist_rater_b[j] / num_scored_items)
+            d = pow(i - j, 2.0) / pow(num_ratings - 1, 2.0)
+            numerator += d * conf_mat[i][j] / num_scored_items
+            denominator += d * expected_count / num_scored_items
+    if denominator < 1e-11:
+        return -1.0
+    else:
+        return 1.0 - numerator / denominator
+
+
+def timeit(func, *args):
+    start = time.time()
+    res = func(*args)
+    return res, time.time() - start
+
+
+def main():
+    opt = parse_args()
+    rng = np.random.RandomState(opt.seed)
+    label = rng.choice(5, opt.num, p=[0.73, 0.07, 0.15, 0.025, 0.025])
+    # predictions that agree with the label most of the time, like a trained model
+    noise = rng.randint(-1, 2, size=(opt.members, opt.num)) * (rng.rand(opt.members, opt.num) < 0.3)
+    preds = np.clip(label[None, :] + noise, 0, 4)
+
+    conf_loop = loop_confusion_matrix(label, preds[0], 0, 4)
+    conf_np = kappa_confusion_matrix(label, preds[0], 0, 4)
+    assert np.array_equal(np.array(conf_loop), conf_np), 'confusion matrices differ'
+
+    kappa_loop, t_loop = timeit(loop_quadratic_weighted_kappa, label, preds[0])
+    kappa_np, t_np = timeit(quadratic_weighted_kappa, label, preds[0])
+    assert abs(kappa_loop - kappa_np) < 1e-12, 'kappa differs: {} vs {}'.format(kappa_loop, kappa_np)
+    print('single kappa on {} ratings:\tloop {:.4f}s\tnumpy {:.4f}s\tspeedup {:.1f}x\tkappa {:.6f}'.format(
+        opt.num, t_loop, t_np, t_loop / max(t_np, 1e-9), kappa_np))
+
+    start = time.time()
+    kappas_loop = [loop_quadratic_weighted_kappa(label, p) for p in preds]
+    t_loop = time.time() - start
+    kappas_np, t_np = timeit(quadratic_weighted_kappa_batch, label, preds)
+    assert np.allclose(kappas_loop, kappas_np, rtol=0, atol=1e-12), 'batched kappa differs'
+    print('batched kappa of {} members:\tloop {:.4f}s\tnumpy {:.4f}s\tspeedup {:.1f}x'.format(
+        opt.members, t_loop, t_np, t_loop / max(t_np, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
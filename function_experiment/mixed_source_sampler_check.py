@@ -0,0 +1,57 @@
+import sys
+sys.path.append('../')
+import numpy as np
+
+from data import MixedSourceSampler
+
+'''
+MixedSourceSampler on stand-in datasets (only names, sizes and offsets are read): the per-source shares of
+an epoch, repeated passes over a small source, and a clear error instead of a failure inside __iter__ for
+an empty source, a non-positive ratio and a positive ratio whose share rounds to zero images. Exits with
+an error otherwise:
+
+python mixed_source_sampler_check.py
+'''
+
+
+class Sources(object):
+    def __init__(self, sizes):
+        self.names = ['source%d' % i for i in range(len(sizes))]
+        self.sizes = sizes
+        self.offsets = np.cumsum([0] + sizes)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+
+def rejected(sizes, ratios):
+    try:
+        MixedSourceSampler(Sources(sizes), ratios)
+    except Exception as e:
+        print('rejected {} {}: {}'.format(sizes, ratios, e))
+        return True
+    return False
+
+
+def main():
+    failures = []
+    sampler = MixedSourceSampler(Sources([1000, 10]), [3, 1], num_samples=400, seed=111)
+    indices = np.array(list(sampler))
+    counts = [int((indices < 1000).sum()), int((indices >= 1000).sum())]
+    if counts != [300, 100] or len(indices) != len(sampler):
+        failures.append('shares {} instead of [300, 100]'.format(counts))
+    if np.bincount(indices[indices >= 1000] - 1000, minlength=10).min() != 10:
+        failures.append('the small source is not repeated pass by pass')
+    print(sampler.describe())
+    for sizes, ratios in [([1000, 0], [1, 1]), ([1000, 10], [1, 0]), ([1000, 10], [1, -1]),
+                          ([1000, 10], [1, float('nan')]), ([1000, 10], [10000, 1])]:
+        if not rejected(sizes, ratios):
+            failures.append('{} {} was accepted'.format(sizes, ratios))
+    for failure in failures:
+        print(failure)
+    if failures:
+        raise Exception('MixedSourceSampler check failed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import sys
+sys.path.append('../')
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import torch
+import torch.utils.data
+import torchvision.transforms as transforms
+from PIL import Image
+from torch.utils.data import DataLoader
+
+from packed_images import write_packed_images, PackedImages, PackedClsDataSet
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='png decode vs packed memmap crops, images/sec')
+    parser.add_argument('--root', default=None, help='A directory of <id>_<size>.png images, synthetic images when not given')
+    parser.add_argument('--list', default=None, help='The ids to read from --root, one per line')
+    parser.add_argument('--num', default=256, type=int, help='The number of (synthetic) images')
+    parser.add_argument('--size', default=512, type=int)
+    parser.add_argument('--crop', default=448, type=int)
+    parser.add_argument('--batch', default=32, type=int)
+    parser.add_argument('--workers', default=0, type=int)
+    parser.add_argument('--seed', default=111, type=int)
+    return parser.parse_args()
+
+
+class PngClsDataSet(torch.utils.data.Dataset):
+    '''the per-sample path of the existing datasets: open and decode the png, then crop'''
+    def __init__(self, root, ids, size, crop_size):
+        self.images = [os.path.join(root, i + '_' + str(size) + '.png') for i in ids]
+        self.transform = transforms.Compose([
+            transforms.RandomCrop(crop_size),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.25, 0.25, 0.25]),
+        ])
+
+    def __getitem__(self, index):
+        return self.transform(Image.open(self.images[index]).convert('RGB')), 0
+
+    def __len__(self):
+        return len(self.images)
+
+
+def synthetic_images(root, num, size, seed):
+    # smooth fundus-like disc plus noise, so png compression behaves like real images
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:size, 0:size]
+    disc = ((x - size / 2.0) ** 2 + (y - size / 2.0) ** 2 < (size / 2.0) ** 2)
+    ids = []
+    for i in range(num):
+        base = np.stack([disc * (150 + 60 * np.sin(x / (20.0 + i % 7))), disc * (70 + 30 * np.cos(y / 15.0)), disc * 30.0], -1)
+        image = np.clip(base + rng.randint(0, 12, size=base.shape), 0, 255).astype(np.uint8)
+        Image.fromarray(image).save(os.path.join(root, '%d_%d.png' % (i, size)))
+        ids.append(str(i))
+    return ids
+
+
+def images_per_second(dataset, batch, workers):
+    loader = DataLoader(dataset, batch_size=batch, shuffle=True, num_workers=workers)
+    start = time.time()
+    for image, _ in loader:
+        pass
+    return len(dataset) / (time.time() - start)
+
+
+def main():
+    opt = parse_args()
+    np.random.seed(opt.seed)
+    tmp = tempfile.mkdtemp()
+    try:
+        if opt.root:
+            root = opt.root
+            ids = [line.strip() for line in open(opt.list, 'r') if line.strip()][:opt.num]
+        else:
+            root = tmp
+            ids = synthetic_images(tmp, opt.num, opt.size, opt.seed)
+        start = time.time()
+        packed_root = os.path.join(tmp, 'packed')
+        write_packed_images(packed_root, ids, lambda i: Image.open(os.path.join(root, i + '_' + str(opt.size) + '.png')), opt.size)
+        print('packed {} images in {:.2f}s'.format(len(ids), time.time() - start))
+
+        packed = PackedImages(packed_root)
+        for i in ids[:8]:
+            assert np.array_equal(packed[i], np.asarray(Image.open(os.path.join(root, i + '_' + str(opt.size) + '.png')).convert('RGB'))), 'packed image differs'
+
+        png = images_per_second(PngClsDataSet(root, ids, opt.size, opt.crop), opt.batch, opt.workers)
+        mem = images_per_second(PackedClsDataSet(packed, ids, np.zeros(len(ids)), opt.crop, train=True,
+                                                 mean=[0.5, 0.5, 0.5], std=[0.25, 0.25, 0.25]), opt.batch, opt.workers)
+        print('png decode + crop:\t{:.1f} images/sec'.format(png))
+        print('packed memmap crop:\t{:.1f} images/sec\tspeedup {:.1f}x'.format(mem, mem / png))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
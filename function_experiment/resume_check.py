@@ -0,0 +1,89 @@
+import sys
+sys.path.append('../')
+sys.path.append('../paper_data')
+import os
+import shutil
+import tempfile
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from utils import ResumableSampler
+from single_channel_multi_task_cls_concatenate_roc import save_resume, load_resume
+
+'''
+Resume round trip of paper_data/single_channel_multi_task_cls_concatenate_roc.py on the device at hand (cuda
+when available, else cpu): a run saved with save_resume after a few SGD steps and restored with load_resume
+into a fresh model built on the cpu, as main() builds it, must keep its momentum buffers on the device of
+the params and continue exactly like the uninterrupted run. Exits with an error otherwise:
+
+python resume_check.py
+'''
+
+
+def build(seed):
+    torch.manual_seed(seed)
+    return nn.Sequential(nn.Linear(8, 16), nn.ReLU(), nn.Linear(16, 3))
+
+
+def sgd(model):
+    return optim.SGD(model.parameters(), lr=0.1, momentum=0.9, weight_decay=1e-4, nesterov=True)
+
+
+def step(model, optimizer, data, device):
+    image, label = data
+    optimizer.zero_grad()
+    loss = nn.functional.cross_entropy(model(image.to(device)), label.to(device))
+    loss.backward()
+    optimizer.step()
+
+
+def main():
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch.manual_seed(111)
+    batches = [(torch.randn(4, 8), torch.randint(0, 3, (4,))) for _ in range(6)]
+
+    reference = build(0).to(device)
+    optimizer = sgd(reference)
+    for data in batches:
+        step(reference, optimizer, data, device)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'resume.pth')
+        model = build(0).to(device)
+        optimizer = sgd(model)
+        sampler = ResumableSampler(64, seed=111)
+        for data in batches[:3]:
+            step(model, optimizer, data, device)
+        sampler.advance(3 * 4)
+        save_resume(path, 0, model, optimizer, sampler, [0.5, 0.4, 0.9])
+
+        restored = build(1)
+        restored_sampler = ResumableSampler(64, seed=0)
+        resume = load_resume(path, restored, restored_sampler, device=device)
+        optimizer = sgd(restored)
+        optimizer.load_state_dict(resume['optimizer'])
+        failures = []
+        for param in restored.parameters():
+            buffer = optimizer.state[param]['momentum_buffer']
+            if buffer.device != param.device:
+                failures.append('momentum buffer on {}, param on {}'.format(buffer.device, param.device))
+        if restored_sampler.position != sampler.position:
+            failures.append('sampler position {} instead of {}'.format(restored_sampler.position, sampler.position))
+        for data in batches[3:]:
+            step(restored, optimizer, data, device)
+        diff = max((a - b).abs().max().item() for a, b in zip(reference.parameters(), restored.parameters()))
+        if diff > 1e-6:
+            failures.append('resumed weights differ from the uninterrupted run by {}'.format(diff))
+        print('====> {}: resume round trip, max weight difference {:.2e}'.format(device, diff))
+        for failure in failures:
+            print(failure)
+        if failures:
+            raise Exception('Resume round trip failed on {}'.format(device))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Decoded-image cache shared by the DataLoader workers.
+
+The decoded uint8 pixels live in fixed-size slots of a file-backed mmap (in /dev/shm when it exists),
+so every worker forked from the process that built the cache reads and fills the same slots, and the
+slots survive from one epoch to the next. Slots are recycled with the clock (second chance) policy once
+the byte budget is used up; hits, misses and evictions are counted in the shared header:
+
+	cache = SharedImageCache(len(dataset), budget=4 << 30, slot_shape=(512, 512, 3))
+	image = cache.load(index, path)		# RGB PIL image, decoded at most once while it stays cached
+	print(cache.stats())
+"""
+import os, atexit, tempfile
+import multiprocessing
+import numpy as np
+from PIL import Image
+from image_decode import decode_image, load_image
+
+# header of the meta file: clock hand, hits, misses, evictions
+HAND, HITS, MISSES, EVICTIONS = range(4)
+NUM_HEADER = 4
+
+
+class SharedImageCache(object):
+	"""Caches decoded images by integer key (the dataset index), budget is in bytes"""
+
+	def __init__(self, num_keys, budget, slot_shape, root=None):
+		self.num_keys = num_keys
+		self.slot_shape = tuple(slot_shape)
+		self.slot_bytes = int(np.prod(self.slot_shape))
+		self.num_slots = int(min(budget // self.slot_bytes, num_keys))
+		if self.num_slots < 1:
+			raise Exception('A budget of {} bytes does not hold one {} image'.format(budget, self.slot_shape))
+		if root is None:
+			root = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+		fd, self.data_path = tempfile.mkstemp(prefix='image_cache_', suffix='.u8', dir=root)
+		os.close(fd)
+		fd, self.meta_path = tempfile.mkstemp(prefix='image_cache_', suffix='.i8', dir=root)
+		os.close(fd)
+		self.owner = os.getpid()
+		self.lock = multiprocessing.Lock()
+		self._open('w+')
+		self.header[:] = 0
+		self.slot_key[:] = -1
+		self.slot_ref[:] = 0
+		self.key_slot[:] = -1
+		atexit.register(self.close)
+
+	def _open(self, mode):
+		self.data = np.memmap(self.data_path, dtype=np.uint8, mode=mode, shape=(self.num_slots, self.slot_bytes))
+		meta = np.memmap(self.meta_path, dtype=np.int64, mode=mode,
+		                 shape=(NUM_HEADER + self.num_slots * 5 + self.num_keys,))
+		self.meta = meta
+		self.header = meta[:NUM_HEADER]
+		start = NUM_HEADER
+		self.slot_key = meta[start:start + self.num_slots]
+		self.slot_ref = meta[start + self.num_slots:start + 2 * self.num_slots]
+		self.slot_shape_of = meta[start + 2 * self.num_slots:start + 5 * self.num_slots].reshape(self.num_slots, 3)
+		self.key_slot = meta[start + 5 * self.num_slots:]
+
+	def __getstate__(self):
+		# forked workers inherit the shared maps, spawned ones map the files again
+		state = self.__dict__.copy()
+		for name in ['data', 'meta', 'header', 'slot_key', 'slot_ref', 'slot_shape_of', 'key_slot']:
+			state[name] = None
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._open('r+')
+
+	def get(self, key):
+		"""The cached pixels of key as a fresh array, None on a miss"""
+		with self.lock:
+			slot = self.key_slot[key]
+			if slot < 0:
+				self.header[MISSES] += 1
+				return None
+			self.header[HITS] += 1
+			self.slot_ref[slot] = 1
+			shape = tuple(self.slot_shape_of[slot])
+			return self.data[slot, :int(np.prod(shape))].reshape(shape).copy()
+
+	def put(self, key, pixels):
+		"""Stores an (h, w) or (h, w, c) uint8 array that fits the slot, evicting with the clock hand"""
+		pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+		if pixels.size > self.slot_bytes:
+			return False
+		shape = (pixels.shape + (1,) * 3)[:3]
+		with self.lock:
+			if self.key_slot[key] >= 0:
+				return True
+			hand = self.header[HAND]
+			while self.slot_ref[hand]:
+				self.slot_ref[hand] = 0
+				hand = (hand + 1) % self.num_slots
+			old = self.slot_key[hand]
+			if old >= 0:
+				self.key_slot[old] = -1
+				self.header[EVICTIONS] += 1
+			self.data[hand, :pixels.size] = pixels.ravel()
+			self.slot_shape_of[hand] = shape
+			self.slot_key[hand] = key
+			self.slot_ref[hand] = 1
+			self.key_slot[key] = hand
+			self.header[HAND] = (hand + 1) % self.num_slots
+		return True
+
+	def load(self, key, path):
+		"""load_image(path) through the cache"""
+		pixels = self.get(key)
+		if pixels is None:
+			pixels = decode_image(path)
+			self.put(key, pixels)
+		return Image.fromarray(pixels)
+
+	def stats(self):
+		hits, misses = int(self.header[HITS]), int(self.header[MISSES])
+		return {'hits': hits, 'misses': misses, 'evictions': int(self.header[EVICTIONS]),
+		        'hit_rate': hits / float(max(hits + misses, 1)), 'cached': int((self.slot_key >= 0).sum()),
+		        'slots': self.num_slots}
+
+	def close(self):
+		if os.getpid() != self.owner:
+			return
+		for path in [self.data_path, self.meta_path]:
+			if os.path.exists(path):
+				os.remove(path)
+
+
+def open_image(path, cache=None, key=None):
+	"""load_image, or the cached decode of dataset index key when a cache is given"""
+	if cache is None:
+		return load_image(path)
+	return cache.load(key, path)
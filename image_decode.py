@@ -0,0 +1,135 @@
+"""One image decode for the datasets, the preprocessing scripts and the web service.
+
+decode_image() returns an (H, W, 3) RGB uint8 array whatever the backend, gray, palette and alpha images
+included; load_image() wraps it as a PIL image for the torchvision transforms. With min_size a JPEG is decoded
+at the largest DCT reduction (1/2, 1/4 or 1/8) whose short side stays at least min_size, which skips most of
+the work for 3000-5000px camera originals; load_square() is the fundus preprocessing on top of it. Backends:
+
+	pil		PIL.Image, always available
+	cv2		OpenCV imread/imdecode, converted from BGR, EXIF orientation ignored like PIL does
+	turbojpeg	PyTurboJPEG (libjpeg-turbo) for JPEG files, the other formats fall back to cv2 or pil
+	auto		turbojpeg for JPEG when installed, else cv2 when installed, else pil
+
+The default is auto, DR_DECODE=<backend> in the environment or set_backend() change it for the process.
+"""
+import os
+import io
+import numpy as np
+from PIL import Image
+
+try:
+	import cv2
+except ImportError:
+	cv2 = None
+
+try:
+	from turbojpeg import TurboJPEG, TJPF_RGB
+	_turbojpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+	_turbojpeg = None
+
+BACKENDS = ['pil', 'cv2', 'turbojpeg']
+_backend = os.environ.get('DR_DECODE', 'auto')
+
+
+def available_backends():
+	return [name for name, ok in zip(BACKENDS, [True, cv2 is not None, _turbojpeg is not None]) if ok]
+
+
+def set_backend(name):
+	global _backend
+	if name != 'auto' and name not in available_backends():
+		raise Exception('Decode backend {} is not available, installed: {}'.format(name, available_backends()))
+	_backend = name
+
+
+def _read(source):
+	if isinstance(source, (bytes, bytearray)):
+		return bytes(source)
+	if hasattr(source, 'read'):
+		return source.read()
+	with open(source, 'rb') as fp:
+		return fp.read()
+
+
+def _is_jpeg(data):
+	return data[:3] == b'\xff\xd8\xff'
+
+
+def _reduction(data, min_size):
+	"""the largest JPEG DCT scale 1/factor that keeps the short side at least min_size"""
+	if min_size is None or not _is_jpeg(data):
+		return 1
+	short = min(Image.open(io.BytesIO(data)).size)
+	for factor in (8, 4, 2):
+		if -(-short // factor) >= min_size:
+			return factor
+	return 1
+
+
+def _decode_pil(data, min_size=None):
+	image = Image.open(io.BytesIO(data))
+	if min_size is not None and image.format == 'JPEG':
+		image.draft('RGB', (min_size, min_size))
+	if image.mode != 'RGB':
+		image = image.convert('RGB')
+	return np.asarray(image)
+
+
+def _decode_cv2(data, min_size=None):
+	flags = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+	         8: cv2.IMREAD_REDUCED_COLOR_8}[_reduction(data, min_size)]
+	image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags | cv2.IMREAD_IGNORE_ORIENTATION)
+	if image is None:
+		return _decode_pil(data, min_size)
+	return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def _decode_turbojpeg(data, min_size=None):
+	if not _is_jpeg(data):
+		return _decode_cv2(data) if cv2 is not None else _decode_pil(data)
+	return _turbojpeg.decode(data, pixel_format=TJPF_RGB, scaling_factor=(1, _reduction(data, min_size)))
+
+
+def _resolve(backend, data):
+	backend = backend or _backend
+	if backend == 'auto':
+		if _turbojpeg is not None and _is_jpeg(data):
+			return 'turbojpeg'
+		return 'cv2' if cv2 is not None else 'pil'
+	return backend
+
+
+def decode_image(source, backend=None, min_size=None):
+	"""(H, W, 3) RGB uint8 array of a path, a file object or encoded bytes, JPEGs reduced towards min_size"""
+	data = _read(source)
+	backend = _resolve(backend, data)
+	if backend == 'pil':
+		return _decode_pil(data, min_size)
+	if backend == 'cv2':
+		return _decode_cv2(data, min_size)
+	if backend == 'turbojpeg':
+		return _decode_turbojpeg(data, min_size)
+	raise Exception('Unknown decode backend: {}'.format(backend))
+
+
+def load_image(source, backend=None, min_size=None):
+	"""decode_image as an RGB PIL image"""
+	return Image.fromarray(decode_image(source, backend, min_size))
+
+
+def load_square(source, size, backend=None):
+	"""
+	The centered square crop of an image resized to size x size, as data_preprocessing_scale.py writes the
+	<id>_<size>.png images; the JPEG is decoded near size first, the final resize is the only full quality one.
+	A PIL image is cropped and resized as it is.
+	"""
+	image = source if isinstance(source, Image.Image) else load_image(source, backend, min_size=size)
+	w, h = image.size
+	t = min(w, h)
+	image = image.crop((w // 2 - t // 2, h // 2 - t // 2, w // 2 + t // 2, h // 2 + t // 2))
+	if image.size[0] > size:
+		image = image.resize((size, size), Image.LANCZOS)
+	elif image.size[0] < size:
+		image = image.resize((size, size), Image.BICUBIC)
+	return image
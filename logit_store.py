@@ -0,0 +1,230 @@
+"""Persisted evaluation outputs: raw logits and labels of every head plus the image ids.
+
+The store is a directory of fixed-size chunks (chunk_size rows, the last one shorter), one .npy per head
+and field (chunk_00000_dr_logits.npy, chunk_00000_dr_labels.npy, ...), an ids.npy and an index.json,
+so it can be memory-mapped and read back without torch:
+
+	python logit_store.py output/.../logits --head dr
+	python logit_store.py output/.../logits --head bin --positive 1 --sensitivity 0.95 --bootstrap 1000
+	python logit_store.py output/.../logits --head reg --cuts
+"""
+import os, json, argparse
+import numpy as np
+from metrics import ConfusionMeter, threshold_sweep, threshold_for_sensitivity, \
+	bootstrap_metrics, apply_cut_points, cross_fit_cut_points
+
+
+class LogitWriter(object):
+	"""Collects per-batch logits and labels of named heads and writes them out every chunk_size rows"""
+
+	def __init__(self, root, chunk_size=8192):
+		self.root = root
+		self.chunk_size = chunk_size
+		self.heads = {}
+		self.chunks = []
+		self.count = 0
+		self.pending = {}
+		self.num_pending = 0
+		if not os.path.exists(root):
+			os.makedirs(root)
+
+	def update(self, logits, labels):
+		"""logits: {head: (batch, classes) array}, labels: {head: (batch,) array}"""
+		num = None
+		for head, logit in logits.items():
+			logit = np.asarray(logit, dtype=np.float32)
+			logit = logit.reshape(len(logit), -1)
+			label = np.asarray(labels[head], dtype=np.int64).reshape(-1)
+			assert (len(label) == len(logit))
+			assert (num is None or num == len(label))
+			num = len(label)
+			self.heads.setdefault(head, logit.shape[1])
+			self.pending.setdefault(head, ([], []))
+			self.pending[head][0].append(logit)
+			self.pending[head][1].append(label)
+		self.num_pending += num or 0
+		while self.num_pending >= self.chunk_size:
+			self.flush(self.chunk_size)
+
+	def flush(self, rows=None):
+		"""Writes the first rows pending rows (all of them by default) as the next chunk"""
+		if self.num_pending == 0:
+			return
+		rows = self.num_pending if rows is None else rows
+		name = 'chunk_%05d' % len(self.chunks)
+		rest = {}
+		for head, (logits, labels) in self.pending.items():
+			logits, labels = np.concatenate(logits), np.concatenate(labels)
+			np.save(os.path.join(self.root, name + '_' + head + '_logits.npy'), logits[:rows])
+			np.save(os.path.join(self.root, name + '_' + head + '_labels.npy'), labels[:rows])
+			if rows < len(labels):
+				rest[head] = ([logits[rows:]], [labels[rows:]])
+		self.chunks.append({'name': name, 'count': rows})
+		self.count += rows
+		self.pending = rest
+		self.num_pending -= rows
+
+	def close(self, ids=None):
+		"""Writes the last chunk, the image ids in evaluation order and the index"""
+		self.flush()
+		if ids is not None:
+			assert (len(ids) == self.count)
+			np.save(os.path.join(self.root, 'ids.npy'), np.array([str(i) for i in ids]))
+		with open(os.path.join(self.root, 'index.json'), 'w') as fp:
+			json.dump({'count': self.count, 'heads': self.heads, 'chunks': self.chunks, 'ids': ids is not None}, fp, indent=4)
+
+
+class ChunkedArray(object):
+	"""
+	The memory-mapped chunks of one head and field seen as one array along the first axis. Indexing
+	with an int, a slice, an index or a boolean array only reads the rows it selects from the chunks
+	holding them; np.asarray() reads everything.
+	"""
+
+	def __init__(self, parts, dtype, shape):
+		self.parts = parts
+		self.offsets = np.cumsum([0] + [len(part) for part in parts])
+		self.dtype = np.dtype(dtype)
+		self.shape = (int(self.offsets[-1]),) + tuple(shape)
+
+	def __len__(self):
+		return self.shape[0]
+
+	def chunks(self):
+		return iter(self.parts)
+
+	def __getitem__(self, item):
+		rows, rest = (item[0], item[1:]) if isinstance(item, tuple) else (item, ())
+		if isinstance(rows, (int, np.integer)):
+			row = rows + len(self) if rows < 0 else rows
+			if not 0 <= row < len(self):
+				raise IndexError('index {} is out of bounds for {} rows'.format(rows, len(self)))
+			chunk = np.searchsorted(self.offsets, row, side='right') - 1
+			return self.parts[chunk][(row - self.offsets[chunk],) + rest]
+		if isinstance(rows, slice):
+			rows = np.arange(len(self))[rows]
+		rows = np.asarray(rows)
+		if rows.dtype == bool:
+			rows = np.nonzero(rows)[0]
+		rows = np.where(rows < 0, rows + len(self), rows)
+		chunk = np.searchsorted(self.offsets, rows, side='right') - 1
+		out = np.empty((len(rows),) + self.shape[1:], dtype=self.dtype)
+		for c in np.unique(chunk):
+			selected = chunk == c
+			out[selected] = self.parts[c][rows[selected] - self.offsets[c]]
+		return out[(slice(None),) + rest] if rest else out
+
+	def __array__(self, dtype=None, copy=None):
+		out = np.concatenate(self.parts) if self.parts else np.empty(self.shape, dtype=self.dtype)
+		return out if dtype is None else out.astype(dtype)
+
+
+class LogitStore(object):
+	"""Read side of LogitWriter, chunks are memory-mapped and only read where they are indexed"""
+
+	def __init__(self, root):
+		self.root = root
+		with open(os.path.join(root, 'index.json'), 'r') as fp:
+			self.index = json.load(fp)
+		self.heads = self.index['heads']
+		self.count = self.index['count']
+
+	def _load(self, head, field):
+		if head not in self.heads:
+			raise KeyError('No head {} in {}, found {}'.format(head, self.root, ', '.join(sorted(self.heads))))
+		parts = [np.load(os.path.join(self.root, chunk['name'] + '_' + head + '_' + field + '.npy'), mmap_mode='r')
+		         for chunk in self.index['chunks']]
+		if field == 'logits':
+			return ChunkedArray(parts, np.float32, (self.heads[head],))
+		return ChunkedArray(parts, np.int64, ())
+
+	def logits(self, head):
+		return self._load(head, 'logits')
+
+	def labels(self, head):
+		return self._load(head, 'labels')
+
+	def ids(self):
+		if not self.index['ids']:
+			return None
+		return np.load(os.path.join(self.root, 'ids.npy'))
+
+	def probs(self, head):
+		"""softmax of the logits, computed chunk by chunk"""
+		probs = []
+		for logits in self.logits(head).chunks():
+			logits = np.asarray(logits, dtype=np.float64)
+			exp = np.exp(logits - logits.max(1, keepdims=True))
+			probs.append(exp / exp.sum(1, keepdims=True))
+		return np.concatenate(probs) if probs else np.empty((0, self.heads[head]))
+
+	def preds(self, head):
+		preds = [np.asarray(logits).argmax(1) for logits in self.logits(head).chunks()]
+		return np.concatenate(preds) if preds else np.empty(0, dtype=np.int64)
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='Recompute metrics from a persisted logit store')
+	parser.add_argument('store', help='The logits directory written by an eval/test phase')
+	parser.add_argument('--head', default=None, help='The head to analyse, all heads by default')
+	parser.add_argument('--positive', default=None, type=int, help='Score P(label >= positive) as a binary task: auc and operating points')
+	parser.add_argument('--sensitivity', default=None, type=float, help='Report the threshold reaching this sensitivity')
+	parser.add_argument('--bootstrap', default=0, type=int, help='The number of bootstrap resamples for confidence intervals')
+	parser.add_argument('--cuts', action='store_true', help='Fit kappa-optimal cut points for a 1-wide regression head, graded cross-fitted')
+	return parser.parse_args()
+
+
+def report_head(store, head, opt):
+	# one label per image, the metrics below need them all
+	label = np.asarray(store.labels(head))
+	print('===> Head {}: {} images, {} outputs'.format(head, len(label), store.heads[head]))
+	if store.heads[head] == 1:
+		score = store.logits(head)[:, 0]
+		cut_points = np.arange(max(label.max(), 1)) + 0.5
+		num_classes = len(cut_points) + 1
+		if opt.cuts:
+			# fitted on this store, so the levels graded come from the cut points of the other folds
+			cut_points, pred, _ = cross_fit_cut_points(score, label, num_classes=num_classes)
+			print('cut points: ' + ', '.join('%.4f' % c for c in cut_points) + ' (kappa below cross-fitted over 5 folds)')
+		else:
+			print('cut points: ' + ', '.join('%.4f' % c for c in cut_points))
+			pred = apply_cut_points(score, cut_points)
+	else:
+		pred = store.preds(head)
+		num_classes = store.heads[head]
+	confusion = ConfusionMeter(num_classes)
+	confusion.update(label, pred)
+	print('kappa: {:.4f}\taccuracy: {:.4f}'.format(confusion.kappa(), confusion.accuracy()))
+	print('confusion matrix (rows: label, cols: prediction):')
+	print(confusion.conf_mat)
+	if opt.bootstrap > 0:
+		res = bootstrap_metrics(label, pred, num_classes=num_classes, num_boot=opt.bootstrap)
+		print('kappa 95% CI: {1:.4f}-{2:.4f}'.format(*res['kappa']))
+
+	if opt.positive is not None and store.heads[head] > 1:
+		binary = (label >= opt.positive).astype(int)
+		prob = store.probs(head)[:, opt.positive:].sum(1)
+		sweep = threshold_sweep(binary, prob)
+		tpr, fpr = np.r_[0, sweep['sensitivity']], np.r_[0, 1 - sweep['specificity']]
+		auc = (np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2).sum()
+		best = sweep['f1'].argmax()
+		print('[label >= {}] auc: {:.4f}\tbest f1: {:.4f} at threshold {:.6f} (sensitivity {:.4f}, specificity {:.4f})'.format(
+			opt.positive, auc, sweep['f1'][best], sweep['threshold'][best], sweep['sensitivity'][best], sweep['specificity'][best]))
+		if opt.sensitivity is not None:
+			threshold, point = threshold_for_sensitivity(binary, prob, opt.sensitivity)
+			print('threshold for sensitivity {}: {:.6f}\tsensitivity: {:.4f}\tspecificity: {:.4f}\tppv: {:.4f}\tf1: {:.4f}'.format(
+				opt.sensitivity, threshold, point['sensitivity'], point['specificity'], point['ppv'], point['f1']))
+		if opt.bootstrap > 0:
+			res = bootstrap_metrics(binary, (prob >= 0.5).astype(int), prob, num_classes=2, num_boot=opt.bootstrap)
+			print('95% CI: ' + '\t'.join('{0}: {1:.4f} ({2:.4f}-{3:.4f})'.format(metric, *res[metric]) for metric in sorted(res)))
+
+
+def main():
+	opt = parse_args()
+	store = LogitStore(opt.store)
+	for head in ([opt.head] if opt.head else sorted(store.heads)):
+		report_head(store, head, opt)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,151 @@
+"""Index of the image files under a set of roots.
+
+Every file gets one sqlite row with its path, directory, size, mtime, image dimensions and md5 content hash.
+refresh() walks a root and only reads the files whose size or mtime changed, and drops the rows of deleted
+files, so keeping the index up to date costs one stat per file. Lookups go through in-memory dicts and sets
+built from the table, O(1) per image instead of a glob plus a list scan:
+
+	manifest = ImageManifest('data/zhizhen/manifest.db')
+	manifest.refresh('data/zhizhen/512')
+	names = manifest.names('data/zhizhen/512')		# frozenset of file names
+	if path in manifest: width, height = manifest.dimensions(path)
+	paths = manifest.files('kaggle/train/3', '.jpeg')	# sorted paths of one directory
+
+A long-running process passes max_age to refresh() on every use, so new files are picked up at most max_age
+seconds after they appear without walking the root on every call.
+"""
+import os
+import time
+import hashlib
+import sqlite3
+from PIL import Image
+
+IMAGE_SUFFIXES = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, root TEXT, dir TEXT, name TEXT, size INTEGER, mtime REAL,
+                                  width INTEGER, height INTEGER, hash TEXT);
+CREATE INDEX IF NOT EXISTS files_root ON files (root);
+CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+'''
+
+
+def file_hash(path, block=1 << 20):
+	md5 = hashlib.md5()
+	with open(path, 'rb') as fp:
+		for chunk in iter(lambda: fp.read(block), b''):
+			md5.update(chunk)
+	return md5.hexdigest()
+
+
+def image_dimensions(path):
+	"""(width, height) from the image header, (None, None) when PIL cannot read it"""
+	try:
+		with Image.open(path) as image:
+			return image.size
+	except (IOError, OSError, SyntaxError):
+		return None, None
+
+
+class ImageManifest(object):
+	"""The sqlite index at db_path and the lookup tables built from it"""
+
+	def __init__(self, db_path):
+		self.db_path = db_path
+		self.db = sqlite3.connect(db_path, check_same_thread=False)
+		self.db.executescript(SCHEMA)
+		self._rows = None
+		self._dirs = {}
+		self._refreshed = {}
+
+	def refresh(self, root, suffixes=IMAGE_SUFFIXES, hash=True, max_age=None):
+		"""
+		Indexes the images under root, returns the number of (added, updated, removed) files; with max_age,
+		a root refreshed by this object less than max_age seconds ago is left as it is
+		"""
+		root = os.path.abspath(root)
+		now = time.time()
+		if max_age is not None and now - self._refreshed.get(root, -float('inf')) < max_age:
+			return 0, 0, 0
+		self._refreshed[root] = now
+		known = dict((path, (size, mtime)) for path, size, mtime in
+		             self.db.execute('SELECT path, size, mtime FROM files WHERE root = ?', (root,)))
+		seen = set()
+		rows = []
+		added = 0
+		for directory, _, names in os.walk(root):
+			for name in names:
+				if not name.lower().endswith(suffixes):
+					continue
+				path = os.path.join(directory, name)
+				stat = os.stat(path)
+				seen.add(path)
+				if known.get(path) == (stat.st_size, stat.st_mtime):
+					continue
+				added += path not in known
+				width, height = image_dimensions(path)
+				rows.append((path, root, directory, name, stat.st_size, stat.st_mtime, width, height,
+				             file_hash(path) if hash else None))
+		removed = [(path,) for path in known if path not in seen]
+		with self.db:
+			self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+			self.db.executemany('DELETE FROM files WHERE path = ?', removed)
+		if rows or removed:
+			self._rows = None
+			self._dirs = {}
+		return added, len(rows) - added, len(removed)
+
+	def _table(self):
+		if self._rows is None:
+			self._rows = dict((path, (size, width, height, digest)) for path, size, width, height, digest in
+			                  self.db.execute('SELECT path, size, width, height, hash FROM files'))
+		return self._rows
+
+	def _directory(self, directory):
+		directory = os.path.abspath(directory)
+		if directory not in self._dirs:
+			paths = [path for path, in self.db.execute('SELECT path FROM files WHERE dir = ? ORDER BY path', (directory,))]
+			self._dirs[directory] = (paths, frozenset(os.path.basename(path) for path in paths))
+		return self._dirs[directory]
+
+	def __contains__(self, path):
+		return os.path.abspath(path) in self._table()
+
+	def __len__(self):
+		return len(self._table())
+
+	def dimensions(self, path):
+		"""(width, height) of an indexed image, None when it is not indexed"""
+		row = self._table().get(os.path.abspath(path))
+		return None if row is None else (row[1], row[2])
+
+	def content_hash(self, path):
+		row = self._table().get(os.path.abspath(path))
+		return None if row is None else row[3]
+
+	def files(self, directory, suffix=None):
+		"""The indexed paths directly in directory, sorted, optionally only those ending with suffix"""
+		paths = self._directory(directory)[0]
+		if suffix is None:
+			return paths
+		return [path for path in paths if path.endswith(suffix)]
+
+	def names(self, directory):
+		"""The file names directly in directory, as a set"""
+		return self._directory(directory)[1]
+
+	def duplicates(self, root=None):
+		"""Lists of the paths that share their content hash, under one root or all of them"""
+		query = 'SELECT hash, path FROM files WHERE hash IN (SELECT hash FROM files {0} GROUP BY hash HAVING COUNT(*) > 1) {1} ORDER BY hash, path'
+		if root is None:
+			cursor = self.db.execute(query.format('WHERE hash IS NOT NULL', ''))
+		else:
+			root = os.path.abspath(root)
+			cursor = self.db.execute(query.format('WHERE hash IS NOT NULL AND root = ?', 'AND root = ?'), (root, root))
+		groups = {}
+		for digest, path in cursor:
+			groups.setdefault(digest, []).append(path)
+		return list(groups.values())
+
+	def close(self):
+		self.db.close()
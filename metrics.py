@@ -0,0 +1,619 @@
+"""Evaluation metrics on numpy arrays, kept free of torch so result files can be analysed anywhere.
+utils re-exports everything here."""
+import os, json, pickle
+import numpy as np
+
+
+class AverageMeter(object):
+	"""Computes and stores the average and current value"""
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.val = 0
+		self.avg = 0
+		self.sum = 0
+		self.count = 0
+
+	def update(self, val, n=1):
+		self.val = val
+		self.sum += val * n
+		self.count += n
+		self.avg = self.sum / self.count
+
+	sum_fields = ('sum', 'count')
+
+	def state_dict(self):
+		return {'sum': self.sum, 'count': self.count}
+
+	def load_state_dict(self, state):
+		self.sum = state['sum']
+		self.count = state['count']
+		self.avg = self.sum / self.count if self.count else 0
+
+	def merge(self, other):
+		self.load_state_dict({'sum': self.sum + other.sum, 'count': self.count + other.count})
+		return self
+
+
+class ConfusionMeter(object):
+	"""Accumulates a KxK confusion matrix (rows: label, cols: prediction) batch by batch.
+	Kappa, accuracy and per-class sensitivity are computed from the counts in O(K^2),
+	so they can be reported after every batch without keeping the predictions around.
+	Ratings are clipped to [0, num_classes-1] like quadratic_weighted_kappa does.
+	"""
+
+	def __init__(self, num_classes=5):
+		self.num_classes = num_classes
+		self.reset()
+
+	def reset(self):
+		self.conf_mat = np.zeros((self.num_classes, self.num_classes), dtype=np.int64)
+		self.count = 0
+
+	def update(self, label, pred):
+		k = self.num_classes
+		label = np.clip(np.asarray(label, dtype=np.int64).ravel(), 0, k - 1)
+		pred = np.clip(np.asarray(pred, dtype=np.int64).ravel(), 0, k - 1)
+		assert (len(label) == len(pred))
+		self.conf_mat += np.bincount(label * k + pred, minlength=k * k).reshape(k, k)
+		self.count += len(label)
+
+	sum_fields = ('conf_mat', 'count')
+
+	def state_dict(self):
+		return {'num_classes': self.num_classes, 'conf_mat': self.conf_mat.copy(), 'count': self.count}
+
+	def load_state_dict(self, state):
+		self.num_classes = int(state['num_classes'])
+		self.conf_mat = np.asarray(state['conf_mat'], dtype=np.int64).reshape(self.num_classes, self.num_classes).copy()
+		self.count = int(state['count'])
+
+	def merge(self, other):
+		assert (self.num_classes == other.num_classes)
+		self.conf_mat += other.conf_mat
+		self.count += other.count
+		return self
+
+	def kappa(self):
+		return kappa_from_confusion_matrix(self.conf_mat)
+
+	def accuracy(self):
+		if self.count == 0:
+			return 0.0
+		return np.trace(self.conf_mat) / float(self.count)
+
+	def sensitivity(self):
+		"""Per-class recall tp/(tp+fn); for a binary meter [1] is sensitivity and [0] specificity"""
+		support = self.conf_mat.sum(1)
+		return np.where(support > 0, np.diag(self.conf_mat) / np.maximum(support, 1).astype(np.float64), 0.0)
+
+
+class RocMeter(object):
+	"""Accumulates per-class histograms of a binary score in [0, 1] over num_bins equal bins.
+	Memory is O(num_bins) whatever the dataset size, and meters of several evaluation shards
+	merge by adding their histograms. The ROC curve has one point per bin edge; AUC counts the
+	pairs sharing a bin as ties, so it is off the exact AUC by at most auc_error() (half the
+	fraction of positive/negative pairs falling into the same bin).
+	"""
+
+	def __init__(self, num_bins=1000):
+		self.num_bins = num_bins
+		self.reset()
+
+	def reset(self):
+		self.pos_hist = np.zeros(self.num_bins, dtype=np.int64)
+		self.neg_hist = np.zeros(self.num_bins, dtype=np.int64)
+
+	def update(self, label, prob):
+		label = np.asarray(label, dtype=np.int64).ravel()
+		prob = np.asarray(prob, dtype=np.float64).ravel()
+		assert (len(label) == len(prob))
+		bins = np.clip((prob * self.num_bins).astype(np.int64), 0, self.num_bins - 1)
+		self.pos_hist += np.bincount(bins[label == 1], minlength=self.num_bins)
+		self.neg_hist += np.bincount(bins[label != 1], minlength=self.num_bins)
+
+	sum_fields = ('pos_hist', 'neg_hist')
+
+	def merge(self, other):
+		assert (self.num_bins == other.num_bins)
+		self.pos_hist += other.pos_hist
+		self.neg_hist += other.neg_hist
+		return self
+
+	def state_dict(self):
+		return {'num_bins': self.num_bins, 'pos_hist': self.pos_hist.copy(), 'neg_hist': self.neg_hist.copy()}
+
+	def load_state_dict(self, state):
+		self.num_bins = int(state['num_bins'])
+		self.pos_hist = np.asarray(state['pos_hist'], dtype=np.int64).copy()
+		self.neg_hist = np.asarray(state['neg_hist'], dtype=np.int64).copy()
+
+	def curve(self):
+		"""
+		fpr, tpr and the matching thresholds (lower bin edges) from the strictest threshold
+		down, starting at (0, 0) like sklearn's roc_curve
+		"""
+		num_pos = max(self.pos_hist.sum(), 1)
+		num_neg = max(self.neg_hist.sum(), 1)
+		tpr = np.concatenate(([0], np.cumsum(self.pos_hist[::-1]))) / float(num_pos)
+		fpr = np.concatenate(([0], np.cumsum(self.neg_hist[::-1]))) / float(num_neg)
+		thresholds = np.concatenate(([np.inf], np.arange(self.num_bins - 1, -1, -1) / float(self.num_bins)))
+		return fpr, tpr, thresholds
+
+	def auc(self):
+		num_pairs = float(self.pos_hist.sum() * self.neg_hist.sum())
+		if num_pairs == 0:
+			return 0.0
+		neg_below = np.cumsum(self.neg_hist) - self.neg_hist
+		return float((self.pos_hist * (neg_below + 0.5 * self.neg_hist)).sum() / num_pairs)
+
+	def auc_error(self):
+		"""Upper bound of |auc() - exact AUC| caused by the binning"""
+		num_pairs = float(self.pos_hist.sum() * self.neg_hist.sum())
+		if num_pairs == 0:
+			return 0.0
+		return float(0.5 * (self.pos_hist * self.neg_hist).sum() / num_pairs)
+
+
+def binary_metrics(tp, fp, fn, tn):
+	"""(accuracy, sensitivity, specificity, f1) from binary counts, 0 where undefined"""
+	total = tp + fp + fn + tn
+	accuracy = (tp + tn) / float(total) if total > 0 else 0
+	sensitivity = tp / float(tp + fn) if (tp + fn) > 0 else 0
+	specificity = tn / float(tn + fp) if (tn + fp) > 0 else 0
+	f1 = 2 * tp / float(2 * tp + fp + fn) if (2 * tp + fp + fn) > 0 else 0
+	return accuracy, sensitivity, specificity, f1
+
+
+class JointMeter(object):
+	"""Counts of joint outcomes, e.g. (DR prediction, DME prediction, referable label), in a dense
+	tensor of the given shape updated with one bincount per batch. Any metric that is a function
+	of these columns becomes a reduction of the tensor, independent of the number of images.
+	"""
+
+	def __init__(self, shape):
+		self.shape = tuple(shape)
+		self.reset()
+
+	def reset(self):
+		self.counts = np.zeros(self.shape, dtype=np.int64)
+
+	def update(self, *columns):
+		assert (len(columns) == len(self.shape))
+		columns = [np.clip(np.asarray(c, dtype=np.int64).ravel(), 0, n - 1) for c, n in zip(columns, self.shape)]
+		index = np.ravel_multi_index(columns, self.shape)
+		self.counts += np.bincount(index, minlength=self.counts.size).reshape(self.shape)
+
+	sum_fields = ('counts',)
+
+	def state_dict(self):
+		return {'shape': self.shape, 'counts': self.counts.copy()}
+
+	def load_state_dict(self, state):
+		self.shape = tuple(state['shape'])
+		self.counts = np.asarray(state['counts'], dtype=np.int64).reshape(self.shape).copy()
+
+	def merge(self, other):
+		assert (self.shape == other.shape)
+		self.counts += other.counts
+		return self
+
+	def binary(self, positive):
+		"""
+		Binary metrics when the last axis is a 0/1 label and positive is a boolean array over the
+		other axes marking the predicted-positive cells. Returns (accuracy, sensitivity, specificity, f1).
+		"""
+		positive = np.broadcast_to(np.asarray(positive, dtype=bool), self.shape[:-1])
+		pos, neg = self.counts[positive], self.counts[~positive]
+		return binary_metrics(pos[..., 1].sum(), pos[..., 0].sum(), neg[..., 1].sum(), neg[..., 0].sum())
+
+
+class MetricState(object):
+	"""Named meters (AverageMeter, ConfusionMeter, RocMeter) of one evaluation, kept mergeable so
+	shards of a test set can be evaluated apart: save() the state of every shard and merge_files()
+	them, or all_reduce() across a torch.distributed group. Every meter only holds sums, so the
+	merged kappa/AUC/loss equal those of a single-process run.
+	"""
+
+	def __init__(self, **meters):
+		self.meters = meters
+
+	def __getitem__(self, name):
+		return self.meters[name]
+
+	def state_dict(self):
+		return dict((name, meter.state_dict()) for name, meter in self.meters.items())
+
+	def load_state_dict(self, state):
+		for name, meter in self.meters.items():
+			meter.load_state_dict(state[name])
+
+	def merge(self, other):
+		for name, meter in self.meters.items():
+			meter.merge(other[name])
+		return self
+
+	def save(self, path):
+		with open(path, 'wb') as fp:
+			pickle.dump(self.state_dict(), fp, protocol=2)
+
+	def merge_files(self, paths):
+		"""Adds the states saved by save() in paths, the meters must be built like the saved ones"""
+		for path in paths:
+			with open(path, 'rb') as fp:
+				state = pickle.load(fp)
+			for name, meter in self.meters.items():
+				shard = meter.__class__.__new__(meter.__class__)
+				shard.load_state_dict(state[name])
+				meter.merge(shard)
+		return self
+
+	def all_reduce(self, group=None):
+		"""Sums every meter over the processes of a torch.distributed (e.g. gloo) group in one call"""
+		import torch
+		import torch.distributed as dist
+		names = sorted(self.meters)
+		states = [self.meters[name].state_dict() for name in names]
+		fields = [(state, field) for name, state in zip(names, states) for field in self.meters[name].sum_fields]
+		flat = np.concatenate([np.asarray(state[field], dtype=np.float64).ravel() for state, field in fields])
+		tensor = torch.from_numpy(flat)
+		if group is None:
+			dist.all_reduce(tensor)
+		else:
+			dist.all_reduce(tensor, group=group)
+		flat, offset = tensor.numpy(), 0
+		for state, field in fields:
+			value = np.asarray(state[field])
+			reduced = np.round(flat[offset:offset + value.size]).reshape(value.shape) if value.dtype.kind in 'iu' \
+				else flat[offset:offset + value.size].reshape(value.shape)
+			# integer counts come back from the float64 reduction as integers again, scalars as python numbers
+			reduced = reduced.astype(value.dtype)
+			state[field] = reduced if value.ndim else reduced.item()
+			offset += value.size
+		for name, state in zip(names, states):
+			self.meters[name].load_state_dict(state)
+		return self
+
+
+"""Quadratic weighted kappa metric.
+   Source: https://github.com/sveitser/kaggle_diabetic/blob/master/quadratic_weighted_kappa.py
+   Origin: https://github.com/benhamner/Metrics/blob/master/Python/ml_metrics/quadratic_weighted_kappa.py
+"""
+
+
+def _kappa_ratings(ratings, min_rating, max_rating):
+	"""
+	Clips and rounds ratings to integers, non-finite ratings count as 0
+	"""
+	ratings = np.asarray(ratings, dtype=np.float64)
+	if min_rating is not None or max_rating is not None:
+		ratings = np.clip(ratings, min_rating, max_rating)
+	ratings = np.where(np.isfinite(ratings), ratings, 0)
+	return np.round(ratings).astype(int)
+
+
+def kappa_confusion_matrix(rater_a, rater_b, min_rating=None, max_rating=None):
+	"""
+	Returns the confusion matrix between rater's ratings
+	"""
+	rater_a = np.asarray(rater_a, dtype=int).ravel()
+	rater_b = np.asarray(rater_b, dtype=int).ravel()
+	assert (len(rater_a) == len(rater_b))
+	if min_rating is None:
+		min_rating = min(rater_a.min(), rater_b.min())
+	if max_rating is None:
+		max_rating = max(rater_a.max(), rater_b.max())
+	num_ratings = int(max_rating - min_rating + 1)
+	index = (rater_a - min_rating) * num_ratings + (rater_b - min_rating)
+	return np.bincount(index, minlength=num_ratings * num_ratings).reshape(num_ratings, num_ratings)
+
+
+def kappa_histogram(ratings, min_rating=None, max_rating=None):
+	"""
+	Returns the counts of each type of rating that a rater made
+	"""
+	ratings = np.asarray(ratings, dtype=int).ravel()
+	if min_rating is None:
+		min_rating = ratings.min()
+	if max_rating is None:
+		max_rating = ratings.max()
+	num_ratings = int(max_rating - min_rating + 1)
+	return np.bincount(ratings - min_rating, minlength=num_ratings)
+
+
+def kappa_from_confusion_matrix(conf_mat):
+	"""
+	Quadratic weighted kappa of a (..., K, K) confusion matrix, rows are rater_a and
+	columns rater_b. Returns -1.0 where the expected disagreement vanishes.
+	"""
+	conf_mat = np.asarray(conf_mat, dtype=np.float64)
+	num_ratings = conf_mat.shape[-1]
+	ratings = np.arange(num_ratings)
+	weights = (ratings[:, None] - ratings[None, :]) ** 2 / float(max(num_ratings - 1, 1) ** 2)
+	num_scored_items = conf_mat.sum(axis=(-2, -1))
+	with np.errstate(divide='ignore', invalid='ignore'):
+		expected = conf_mat.sum(-1)[..., :, None] * conf_mat.sum(-2)[..., None, :] / num_scored_items[..., None, None]
+		numerator = (weights * conf_mat).sum(axis=(-2, -1)) / num_scored_items
+		denominator = (weights * expected).sum(axis=(-2, -1)) / num_scored_items
+		kappa = np.where(denominator >= 1e-11, 1.0 - numerator / denominator, -1.0)
+	if kappa.ndim == 0:
+		return float(kappa)
+	return kappa
+
+
+def quadratic_weighted_kappa(rater_a, rater_b, min_rating=0, max_rating=4):
+	"""
+	Calculates the quadratic weighted kappa
+	quadratic_weighted_kappa calculates the quadratic weighted kappa
+	value, which is a measure of inter-rater agreement between two raters
+	that provide discrete numeric ratings.  Potential values range from -1
+	(representing complete disagreement) to 1 (representing complete
+	agreement).  A kappa value of 0 is expected if all agreement is due to
+	chance.
+
+	quadratic_weighted_kappa(rater_a, rater_b), where rater_a and rater_b
+	each correspond to a list of integer ratings.  These lists must have the
+	same length.
+
+	The ratings should be integers, and it is assumed that they contain
+	the complete range of possible ratings.
+
+	quadratic_weighted_kappa(X, min_rating, max_rating), where min_rating
+	is the minimum possible rating, and max_rating is the maximum possible
+	rating
+	"""
+	rater_a = _kappa_ratings(rater_a, min_rating, max_rating).ravel()
+	rater_b = _kappa_ratings(rater_b, min_rating, max_rating).ravel()
+
+	assert (len(rater_a) == len(rater_b))
+	if min_rating is None:
+		min_rating = min(rater_a.min(), rater_b.min())
+	if max_rating is None:
+		max_rating = max(rater_a.max(), rater_b.max())
+	conf_mat = kappa_confusion_matrix(rater_a, rater_b, min_rating, max_rating)
+	return kappa_from_confusion_matrix(conf_mat)
+
+
+def quadratic_weighted_kappa_batch(rater_a, rater_b, min_rating=0, max_rating=4):
+	"""
+	Scores every row of rater_b (M x n, e.g. the predictions of M checkpoints or
+	ensemble members) against the single rating vector rater_a in one call.
+	Returns an array of M kappas, each equal to quadratic_weighted_kappa(rater_a, rater_b[m]).
+	"""
+	rater_a = _kappa_ratings(rater_a, min_rating, max_rating).ravel()
+	rater_b = _kappa_ratings(rater_b, min_rating, max_rating).reshape(-1, len(rater_a))
+	if min_rating is None:
+		min_rating = min(rater_a.min(), rater_b.min())
+	if max_rating is None:
+		max_rating = max(rater_a.max(), rater_b.max())
+	num_ratings = int(max_rating - min_rating + 1)
+	num_rows = rater_b.shape[0]
+	index = np.arange(num_rows)[:, None] * num_ratings * num_ratings + \
+	        (rater_a[None, :] - min_rating) * num_ratings + (rater_b - min_rating)
+	conf_mat = np.bincount(index.ravel(), minlength=num_rows * num_ratings * num_ratings)
+	return kappa_from_confusion_matrix(conf_mat.reshape(num_rows, num_ratings, num_ratings))
+
+
+def bootstrap_indices(num_items, num_boot, seed=111, max_elements=2 ** 24):
+	"""
+	Yields the (num_boot, num_items) bootstrap resample index matrix in row chunks of at
+	most max_elements entries, so memory stays bounded for large test sets
+	"""
+	rng = np.random.RandomState(seed)
+	chunk = max(1, max_elements // max(num_items, 1))
+	for start in range(0, num_boot, chunk):
+		yield rng.randint(0, num_items, size=(min(chunk, num_boot - start), num_items))
+
+
+def _bootstrap_auc(label, group, num_groups, index):
+	"""
+	AUC (Mann-Whitney, ties count one half) of every resample row in index, group is the
+	rank of each sample's score among the unique scores
+	"""
+	num_rows = index.shape[0]
+	cell = (np.arange(num_rows)[:, None] * num_groups + group[index]).ravel()
+	tot = np.bincount(cell, minlength=num_rows * num_groups).reshape(num_rows, num_groups)
+	pos = np.bincount(cell, weights=label[index].ravel(), minlength=num_rows * num_groups).reshape(num_rows, num_groups)
+	neg = tot - pos
+	neg_below = np.cumsum(neg, axis=1) - neg
+	with np.errstate(divide='ignore', invalid='ignore'):
+		auc = (pos * (neg_below + 0.5 * neg)).sum(1) / (pos.sum(1) * neg.sum(1))
+	return auc
+
+
+def bootstrap_metrics(label, pred=None, prob=None, num_classes=5, num_boot=1000, alpha=0.05, seed=111, max_elements=2 ** 24):
+	"""
+	Percentile bootstrap confidence intervals from cached predictions, no model needed.
+	pred (graded or binary predictions) gives 'kappa', plus 'sensitivity' and 'specificity'
+	when num_classes is 2; prob (score of the positive class, binary label) gives 'auc'.
+	All num_boot resamples are scored at once per chunk of the resample index matrix.
+	Returns {metric: (estimate on all items, lower, upper)}.
+	"""
+	label = np.asarray(label, dtype=int).ravel()
+	num_items = len(label)
+	metrics = {}
+	if pred is not None:
+		pred = np.clip(np.asarray(pred, dtype=int).ravel(), 0, num_classes - 1)
+		assert (len(pred) == num_items)
+		cell = np.clip(label, 0, num_classes - 1) * num_classes + pred
+		metrics['kappa'] = []
+		if num_classes == 2:
+			true_pos = (label == 1) & (pred == 1)
+			true_neg = (label == 0) & (pred == 0)
+			metrics['sensitivity'] = []
+			metrics['specificity'] = []
+	if prob is not None:
+		prob = np.asarray(prob, dtype=np.float64).ravel()
+		assert (len(prob) == num_items)
+		unique_prob, group = np.unique(prob, return_inverse=True)
+		metrics['auc'] = []
+
+	full = np.arange(num_items)[None, :]
+	for index in [full] + list(bootstrap_indices(num_items, num_boot, seed, max_elements)):
+		num_rows = index.shape[0]
+		if pred is not None:
+			conf_mat = np.bincount((np.arange(num_rows)[:, None] * num_classes ** 2 + cell[index]).ravel(),
+			                       minlength=num_rows * num_classes ** 2)
+			metrics['kappa'].append(kappa_from_confusion_matrix(conf_mat.reshape(num_rows, num_classes, num_classes)).reshape(-1))
+			if num_classes == 2:
+				num_pos = (label[index] == 1).sum(1)
+				num_neg = num_items - num_pos
+				metrics['sensitivity'].append(np.where(num_pos > 0, true_pos[index].sum(1) / np.maximum(num_pos, 1).astype(np.float64), 0.0))
+				metrics['specificity'].append(np.where(num_neg > 0, true_neg[index].sum(1) / np.maximum(num_neg, 1).astype(np.float64), 0.0))
+		if prob is not None:
+			metrics['auc'].append(_bootstrap_auc(label, group, len(unique_prob), index))
+
+	res = {}
+	for name, values in metrics.items():
+		estimate, values = values[0][0], np.concatenate(values[1:])
+		lower, upper = np.nanpercentile(values, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+		res[name] = (float(estimate), float(lower), float(upper))
+	return res
+
+
+def threshold_sweep(label, prob):
+	"""
+	Binary operating points at every unique score threshold (predict positive when
+	prob >= threshold) from a single sort, thresholds descending.
+	Returns a dict of arrays: threshold, sensitivity, specificity, ppv, f1.
+	"""
+	label = (np.asarray(label).ravel() == 1)
+	prob = np.asarray(prob, dtype=np.float64).ravel()
+	assert (len(label) == len(prob))
+	order = np.argsort(-prob, kind='mergesort')
+	prob, label = prob[order], label[order]
+	# last position of every run of equal scores
+	last = np.r_[np.nonzero(np.diff(prob))[0], len(prob) - 1]
+	tp = np.cumsum(label)[last].astype(np.float64)
+	fp = (last + 1) - tp
+	num_pos = max(label.sum(), 1)
+	num_neg = max(len(label) - label.sum(), 1)
+	return {
+		'threshold': prob[last],
+		'sensitivity': tp / num_pos,
+		'specificity': 1.0 - fp / num_neg,
+		'ppv': tp / (tp + fp),
+		'f1': 2 * tp / (tp + fp + label.sum()),
+	}
+
+
+def threshold_for_sensitivity(label, prob, target=0.95):
+	"""
+	The strictest threshold whose sensitivity reaches target, i.e. the best specificity
+	at that sensitivity. Returns (threshold, {metric: value at threshold}).
+	"""
+	sweep = threshold_sweep(label, prob)
+	index = min(np.searchsorted(sweep['sensitivity'], target - 1e-12), len(sweep['threshold']) - 1)
+	return float(sweep['threshold'][index]), dict((k, float(v[index])) for k, v in sweep.items() if k != 'threshold')
+
+
+def checkpoint_info_path(weight, name):
+	return os.path.splitext(weight)[0] + '_' + name + '.json'
+
+
+def save_checkpoint_info(weight, name, info):
+	with open(checkpoint_info_path(weight, name), 'w') as fp:
+		json.dump(info, fp, indent=4, sort_keys=True)
+
+
+def load_checkpoint_info(weight, name):
+	"""The json stored by save_checkpoint_info next to the checkpoint, None when there is none"""
+	if weight is None or not os.path.isfile(checkpoint_info_path(weight, name)):
+		return None
+	with open(checkpoint_info_path(weight, name)) as fp:
+		return json.load(fp)
+
+
+def save_operating_point(weight, threshold, **info):
+	"""Stores the referable threshold chosen for a checkpoint in a json next to it"""
+	info['threshold'] = float(threshold)
+	save_checkpoint_info(weight, 'operating_point', info)
+
+
+def load_operating_point(weight, default=None):
+	"""The threshold stored by save_operating_point for this checkpoint, default when there is none"""
+	info = load_checkpoint_info(weight, 'operating_point')
+	return default if info is None else info['threshold']
+
+
+def default_cut_points(num_classes=5):
+	return np.arange(num_classes - 1) + 0.5
+
+
+def apply_cut_points(score, cut_points):
+	"""Maps regression outputs to levels, level k for cut_points[k-1] <= score < cut_points[k]"""
+	score = np.asarray(score, dtype=np.float64)
+	return np.searchsorted(np.sort(np.asarray(cut_points, dtype=np.float64)), score, side='right')
+
+
+def optimize_cut_points(score, label, num_classes=5, cut_points=None, num_candidates=100, max_rounds=20):
+	"""
+	Coordinate search for the num_classes-1 cut points maximizing quadratic weighted kappa of
+	apply_cut_points(score) against label. Each step scores num_candidates positions of one cut
+	point (score quantiles between its neighbours) at once with quadratic_weighted_kappa_batch.
+	Returns (cut_points, kappa).
+	"""
+	score = np.asarray(score, dtype=np.float64).ravel()
+	label = np.asarray(label, dtype=int).ravel()
+	assert (len(score) == len(label))
+	cut_points = default_cut_points(num_classes) if cut_points is None else np.sort(np.asarray(cut_points, dtype=np.float64))
+	max_rating = num_classes - 1
+	best = quadratic_weighted_kappa(label, apply_cut_points(score, cut_points), 0, max_rating)
+	for _ in range(max_rounds):
+		improved = False
+		for i in range(num_classes - 1):
+			lower = cut_points[i - 1] if i > 0 else -np.inf
+			upper = cut_points[i + 1] if i < num_classes - 2 else np.inf
+			inside = score[(score > lower) & (score < upper)]
+			if len(inside) == 0:
+				continue
+			candidates = np.unique(np.percentile(inside, np.linspace(0, 100, num_candidates)))
+			# items below the neighbours keep their level, so only cut point i moves between candidates
+			base = apply_cut_points(score, np.delete(cut_points, i))
+			moving = base == i
+			base = base + (base > i)
+			preds = base[None, :] + ((score[None, :] >= candidates[:, None]) & moving[None, :])
+			kappas = quadratic_weighted_kappa_batch(label, preds, 0, max_rating)
+			if kappas.max() > best + 1e-12:
+				best = float(kappas.max())
+				cut_points[i] = candidates[kappas.argmax()]
+				improved = True
+		if not improved:
+			break
+	return cut_points, best
+
+
+def cross_fit_cut_points(score, label, num_classes=5, folds=5, seed=111):
+	"""
+	optimize_cut_points on all items plus an honest kappa for them: each of folds label-stratified
+	parts is graded with the cut points fitted on the other parts. Returns (cut_points fitted on all
+	items, out-of-fold levels, out-of-fold kappa), the in-sample kappa of the first is optimistic.
+	"""
+	score = np.asarray(score, dtype=np.float64).ravel()
+	label = np.asarray(label, dtype=int).ravel()
+	order = np.random.RandomState(seed).permutation(len(label))
+	order = order[np.argsort(label[order], kind='mergesort')]
+	fold = np.empty(len(label), dtype=int)
+	fold[order] = np.arange(len(label)) % folds
+	pred = np.zeros(len(label), dtype=int)
+	for k in range(folds):
+		held = fold == k
+		cut_points, _ = optimize_cut_points(score[~held], label[~held], num_classes)
+		pred[held] = apply_cut_points(score[held], cut_points)
+	cut_points, _ = optimize_cut_points(score, label, num_classes)
+	return cut_points, pred, quadratic_weighted_kappa(label, pred, 0, num_classes - 1)
+
+
+def save_cut_points(weight, cut_points, **info):
+	"""Stores the regression cut points chosen for a checkpoint in a json next to it"""
+	info['cut_points'] = [float(c) for c in cut_points]
+	save_checkpoint_info(weight, 'cut_points', info)
+
+
+def load_cut_points(weight, default=None):
+	"""The cut points stored by save_cut_points for this checkpoint, default when there are none"""
+	info = load_checkpoint_info(weight, 'cut_points')
+	return default if info is None else np.array(info['cut_points'], dtype=np.float64)
+
@@ -0,0 +1,168 @@
+"""Pre-resized fundus images packed into fixed-shape uint8 memmap shards.
+
+A packed directory (written by data_processing/pack_images.py) holds
+	shard_00000.u8, shard_00001.u8, ...	raw (count, size, size, channels) uint8 arrays
+	index.json				{'size': 512, 'channels': 3, 'shards': [{'file':, 'count':}], 'ids': [...]}
+Reading a crop is a slice of the memmap, so only the cropped rows are paged in and no decode is needed.
+A record can hold several aligned views of an image side by side in the channels, e.g. the raw and the AHE
+images as 6 channels, so one read and one crop serve both.
+"""
+import os, json
+import numpy as np
+import torch
+import torch.utils.data
+from PIL import Image
+
+
+def write_packed_images(output, ids, load_image, size, shard_size=4096, channels=3):
+	"""
+	Packs the images returned by load_image(id) (PIL images or size x size x channels uint8 arrays)
+	into shards of shard_size images, then writes the index
+	"""
+	if not os.path.exists(output):
+		os.makedirs(output)
+	shards = []
+	for start in range(0, len(ids), shard_size):
+		shard_ids = ids[start:start + shard_size]
+		name = 'shard_%05d.u8' % len(shards)
+		shard = np.memmap(os.path.join(output, name), dtype=np.uint8, mode='w+', shape=(len(shard_ids), size, size, channels))
+		for row, image_id in enumerate(shard_ids):
+			image = load_image(image_id)
+			if isinstance(image, Image.Image):
+				image = image.convert('RGB')
+			image = np.asarray(image, dtype=np.uint8)
+			if image.shape != (size, size, channels):
+				raise Exception('{} is {}, expected {}'.format(image_id, image.shape, (size, size, channels)))
+			shard[row] = image
+		shard.flush()
+		del shard
+		shards.append({'file': name, 'count': len(shard_ids)})
+	with open(os.path.join(output, 'index.json'), 'w') as fp:
+		json.dump({'size': size, 'channels': channels, 'shards': shards, 'ids': [str(i) for i in ids]}, fp)
+
+
+class PackedImages(object):
+	"""id -> (size, size, channels) uint8 view into the shards; the memmaps are opened lazily in each worker"""
+
+	def __init__(self, root):
+		self.root = root
+		with open(os.path.join(root, 'index.json'), 'r') as fp:
+			index = json.load(fp)
+		self.size = index['size']
+		self.channels = index.get('channels', 3)
+		self.shards = index['shards']
+		self.ids = index['ids']
+		self.offsets = dict((image_id, i) for i, image_id in enumerate(self.ids))
+		self.shard_starts = np.cumsum([0] + [shard['count'] for shard in self.shards])
+		self.maps = None
+
+	def __len__(self):
+		return len(self.ids)
+
+	def __contains__(self, image_id):
+		return image_id in self.offsets
+
+	def __getstate__(self):
+		# open memmaps are not pickled into DataLoader workers, each worker maps the files itself
+		state = self.__dict__.copy()
+		state['maps'] = None
+		return state
+
+	def _open(self):
+		self.maps = [np.memmap(os.path.join(self.root, shard['file']), dtype=np.uint8, mode='r',
+		                       shape=(shard['count'], self.size, self.size, self.channels)) for shard in self.shards]
+
+	def image(self, position):
+		"""The full image at position (in index order) as a read-only view"""
+		if self.maps is None:
+			self._open()
+		shard = np.searchsorted(self.shard_starts, position, side='right') - 1
+		return self.maps[shard][position - self.shard_starts[shard]]
+
+	def __getitem__(self, image_id):
+		return self.image(self.offsets[image_id])
+
+	def crop(self, image_id, top, left, height, width):
+		"""Zero-copy crop, only the touched rows are read from disk"""
+		return self[image_id][top:top + height, left:left + width]
+
+
+def crop_record(record, crop_size, train=True):
+	"""
+	A random (train) or center crop_size crop of a (size, size, channels) record, flipped horizontally with
+	probability 0.5 when training; one geometry for all the channels, returned as a view
+	"""
+	margin_h, margin_w = record.shape[0] - crop_size, record.shape[1] - crop_size
+	if train:
+		top, left = np.random.randint(0, margin_h + 1), np.random.randint(0, margin_w + 1)
+	else:
+		top, left = margin_h // 2, margin_w // 2
+	crop = record[top:top + crop_size, left:left + crop_size]
+	if train and np.random.rand() < 0.5:
+		crop = crop[:, ::-1]
+	return crop
+
+
+class PairedCrop(object):
+	"""
+	The geometric part of the transforms of aligned views (e.g. the raw and AHE images): one crop_record
+	crop and flip for all of them, returned as one PIL image per view. Takes a packed record holding the
+	views in its channels, or the views themselves as PIL images, which are first resized so their shorter
+	side is scale_size when it is given (the Scale of the val transforms). The per-view transforms then only
+	hold the non-geometric tail: color, ToTensor, Normalize.
+	"""
+
+	def __init__(self, crop_size, scale_size=None, train=True, channels=3):
+		self.crop_size = crop_size
+		self.scale_size = scale_size
+		self.train = train
+		self.channels = channels
+
+	def rescale(self, image):
+		w, h = image.size
+		if self.scale_size is None or min(w, h) == self.scale_size:
+			return image
+		if w < h:
+			return image.resize((self.scale_size, int(self.scale_size * h / w)), Image.BILINEAR)
+		return image.resize((int(self.scale_size * w / h), self.scale_size), Image.BILINEAR)
+
+	def __call__(self, *views):
+		if len(views) == 1 and not isinstance(views[0], Image.Image):
+			record = views[0]
+		else:
+			record = np.concatenate([np.asarray(self.rescale(view)) for view in views], 2)
+		crop = crop_record(record, self.crop_size, self.train)
+		return [Image.fromarray(np.ascontiguousarray(crop[:, :, c:c + self.channels]))
+		        for c in range(0, crop.shape[2], self.channels)]
+
+
+class PackedClsDataSet(torch.utils.data.Dataset):
+	"""
+	Classification dataset over a packed directory: random (train) or center (val) crop_size crops
+	with optional horizontal flip, converted straight to a normalized tensor. A PIL transform can be
+	given instead for the augmentations that need one; it gets the crop, not the full image.
+	"""
+
+	def __init__(self, packed, ids, labels, crop_size, train=True, mean=None, std=None, transform=None):
+		super(PackedClsDataSet, self).__init__()
+		self.packed = packed if isinstance(packed, PackedImages) else PackedImages(packed)
+		self.positions = np.array([self.packed.offsets[str(i)] for i in ids], dtype=np.int64)
+		self.labels = np.asarray(labels, dtype=np.int64)
+		assert (len(self.positions) == len(self.labels))
+		self.crop_size = crop_size
+		self.train = train
+		self.mean = None if mean is None else torch.FloatTensor(mean).view(3, 1, 1)
+		self.std = None if std is None else torch.FloatTensor(std).view(3, 1, 1)
+		self.transform = transform
+
+	def __getitem__(self, index):
+		crop = crop_record(self.packed.image(self.positions[index]), self.crop_size, self.train)
+		if self.transform is not None:
+			return self.transform(Image.fromarray(np.ascontiguousarray(crop))), self.labels[index]
+		tensor = torch.from_numpy(np.ascontiguousarray(crop.transpose(2, 0, 1))).float().div_(255)
+		if self.mean is not None:
+			tensor = tensor.sub_(self.mean).div_(self.std)
+		return tensor, self.labels[index]
+
+	def __len__(self):
+		return len(self.labels)
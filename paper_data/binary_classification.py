@@ -1,13 +1,13 @@
 import json
 import torch.utils.data
 import numpy as np
-from PIL import Image
 import sys
 sys.path.append('../')
-from utils import TenCrop, HorizontalFlip, Affine, ColorJitter, Lighting, PILColorJitter
-from utils import AverageMeter, quadratic_weighted_kappa
+from utils import TenCrop, HorizontalFlip, Affine, ColorJitter, Lighting, PILColorJitter, LabelTable
+from image_decode import load_image
+from utils import AverageMeter, ConfusionMeter
+from logit_store import LogitWriter
 import torchvision.transforms as transforms
-import pandas as pd
 
 import argparse
 import os
@@ -67,10 +67,7 @@ class BinClsDataSet(torch.utils.data.Dataset):
         self.config = config
         self.crop_size = crop_size
         self.scale_size = scale_size
-        df = pd.DataFrame.from_csv(config)
-        self.images_list = []
-        for index, row in df.iterrows():
-            self.images_list.append(row)
+        self.images_list = LabelTable(config)
         with open('info.json', 'r') as fp:
             info = json.load(fp)
         mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
@@ -115,7 +112,7 @@ class BinClsDataSet(torch.utils.data.Dataset):
                 ])
 
     def __getitem__(self, item):
-        return self.transform(Image.open(os.path.join(self.root, self.images_list[item][0]+'_'+str(self.scale_size)+'.png'))), self.images_list[item][3]
+        return self.transform(load_image(os.path.join(self.root, self.images_list[item][0]+'_'+str(self.scale_size)+'.png'))), self.images_list[item][3]
 
     def __len__(self):
         return len(self.images_list)
@@ -127,10 +124,7 @@ class BinClsDataSetVal(torch.utils.data.Dataset):
         self.config = config
         self.crop_size = crop_size
         self.scale_size = scale_size
-        df = pd.DataFrame.from_csv(config)
-        self.images_list = []
-        for index, row in df.iterrows():
-            self.images_list.append(row)
+        self.images_list = LabelTable(config)
         with open('info.json', 'r') as fp:
             info = json.load(fp)
         mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
@@ -153,7 +147,7 @@ class BinClsDataSetVal(torch.utils.data.Dataset):
             ])
 
     def __getitem__(self, item):
-        return self.transform(Image.open(os.path.join(self.root, self.images_list[item][0]+'_'+str(self.scale_size)+'.png'))), self.images_list[item][3]
+        return self.transform(load_image(os.path.join(self.root, self.images_list[item][0]+'_'+str(self.scale_size)+'.png'))), self.images_list[item][3]
 
     def __len__(self):
         return len(self.images_list)
@@ -290,8 +284,7 @@ class multi_channel_model(nn.Module):
 
 def cls_train(train_data_loader, model, criterion, optimizer, epoch, display):
     model.train()
-    tot_pred = np.array([], dtype=int)
-    tot_label = np.array([], dtype=int)
+    confusion = ConfusionMeter(2)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     losses = AverageMeter()
@@ -309,13 +302,12 @@ def cls_train(train_data_loader, model, criterion, optimizer, epoch, display):
         _,pred = torch.max(output, 1)
         pred = pred.cpu().data.numpy().squeeze()
         labels = labels.numpy().squeeze()
-        tot_pred = np.append(tot_pred, pred)
-        tot_label = np.append(tot_label, labels)
+        confusion.update(labels, pred)
         losses.update(loss.data[0], len(images))
         accuracy.update(np.equal(pred, labels).sum()/len(labels), len(labels))
         end = time.time()
         if num_iter % display == 0:
-            correct = np.equal(tot_pred, tot_label).sum()/len(tot_pred)
+            correct = confusion.accuracy()
             print_info = 'Epoch: [{0}][{1}/{2}]\tTime {batch_time.val:3f} ({batch_time.avg:.3f})\t'\
                 'Data {data_time.avg:.3f}\t''Loss {loss.avg:.4f}\tAccuray {accuracy.avg:.4f}'.format(
                 epoch, num_iter, len(train_data_loader),batch_time=batch_time, data_time=data_time,
@@ -365,10 +357,11 @@ def calc_sensitivity_specificity(pred, label):
     return sensitivity, specificity, f1
 
 
-def cls_eval(eval_data_loader, model, criterion, display):
+def cls_eval(eval_data_loader, model, criterion, display, store=None):
     model.eval()
-    tot_pred = np.array([], dtype=int)
-    tot_label = np.array([], dtype=int)
+    tot_pred = []
+    tot_label = []
+    confusion = ConfusionMeter(2)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     losses = AverageMeter()
@@ -378,6 +371,8 @@ def cls_eval(eval_data_loader, model, criterion, display):
     for num_iter, (image, label) in enumerate(eval_data_loader):
         data_time.update(time.time()-end)
         output = model(Variable(image.cuda()))
+        if store is not None:
+            store.update({'bin': output.cpu().data.numpy()}, {'bin': label.numpy()})
         loss = criterion(output, Variable(label.cuda()))
         _,pred = torch.max(output, 1)
         pred = pred.cpu().data.numpy().squeeze()
@@ -385,8 +380,9 @@ def cls_eval(eval_data_loader, model, criterion, display):
         losses.update(loss.data[0], len(image))
         batch_time.update(time.time()-end)
 
-        tot_pred = np.append(tot_pred, pred)
-        tot_label = np.append(tot_label, label)
+        tot_pred.append(pred)
+        tot_label.append(label)
+        confusion.update(label, pred)
 
         accuracy.update(np.equal(pred, label).sum()/len(label), len(label))
         end = time.time()
@@ -398,6 +394,9 @@ def cls_eval(eval_data_loader, model, criterion, display):
         logger.append(print_info)
         print(print_info)
 
+    tot_pred = np.hstack(tot_pred)
+    tot_label = np.hstack(tot_label)
+
     sensitivity, specificity, f1 = calc_sensitivity_specificity(tot_pred, tot_label)
     print_info1 = '\naccuracy:{0:.4f}\tsensitivity: {1:.4f}\t specificity: {2:.4f}\tf1 score: {3:.4f}\n'.format(accuracy.avg, sensitivity, specificity, f1)
     logger.append(print_info1)
@@ -488,7 +487,9 @@ def main():
             dataset_test = DataLoader(BinClsDataSetVal(opt.root, opt.testcsv, opt.size, opt.size, gcn=gcn), batch_size=opt.batch,
                                       num_workers=opt.workers,
                                       shuffle=False, pin_memory=False)
-            acc, logger_test = cls_eval(dataset_test, nn.DataParallel(model).cuda(), criterion, opt.display)
+            store = LogitWriter(os.path.join(output_dir, 'logits'))
+            acc, logger_test = cls_eval(dataset_test, nn.DataParallel(model).cuda(), criterion, opt.display, store=store)
+            store.close([dataset_test.dataset.images_list[i][0] for i in range(len(dataset_test.dataset))])
             with open(os.path.join(output_dir, 'test.log'), 'w') as fp:
                 fp.write('\n' + '\n'.join(logger_test))
                 fp.write('\n' + str(opt) + '\n')
@@ -1,13 +1,13 @@
 import json
 import torch.utils.data
 import numpy as np
-from PIL import Image
 import sys
 sys.path.append('../')
-from utils import TenCrop, HorizontalFlip, Affine, ColorJitter, Lighting, PILColorJitter
-from utils import AverageMeter, quadratic_weighted_kappa
+from utils import TenCrop, HorizontalFlip, Affine, ColorJitter, Lighting, PILColorJitter, LabelTable
+from image_decode import load_image
+from utils import AverageMeter, ConfusionMeter, RocMeter
+from logit_store import LogitWriter
 import torchvision.transforms as transforms
-import pandas as pd
 
 import argparse
 import os
@@ -67,10 +67,7 @@ class BinClsDataSet(torch.utils.data.Dataset):
         self.config = config
         self.crop_size = crop_size
         self.scale_size = scale_size
-        df = pd.DataFrame.from_csv(config)
-        self.images_list = []
-        for index, row in df.iterrows():
-            self.images_list.append(row)
+        self.images_list = LabelTable(config)
         with open('info.json', 'r') as fp:
             info = json.load(fp)
         mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
@@ -115,7 +112,7 @@ class BinClsDataSet(torch.utils.data.Dataset):
                 ])
 
     def __getitem__(self, item):
-        return self.transform(Image.open(os.path.join(self.root, self.images_list[item][0]+'_'+str(self.scale_size)+'.png'))), 0 if self.images_list[item][1] < 2 else 1, 0 if self.images_list[item][1] < 2 else 1, 0 if self.images_list[item][2] < 1 else 1
+        return self.transform(load_image(os.path.join(self.root, self.images_list[item][0]+'_'+str(self.scale_size)+'.png'))), 0 if self.images_list[item][1] < 2 else 1, 0 if self.images_list[item][1] < 2 else 1, 0 if self.images_list[item][2] < 1 else 1
 
     def __len__(self):
         return len(self.images_list)
@@ -127,10 +124,7 @@ class BinClsDataSetVal(torch.utils.data.Dataset):
         self.config = config
         self.crop_size = crop_size
         self.scale_size = scale_size
-        df = pd.DataFrame.from_csv(config)
-        self.images_list = []
-        for index, row in df.iterrows():
-            self.images_list.append(row)
+        self.images_list = LabelTable(config)
         with open('info.json', 'r') as fp:
             info = json.load(fp)
         mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
@@ -153,7 +147,7 @@ class BinClsDataSetVal(torch.utils.data.Dataset):
             ])
 
     def __getitem__(self, item):
-        return self.transform(Image.open(os.path.join(self.root, self.images_list[item][0]+'_'+str(self.scale_size)+'.png'))), 0 if self.images_list[item][1] < 2 else 1, 0 if self.images_list[item][1] < 2 else 1, 0 if self.images_list[item][2] < 1 else 1
+        return self.transform(load_image(os.path.join(self.root, self.images_list[item][0]+'_'+str(self.scale_size)+'.png'))), 0 if self.images_list[item][1] < 2 else 1, 0 if self.images_list[item][1] < 2 else 1, 0 if self.images_list[item][2] < 1 else 1
 
     def __len__(self):
         return len(self.images_list)
@@ -303,12 +297,9 @@ class multi_channel_model(nn.Module):
 def cls_train_3_task(train_data_loader, model, criterion, optimizer, epoch, display, ft_dme=False):
     model.train()
 
-    tot_pred_bin = np.array([], dtype=int)
-    tot_label_bin = np.array([], dtype=int)
-    tot_pred_dr = np.array([], dtype=int)
-    tot_label_dr = np.array([], dtype=int)
-    tot_pred_dme = np.array([], dtype=int)
-    tot_label_dme = np.array([], dtype=int)
+    confusion_bin = ConfusionMeter(2)
+    confusion_dr = ConfusionMeter(2)
+    confusion_dme = ConfusionMeter(2)
 
     batch_time = AverageMeter()
     data_time = AverageMeter()
@@ -345,12 +336,9 @@ def cls_train_3_task(train_data_loader, model, criterion, optimizer, epoch, disp
         pred_dme = pred_dme.cpu().data.numpy().squeeze()
         labels_dme = labels_dme.numpy().squeeze()
 
-        tot_pred_bin = np.append(tot_pred_bin, pred_bin)
-        tot_label_bin = np.append(tot_label_bin, labels_bin)
-        tot_pred_dr = np.append(tot_pred_dr, pred_dr)
-        tot_label_dr = np.append(tot_label_dr, labels_dr)
-        tot_pred_dme = np.append(tot_pred_dme, pred_dme)
-        tot_label_dme = np.append(tot_label_dme, labels_dme)
+        confusion_bin.update(labels_bin, pred_bin)
+        confusion_dr.update(labels_dr, pred_dr)
+        confusion_dme.update(labels_dme, pred_dme)
 
         losses.update(loss.data[0], len(images))
         accuracy_bin.update(np.equal(pred_bin, labels_bin).sum()/len(labels_bin), len(labels_bin))
@@ -359,9 +347,9 @@ def cls_train_3_task(train_data_loader, model, criterion, optimizer, epoch, disp
 
         end = time.time()
         if num_iter % display == 0:
-            correct_bin = np.equal(tot_pred_bin, tot_label_bin).sum()/len(tot_pred_bin)
-            correct_dr = np.equal(tot_pred_bin, tot_label_bin).sum() / len(tot_pred_bin)
-            correct_dme = np.equal(tot_pred_bin, tot_label_bin).sum() / len(tot_pred_bin)
+            correct_bin = confusion_bin.accuracy()
+            correct_dr = confusion_dr.accuracy()
+            correct_dme = confusion_dme.accuracy()
 
             print_info = 'Epoch: [{0}][{1}/{2}]\tTime {batch_time.val:3f} ({batch_time.avg:.3f})\t'\
                 'Data {data_time.avg:.3f}\t''Loss {loss.avg:.4f}\tDR Graded Accuray {accuracy_bin.avg:.4f}' \
@@ -377,8 +365,7 @@ def cls_train_3_task(train_data_loader, model, criterion, optimizer, epoch, disp
 
 def cls_train(train_data_loader, model, criterion, optimizer, epoch, display):
     model.train()
-    tot_pred = np.array([], dtype=int)
-    tot_label = np.array([], dtype=int)
+    confusion = ConfusionMeter(2)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     losses = AverageMeter()
@@ -396,13 +383,12 @@ def cls_train(train_data_loader, model, criterion, optimizer, epoch, display):
         _,pred = torch.max(output, 1)
         pred = pred.cpu().data.numpy().squeeze()
         labels = labels.numpy().squeeze()
-        tot_pred = np.append(tot_pred, pred)
-        tot_label = np.append(tot_label, labels)
+        confusion.update(labels, pred)
         losses.update(loss.data[0], len(images))
         accuracy.update(np.equal(pred, labels).sum()/len(labels), len(labels))
         end = time.time()
         if num_iter % display == 0:
-            correct = np.equal(tot_pred, tot_label).sum()/len(tot_pred)
+            correct = confusion.accuracy()
             print_info = 'Epoch: [{0}][{1}/{2}]\tTime {batch_time.val:3f} ({batch_time.avg:.3f})\t'\
                 'Data {data_time.avg:.3f}\t''Loss {loss.avg:.4f}\tAccuray {accuracy.avg:.4f}'.format(
                 epoch, num_iter, len(train_data_loader),batch_time=batch_time, data_time=data_time,
@@ -453,19 +439,22 @@ def calc_sensitivity_specificity(pred, label):
     return sensitivity, specificity, f1
 
 
-def cls_eval_3_task(eval_data_loader, model, criterion, display):
+def cls_eval_3_task(eval_data_loader, model, criterion, display, store=None):
     model.eval()
 
-    tot_pred_bin = np.array([], dtype=int)
-    tot_label_bin = np.array([], dtype=int)
-    tot_pred_dr = np.array([], dtype=int)
-    tot_label_dr = np.array([], dtype=int)
-    tot_pred_dme = np.array([], dtype=int)
-    tot_label_dme = np.array([], dtype=int)
+    tot_pred_bin = []
+    tot_label_bin = []
+    confusion_bin = ConfusionMeter(2)
+    tot_pred_dr = []
+    tot_label_dr = []
+    confusion_dr = ConfusionMeter(2)
+    tot_pred_dme = []
+    tot_label_dme = []
+    confusion_dme = ConfusionMeter(2)
 
-    tot_prob_bin = np.array([], dtype=float)
-    tot_prob_dr = np.array([], dtype=float)
-    tot_prob_dme = np.array([], dtype=float)
+    roc_bin = RocMeter()
+    roc_dr = RocMeter()
+    roc_dme = RocMeter()
 
     batch_time = AverageMeter()
     data_time = AverageMeter()
@@ -479,6 +468,9 @@ def cls_eval_3_task(eval_data_loader, model, criterion, display):
     for num_iter, (image, labels_bin, labels_dr, labels_dme) in enumerate(eval_data_loader):
         data_time.update(time.time()-end)
         o_bin, o_dr, o_dme = model(Variable(image.cuda()))
+        if store is not None:
+            store.update({'bin': o_bin.cpu().data.numpy(), 'dr': o_dr.cpu().data.numpy(), 'dme': o_dme.cpu().data.numpy()},
+                         {'bin': labels_bin.numpy(), 'dr': labels_dr.numpy(), 'dme': labels_dme.numpy()})
 
         loss_bin = criterion(o_bin, Variable(labels_bin.cuda()))
         loss_dr = criterion(o_dr, Variable(labels_dr.cuda()))
@@ -494,15 +486,15 @@ def cls_eval_3_task(eval_data_loader, model, criterion, display):
         prop = m(o_bin).data
         res_prop = prop.cpu().numpy()
         res_prop = res_prop[:, 1]
-        tot_prob_bin = np.append(tot_prob_bin, res_prop)
+        roc_bin.update(labels_bin.numpy(), res_prop)
         prop = m(o_dr).data
         res_prop = prop.cpu().numpy()
         res_prop = res_prop[:, 1]
-        tot_prob_dr = np.append(tot_prob_dr, res_prop)
+        roc_dr.update(labels_dr.numpy(), res_prop)
         prop = m(o_dme).data
         res_prop = prop.cpu().numpy()
         res_prop = res_prop[:, 1]
-        tot_prob_dme = np.append(tot_prob_dme, res_prop)
+        roc_dme.update(labels_dme.numpy(), res_prop)
 
         pred_bin = pred_bin.cpu().data.numpy().squeeze()
         labels_bin = labels_bin.numpy().squeeze()
@@ -511,12 +503,15 @@ def cls_eval_3_task(eval_data_loader, model, criterion, display):
         pred_dme = pred_dme.cpu().data.numpy().squeeze()
         labels_dme = labels_dme.numpy().squeeze()
 
-        tot_pred_bin = np.append(tot_pred_bin, pred_bin)
-        tot_label_bin = np.append(tot_label_bin, labels_bin)
-        tot_pred_dr = np.append(tot_pred_dr, pred_dr)
-        tot_label_dr = np.append(tot_label_dr, labels_dr)
-        tot_pred_dme = np.append(tot_pred_dme, pred_dme)
-        tot_label_dme = np.append(tot_label_dme, labels_dme)
+        tot_pred_bin.append(pred_bin)
+        tot_label_bin.append(labels_bin)
+        confusion_bin.update(labels_bin, pred_bin)
+        tot_pred_dr.append(pred_dr)
+        tot_label_dr.append(labels_dr)
+        confusion_dr.update(labels_dr, pred_dr)
+        tot_pred_dme.append(pred_dme)
+        tot_label_dme.append(labels_dme)
+        confusion_dme.update(labels_dme, pred_dme)
 
         batch_time.update(time.time()-end)
 
@@ -535,15 +530,20 @@ def cls_eval_3_task(eval_data_loader, model, criterion, display):
         logger.append(print_info)
         print(print_info)
 
-    from sklearn.metrics import roc_curve, auc
+    tot_pred_dr = np.hstack(tot_pred_dr)
+    tot_label_dr = np.hstack(tot_label_dr)
+    tot_pred_dme = np.hstack(tot_pred_dme)
+    tot_label_dme = np.hstack(tot_label_dme)
+    tot_pred_bin = np.hstack(tot_pred_bin)
+    tot_label_bin = np.hstack(tot_label_bin)
+
     # bin
-    fpr, tpr, _ = roc_curve(tot_label_bin, tot_prob_bin)
-    roc_auc = auc(fpr, tpr)
+    fpr, tpr, _ = roc_bin.curve()
+    roc_auc = roc_bin.auc()
     print('fpr: {}'.format(fpr))
     print('tpr: {}'.format(tpr))
     print('ground truth label: {}'.format(tot_label_bin))
-    print('probability label: {}'.format(tot_prob_bin))
-    print('roc_auc: {}'.format(roc_auc))
+    print('roc_auc: {} (+/- {:.5f})'.format(roc_auc, roc_bin.auc_error()))
 
     import matplotlib.pyplot as plt
 
@@ -575,13 +575,12 @@ def cls_eval_3_task(eval_data_loader, model, criterion, display):
     plt.show()
 
     # dr bin
-    fpr, tpr, _ = roc_curve(tot_label_dr, tot_prob_dr)
-    roc_auc = auc(fpr, tpr)
+    fpr, tpr, _ = roc_dr.curve()
+    roc_auc = roc_dr.auc()
     print('fpr: {}'.format(fpr))
     print('tpr: {}'.format(tpr))
     print('ground truth label: {}'.format(tot_label_dr))
-    print('probability label: {}'.format(tot_prob_dr))
-    print('roc_auc: {}'.format(roc_auc))
+    print('roc_auc: {} (+/- {:.5f})'.format(roc_auc, roc_dr.auc_error()))
 
     import matplotlib.pyplot as plt
 
@@ -613,13 +612,12 @@ def cls_eval_3_task(eval_data_loader, model, criterion, display):
     plt.show()
 
     # dme bin
-    fpr, tpr, _ = roc_curve(tot_label_dr, tot_prob_dr)
-    roc_auc = auc(fpr, tpr)
+    fpr, tpr, _ = roc_dme.curve()
+    roc_auc = roc_dme.auc()
     print('fpr: {}'.format(fpr))
     print('tpr: {}'.format(tpr))
-    print('ground truth label: {}'.format(tot_label_dr))
-    print('probability label: {}'.format(tot_prob_dr))
-    print('roc_auc: {}'.format(roc_auc))
+    print('ground truth label: {}'.format(tot_label_dme))
+    print('roc_auc: {} (+/- {:.5f})'.format(roc_auc, roc_dme.auc_error()))
 
     import matplotlib.pyplot as plt
 
@@ -674,8 +672,9 @@ def cls_eval_3_task(eval_data_loader, model, criterion, display):
 
 def cls_eval(eval_data_loader, model, criterion, display):
     model.eval()
-    tot_pred = np.array([], dtype=int)
-    tot_label = np.array([], dtype=int)
+    tot_pred = []
+    tot_label = []
+    confusion = ConfusionMeter(2)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     losses = AverageMeter()
@@ -692,8 +691,9 @@ def cls_eval(eval_data_loader, model, criterion, display):
         losses.update(loss.data[0], len(image))
         batch_time.update(time.time()-end)
 
-        tot_pred = np.append(tot_pred, pred)
-        tot_label = np.append(tot_label, label)
+        tot_pred.append(pred)
+        tot_label.append(label)
+        confusion.update(label, pred)
 
         accuracy.update(np.equal(pred, label).sum()/len(label), len(label))
         end = time.time()
@@ -705,6 +705,9 @@ def cls_eval(eval_data_loader, model, criterion, display):
         logger.append(print_info)
         print(print_info)
 
+    tot_pred = np.hstack(tot_pred)
+    tot_label = np.hstack(tot_label)
+
     sensitivity, specificity, f1 = calc_sensitivity_specificity(tot_pred, tot_label)
     print_info1 = '\naccuracy:{0:.4f}\tsensitivity: {1:.4f}\t specificity: {2:.4f}\tf1 score: {3:.4f}\n'.format(accuracy.avg, sensitivity, specificity, f1)
     logger.append(print_info1)
@@ -848,7 +851,9 @@ def main():
             dataset_test = DataLoader(BinClsDataSetVal(opt.root, opt.testcsv, opt.size, opt.size, gcn=gcn), batch_size=opt.batch,
                                       num_workers=opt.workers,
                                       shuffle=False, pin_memory=False)
-            acc, logger_test, _, _, _, _ = cls_eval_3_task(dataset_test, nn.DataParallel(model).cuda(), criterion, opt.display)
+            store = LogitWriter(os.path.join(output_dir, 'logits'))
+            acc, logger_test, _, _, _, _ = cls_eval_3_task(dataset_test, nn.DataParallel(model).cuda(), criterion, opt.display, store=store)
+            store.close([dataset_test.dataset.images_list[i][0] for i in range(len(dataset_test.dataset))])
             with open(os.path.join(output_dir, 'test.log'), 'w') as fp:
                 fp.write('\n' + '\n'.join(logger_test))
                 fp.write('\n' + str(opt) + '\n')
@@ -1,13 +1,14 @@
 import json
 import torch.utils.data
 import numpy as np
-from PIL import Image
 import sys
 sys.path.append('../')
-from utils import TenCrop, HorizontalFlip, Affine, ColorJitter, Lighting, PILColorJitter
-from utils import AverageMeter, quadratic_weighted_kappa
+from utils import TenCrop, HorizontalFlip, Affine, ColorJitter, Lighting, PILColorJitter, LabelTable
+from image_decode import load_image
+from utils import AverageMeter, ConfusionMeter, threshold_sweep, threshold_for_sensitivity, save_operating_point, load_operating_point
+from logit_store import LogitWriter
+from image_cache import SharedImageCache, open_image
 import torchvision.transforms as transforms
-import pandas as pd
 
 import argparse
 import os
@@ -50,9 +51,12 @@ def parse_args():
     parser.add_argument('--epoch', default=300, type=int)
     parser.add_argument('--display', default=10, type=int, help='The frequency of print log')
     parser.add_argument('--seed', default=111, type=int)
+    parser.add_argument('--cache', default=0, type=float, help='GB of shared memory for decoded validation images, 0 disables the cache')
     parser.add_argument('--workers', default=4, type=int)
     parser.add_argument('--baseline', action='store_true')
     parser.add_argument('--output', default='output', help='The output dir')
+    parser.add_argument('--sensitivity', default=0.95, type=float, help='The target sensitivity of the referable operating point')
+    parser.add_argument('--threshold', default=None, type=float, help='The referable threshold, defaults to the one stored next to --weight, else 0.5 (argmax)')
 
     return parser.parse_args()
 
@@ -67,10 +71,7 @@ class BinClsDataSet(torch.utils.data.Dataset):
         self.config = config
         self.crop_size = crop_size
         self.scale_size = scale_size
-        df = pd.DataFrame.from_csv(config)
-        self.images_list = []
-        for index, row in df.iterrows():
-            self.images_list.append(row)
+        self.images_list = LabelTable(config)
         with open('info.json', 'r') as fp:
             info = json.load(fp)
         mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
@@ -115,22 +116,19 @@ class BinClsDataSet(torch.utils.data.Dataset):
                 ])
 
     def __getitem__(self, item):
-        return self.transform(Image.open(os.path.join(self.root, self.images_list[item][0]+'_'+str(self.scale_size)+'.png'))), self.images_list[item][3]
+        return self.transform(load_image(os.path.join(self.root, self.images_list[item][0]+'_'+str(self.scale_size)+'.png'))), self.images_list[item][3]
 
     def __len__(self):
         return len(self.images_list)
 
 class BinClsDataSetVal(torch.utils.data.Dataset):
-    def __init__(self, root, config, crop_size, scale_size, baseline=False, gcn=True):
+    def __init__(self, root, config, crop_size, scale_size, baseline=False, gcn=True, cache_bytes=0):
         super(BinClsDataSetVal, self).__init__()
         self.root = root
         self.config = config
         self.crop_size = crop_size
         self.scale_size = scale_size
-        df = pd.DataFrame.from_csv(config)
-        self.images_list = []
-        for index, row in df.iterrows():
-            self.images_list.append(row)
+        self.images_list = LabelTable(config)
         with open('info.json', 'r') as fp:
             info = json.load(fp)
         mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
@@ -152,8 +150,11 @@ class BinClsDataSetVal(torch.utils.data.Dataset):
                 transforms.Normalize(mean=mean_values, std=std_values),
             ])
 
+        # decoded images shared by the loader workers and kept across epochs
+        self.cache = SharedImageCache(len(self.images_list), cache_bytes, (scale_size, scale_size, 3)) if cache_bytes > 0 else None
+
     def __getitem__(self, item):
-        return self.transform(Image.open(os.path.join(self.root, self.images_list[item][0]+'_'+str(self.scale_size)+'.png'))), self.images_list[item][3]
+        return self.transform(open_image(os.path.join(self.root, self.images_list[item][0]+'_'+str(self.scale_size)+'.png'), self.cache, item)), self.images_list[item][3]
 
     def __len__(self):
         return len(self.images_list)
@@ -288,8 +289,7 @@ class multi_channel_model(nn.Module):
 
 def cls_train(train_data_loader, model, criterion, optimizer, epoch, display):
     model.train()
-    tot_pred = np.array([], dtype=int)
-    tot_label = np.array([], dtype=int)
+    confusion = ConfusionMeter(2)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     losses = AverageMeter()
@@ -313,13 +313,12 @@ def cls_train(train_data_loader, model, criterion, optimizer, epoch, display):
         _,pred = torch.max(output, 1)
         pred = pred.cpu().data.numpy().squeeze()
         labels = labels.numpy().squeeze()
-        tot_pred = np.append(tot_pred, pred)
-        tot_label = np.append(tot_label, labels)
+        confusion.update(labels, pred)
         losses.update(loss.data[0], len(images))
         accuracy.update(np.equal(pred, labels).sum()/len(labels), len(labels))
         end = time.time()
         if num_iter % display == 0:
-            correct = np.equal(tot_pred, tot_label).sum()/len(tot_pred)
+            correct = confusion.accuracy()
             print_info = 'Epoch: [{0}][{1}/{2}]\tTime {batch_time.val:3f} ({batch_time.avg:.3f})\t'\
                 'Data {data_time.avg:.3f}\t''Loss {loss.avg:.4f}\tAccuray {accuracy.avg:.4f}'.format(
                 epoch, num_iter, len(train_data_loader),batch_time=batch_time, data_time=data_time,
@@ -344,23 +343,12 @@ f1 score:
 '''
 def calc_sensitivity_specificity(pred, label):
     assert len(pred) == len(label)
-    tp_cnt = 0
-    tn_cnt = 0
-    fp_cnt = 0
-    fn_cnt = 0
-    # print(pred)
-    # print(label)
-    for i in range(0, len(pred)):
-        if pred[i] == 1:
-            if label[i] == 1:
-                tp_cnt += 1
-            else:
-                fp_cnt += 1
-        else:
-            if label[i] == 1:
-                fn_cnt += 1
-            else:
-                tn_cnt += 1
+    pred = np.asarray(pred).ravel() == 1
+    label = np.asarray(label).ravel() == 1
+    tp_cnt = int(np.sum(pred & label))
+    fp_cnt = int(np.sum(pred & ~label))
+    fn_cnt = int(np.sum(~pred & label))
+    tn_cnt = int(np.sum(~pred & ~label))
 
     sensitivity = tp_cnt/(tp_cnt+fn_cnt) if (tp_cnt+fn_cnt)>0 else 0
     specificity = tn_cnt/(tn_cnt+fp_cnt) if (tn_cnt+fp_cnt)>0 else 0
@@ -369,10 +357,12 @@ def calc_sensitivity_specificity(pred, label):
     return sensitivity, specificity, f1
 
 
-def cls_eval(eval_data_loader, model, criterion, display):
+def cls_eval(eval_data_loader, model, criterion, display, target_sensitivity=0.95, threshold=None, fit_threshold=True, store=None):
     model.eval()
-    tot_pred = np.array([], dtype=int)
-    tot_label = np.array([], dtype=int)
+    tot_pred = []
+    tot_label = []
+    tot_prob = []
+    confusion = ConfusionMeter(2)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     losses = AverageMeter()
@@ -382,15 +372,20 @@ def cls_eval(eval_data_loader, model, criterion, display):
     for num_iter, (image, label) in enumerate(eval_data_loader):
         data_time.update(time.time()-end)
         output = model(Variable(image.cuda()))
+        if store is not None:
+            store.update({'bin': output.cpu().data.numpy()}, {'bin': label.numpy()})
         loss = criterion(output, Variable(label.cuda()))
         _,pred = torch.max(output, 1)
+        prob = F.softmax(output).data.cpu().numpy()[:, 1]
         pred = pred.cpu().data.numpy().squeeze()
         label = label.numpy().squeeze()
         losses.update(loss.data[0], len(image))
         batch_time.update(time.time()-end)
 
-        tot_pred = np.append(tot_pred, pred)
-        tot_label = np.append(tot_label, label)
+        tot_prob.append(prob)
+        tot_pred.append(pred)
+        tot_label.append(label)
+        confusion.update(label, pred)
 
         accuracy.update(np.equal(pred, label).sum()/len(label), len(label))
         end = time.time()
@@ -402,12 +397,34 @@ def cls_eval(eval_data_loader, model, criterion, display):
         logger.append(print_info)
         print(print_info)
 
+    tot_pred = np.hstack(tot_pred)
+    tot_label = np.hstack(tot_label)
+    tot_prob = np.hstack(tot_prob)
+
     sensitivity, specificity, f1 = calc_sensitivity_specificity(tot_pred, tot_label)
     print_info1 = '\naccuracy:{0:.4f}\tsensitivity: {1:.4f}\t specificity: {2:.4f}\tf1 score: {3:.4f}\n'.format(accuracy.avg, sensitivity, specificity, f1)
     logger.append(print_info1)
     print(print_info1)
 
-    return accuracy.avg, logger
+    # operating point: the given threshold, or the strictest one reaching the target sensitivity on this
+    # (validation) set; a test set never fits its own threshold, it falls back to the argmax one
+    if threshold is None and fit_threshold:
+        threshold, _ = threshold_for_sensitivity(tot_label, tot_prob, target_sensitivity)
+    elif threshold is None:
+        threshold = 0.5
+        print_info = '\n[operating point]\tno --threshold and no operating point stored with the weights, ' \
+                     'reporting the argmax threshold 0.5 instead of fitting one on the evaluation set'
+        logger.append(print_info)
+        print(print_info)
+    sensitivity, specificity, f1 = calc_sensitivity_specificity((tot_prob >= threshold).astype(int), tot_label)
+    sweep = threshold_sweep(tot_label, tot_prob)
+    print_info2 = '\n[operating point]\tthreshold: {0:.6f}\tsensitivity: {1:.4f}\t specificity: {2:.4f}\tf1 score: {3:.4f}' \
+                  '\t(best f1 {4:.4f} at threshold {5:.6f})\n'.format(threshold, sensitivity, specificity, f1,
+                                                                   sweep['f1'].max(), sweep['threshold'][sweep['f1'].argmax()])
+    logger.append(print_info2)
+    print(print_info2)
+
+    return accuracy.avg, logger, threshold
 
 def main():
     print('===> Parsing options')
@@ -443,7 +460,7 @@ def main():
 
         dataset_train = DataLoader(BinClsDataSet(opt.root, opt.traincsv, opt.crop, opt.size, gcn=gcn), batch_size=opt.batch, num_workers=opt.workers,
                              shuffle=True, pin_memory=True)
-        dataset_val = DataLoader(BinClsDataSetVal(opt.root, opt.valcsv, opt.crop, opt.size, gcn=gcn), batch_size=opt.batch,
+        dataset_val = DataLoader(BinClsDataSetVal(opt.root, opt.valcsv, opt.crop, opt.size, gcn=gcn, cache_bytes=int(opt.cache * (1 << 30))), batch_size=opt.batch,
                              num_workers=opt.workers,
                              shuffle=False, pin_memory=False)
         accuracy_best = 0
@@ -473,12 +490,16 @@ def main():
 
             logger = cls_train(dataset_train, nn.DataParallel(model).cuda(), criterion, optimizer, epoch, opt.display)
 
-            acc, logger_val = cls_eval(dataset_val, nn.DataParallel(model).cuda(), criterion, opt.display)
+            acc, logger_val, threshold = cls_eval(dataset_val, nn.DataParallel(model).cuda(), criterion, opt.display, opt.sensitivity)
+            if dataset_val.dataset.cache is not None:
+                print('====> Val image cache: {}'.format(dataset_val.dataset.cache.stats()))
 
             if acc > accuracy_best:
                 print('\ncurrent best accuracy is: {}\n'.format(acc))
                 accuracy_best = acc
                 torch.save(model.cpu().state_dict(), os.path.join(output_dir, opt.dataset+'_binarycls_'+opt.model+'_%03d'%epoch+'_best.pth'))
+                save_operating_point(os.path.join(output_dir, opt.dataset+'_binarycls_'+opt.model+'_%03d'%epoch+'_best.pth'), threshold,
+                                     target_sensitivity=opt.sensitivity)
                 print('====> Save model: {}'.format(os.path.join(output_dir, opt.dataset+'_binarycls_'+opt.model+'_%03d'%epoch+'_best.pth')))
             if not os.path.isfile(os.path.join(output_dir, 'train.log')):
                 with open(os.path.join(output_dir, 'train.log'), 'w') as fp:
@@ -492,11 +513,16 @@ def main():
             dataset_test = DataLoader(BinClsDataSetVal(opt.root, opt.testcsv, opt.size, opt.size, gcn=gcn), batch_size=opt.batch,
                                       num_workers=opt.workers,
                                       shuffle=False, pin_memory=False)
-            acc, logger_test = cls_eval(dataset_test, nn.DataParallel(model).cuda(), criterion, opt.display)
+            threshold = opt.threshold if opt.threshold is not None else load_operating_point(opt.weight)
+            store = LogitWriter(os.path.join(output_dir, 'logits'))
+            acc, logger_test, threshold = cls_eval(dataset_test, nn.DataParallel(model).cuda(), criterion, opt.display,
+                                                   opt.sensitivity, threshold, fit_threshold=False, store=store)
+            store.close([dataset_test.dataset.images_list[i][0] for i in range(len(dataset_test.dataset))])
             with open(os.path.join(output_dir, 'test.log'), 'w') as fp:
                 fp.write('\n' + '\n'.join(logger_test))
                 fp.write('\n' + str(opt) + '\n')
                 fp.write('\n====> Accuracy: %.4f' % acc)
+                fp.write('\n====> Threshold: %.6f' % threshold)
             print('\n====> Accuracy: %.4f' % acc)
         else:
             raise Exception('No weights found!')
@@ -3,8 +3,8 @@ sys.path.append('../')
 import torch
 import json
 import torchvision.transforms as transforms
-from utils import PILColorJitter, Lighting
-from PIL import Image
+from utils import PILColorJitter, Lighting, LabelTable
+from image_decode import load_image, load_square
 import os
 import pandas as pd
 import numpy as np
@@ -22,7 +22,8 @@ import math
 
 import torch.optim as optim
 
-from utils import quadratic_weighted_kappa, kappa_confusion_matrix, AverageMeter
+from utils import ConfusionMeter, JointMeter, kappa_confusion_matrix, AverageMeter, binary_metrics
+from logit_store import LogitWriter
 from sklearn.metrics import confusion_matrix
 import time
 
@@ -71,10 +72,7 @@ class MultiTaskClsDataSet(torch.utils.data.Dataset):
         self.crop_size = crop_size
         self.scale_size = scale_size
         self.baseline = baseline
-        df = pd.DataFrame.from_csv(config)
-        self.images_list = []
-        for index, row in df.iterrows():
-            self.images_list.append(row)
+        self.images_list = LabelTable(config)
         with open('info.json', 'r') as fp:
             info = json.load(fp)
         mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
@@ -100,7 +98,7 @@ class MultiTaskClsDataSet(torch.utils.data.Dataset):
 
     def __getitem__(self, item):
         return self.transform(
-            Image.open(os.path.join(self.root, str(self.images_list[item][0]) + '_' + str(self.scale_size) + '.png'))), \
+            load_image(os.path.join(self.root, str(self.images_list[item][0]) + '_' + str(self.scale_size) + '.png'))), \
                self.images_list[item][1], self.images_list[item][2], self.images_list[item][3]
 
     def __len__(self):
@@ -113,10 +111,7 @@ class MultiTaskClsValDataSet(torch.utils.data.Dataset):
         self.config = config
         self.crop_size = crop_size
         self.scale_size = scale_size
-        df = pd.DataFrame.from_csv(config)
-        self.images_list = []
-        for index, row in df.iterrows():
-            self.images_list.append(row)
+        self.images_list = LabelTable(config)
         with open('info.json', 'r') as fp:
             info = json.load(fp)
         mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
@@ -131,7 +126,7 @@ class MultiTaskClsValDataSet(torch.utils.data.Dataset):
         ])
 
     def __getitem__(self, item):
-        return self.transform(Image.open(os.path.join(self.root, str(self.images_list[item][0])+'_'+str(self.scale_size)+'.png'))), self.images_list[item][1], self.images_list[item][2], self.images_list[item][3]
+        return self.transform(load_image(os.path.join(self.root, str(self.images_list[item][0])+'_'+str(self.scale_size)+'.png'))), self.images_list[item][1], self.images_list[item][2], self.images_list[item][3]
 
     def __len__(self):
         return len(self.images_list)
@@ -161,31 +156,8 @@ class MultiTaskClsInferenceDataSet(torch.utils.data.Dataset):
         return len(self.images_list)
 
     def _scale_image(self, imagepath, scale_size):
-        # image = Image.open(os.path.join(root, '{}.jpg'.format(index)))
-        image = Image.open(imagepath)
-        w, h = image.size
-        tw, th = (min(w, h), min(w, h))
-        image = image.crop((w // 2 - tw // 2, h // 2 - th // 2, w // 2 + tw // 2, h // 2 + th // 2))
-        w, h = image.size
-        tw, th = (scale_size, scale_size)
-        ratio = tw / w
-        assert ratio == th / h
-        if ratio < 1:
-            image = image.resize((tw, th), Image.ANTIALIAS)
-        elif ratio > 1:
-            image = image.resize((tw, th), Image.CUBIC)
-        w, h = image.size
-        tw, th = (min(w, h), min(w, h))
-        image = image.crop((w // 2 - tw // 2, h // 2 - th // 2, w // 2 + tw // 2, h // 2 + th // 2))
-        w, h = image.size
-        tw, th = (scale_size, scale_size)
-        ratio = tw / w
-        assert ratio == th / h
-        if ratio < 1:
-            image = image.resize((tw, th), Image.ANTIALIAS)
-        elif ratio > 1:
-            image = image.resize((tw, th), Image.CUBIC)
-        return image
+        # centered square crop resized to scale_size, the JPEG is decoded at a reduced DCT scale near scale_size
+        return load_square(imagepath, scale_size)
 
 def initialize_cls_weights(cls):
 	for m in cls.modules():
@@ -322,10 +294,8 @@ def model_test():
 
 def train(train_data_loader, model, criterion, optimizer, epoch, display):
     model.train()
-    tot_pred_dr = np.array([], dtype=int)
-    tot_label_dr = np.array([], dtype=int)
-    tot_pred_dme = np.array([], dtype=int)
-    tot_label_dme = np.array([], dtype=int)
+    confusion_dr = ConfusionMeter(5)
+    confusion_dme = ConfusionMeter(4)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     accuracy = AverageMeter()
@@ -351,10 +321,8 @@ def train(train_data_loader, model, criterion, optimizer, epoch, display):
         pred_dme = pred_dme.cpu().data.numpy().squeeze()
         label_dme = label_dme.numpy().squeeze()
 
-        tot_pred_dr = np.append(tot_pred_dr, pred_dr)
-        tot_label_dr = np.append(tot_label_dr, label_dr)
-        tot_pred_dme = np.append(tot_pred_dme, pred_dme)
-        tot_label_dme = np.append(tot_label_dme, label_dme)
+        confusion_dr.update(label_dr, pred_dr)
+        confusion_dme.update(label_dme, pred_dme)
 
         #precision
         losses_dr.update(loss_dr.data[0], len(image))
@@ -363,10 +331,10 @@ def train(train_data_loader, model, criterion, optimizer, epoch, display):
 
 
         if index % display == 0:
-            dr_accuracy = np.equal(tot_pred_dr, tot_label_dr).sum()/len(tot_pred_dr)
-            dme_accuracy = np.equal(tot_pred_dme, tot_label_dme).sum()/len(tot_pred_dme)
-            dr_kappa = quadratic_weighted_kappa(tot_label_dr, tot_pred_dr)
-            dme_kappa = quadratic_weighted_kappa(tot_label_dme, tot_pred_dme)
+            dr_accuracy = confusion_dr.accuracy()
+            dme_accuracy = confusion_dme.accuracy()
+            dr_kappa = confusion_dr.kappa()
+            dme_kappa = confusion_dme.kappa()
             print_info = 'Epoch: [{epoch}][{iter}/{tot}]\t' \
                          'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t' \
                          'Data {data_time.avg:.3f}\t ' \
@@ -393,12 +361,9 @@ def train(train_data_loader, model, criterion, optimizer, epoch, display):
 
 def train_dr(train_data_loader, model, criterion, optimizer, epoch, display):
     model.train()
-    tot_pred_dr = np.array([], dtype=int)
-    tot_label_dr = np.array([], dtype=int)
-    tot_pred_dme = np.array([], dtype=int)
-    tot_label_dme = np.array([], dtype=int)
-    tot_pred_bin = np.array([], dtype=int)
-    tot_label_bin = np.array([], dtype=int)
+    confusion_dr = ConfusionMeter(5)
+    confusion_dme = ConfusionMeter(4)
+    confusion_bin = ConfusionMeter(2)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     accuracy = AverageMeter()
@@ -430,12 +395,9 @@ def train_dr(train_data_loader, model, criterion, optimizer, epoch, display):
         pred_bin = pred_bin.cpu().data.numpy().squeeze()
         label_bin = label_bin.numpy().squeeze()
 
-        tot_pred_dr = np.append(tot_pred_dr, pred_dr)
-        tot_label_dr = np.append(tot_label_dr, label_dr)
-        tot_pred_dme = np.append(tot_pred_dme, pred_dme)
-        tot_label_dme = np.append(tot_label_dme, label_dme)
-        tot_pred_bin = np.append(tot_pred_bin, pred_bin)
-        tot_label_bin = np.append(tot_label_bin, label_bin)
+        confusion_dr.update(label_dr, pred_dr)
+        confusion_dme.update(label_dme, pred_dme)
+        confusion_bin.update(label_bin, pred_bin)
 
 
         #precision
@@ -448,10 +410,10 @@ def train_dr(train_data_loader, model, criterion, optimizer, epoch, display):
 
 
         if index % display == 0:
-            dr_accuracy = np.equal(tot_pred_dr, tot_label_dr).sum()/len(tot_pred_dr)
-            dme_accuracy = np.equal(tot_pred_dme, tot_label_dme).sum()/len(tot_pred_dme)
-            dr_kappa = quadratic_weighted_kappa(tot_label_dr, tot_pred_dr)
-            dme_kappa = quadratic_weighted_kappa(tot_label_dme, tot_pred_dme)
+            dr_accuracy = confusion_dr.accuracy()
+            dme_accuracy = confusion_dme.accuracy()
+            dr_kappa = confusion_dr.kappa()
+            dme_kappa = confusion_dme.kappa()
             print_info = 'Epoch: [{epoch}][{iter}/{tot}]\t' \
                          'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t' \
                          'Data {data_time.avg:.3f}\t ' \
@@ -481,12 +443,9 @@ def train_dr(train_data_loader, model, criterion, optimizer, epoch, display):
 
 def train_dr_and_dme(train_data_loader, model, criterion, optimizer, epoch, display):
     model.train()
-    tot_pred_dr = np.array([], dtype=int)
-    tot_label_dr = np.array([], dtype=int)
-    tot_pred_dme = np.array([], dtype=int)
-    tot_label_dme = np.array([], dtype=int)
-    tot_pred_bin = np.array([], dtype=int)
-    tot_label_bin = np.array([], dtype=int)
+    confusion_dr = ConfusionMeter(5)
+    confusion_dme = ConfusionMeter(4)
+    confusion_bin = ConfusionMeter(2)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     accuracy = AverageMeter()
@@ -518,12 +477,9 @@ def train_dr_and_dme(train_data_loader, model, criterion, optimizer, epoch, disp
         pred_bin = pred_bin.cpu().data.numpy().squeeze()
         label_bin = label_bin.numpy().squeeze()
 
-        tot_pred_dr = np.append(tot_pred_dr, pred_dr)
-        tot_label_dr = np.append(tot_label_dr, label_dr)
-        tot_pred_dme = np.append(tot_pred_dme, pred_dme)
-        tot_label_dme = np.append(tot_label_dme, label_dme)
-        tot_pred_bin = np.append(tot_pred_bin, pred_bin)
-        tot_label_bin = np.append(tot_label_bin, label_bin)
+        confusion_dr.update(label_dr, pred_dr)
+        confusion_dme.update(label_dme, pred_dme)
+        confusion_bin.update(label_bin, pred_bin)
 
 
         #precision
@@ -536,10 +492,10 @@ def train_dr_and_dme(train_data_loader, model, criterion, optimizer, epoch, disp
 
 
         if index % display == 0:
-            dr_accuracy = np.equal(tot_pred_dr, tot_label_dr).sum()/len(tot_pred_dr)
-            dme_accuracy = np.equal(tot_pred_dme, tot_label_dme).sum()/len(tot_pred_dme)
-            dr_kappa = quadratic_weighted_kappa(tot_label_dr, tot_pred_dr)
-            dme_kappa = quadratic_weighted_kappa(tot_label_dme, tot_pred_dme)
+            dr_accuracy = confusion_dr.accuracy()
+            dme_accuracy = confusion_dme.accuracy()
+            dr_kappa = confusion_dr.kappa()
+            dme_kappa = confusion_dme.kappa()
             print_info = 'Epoch: [{epoch}][{iter}/{tot}]\t' \
                          'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t' \
                          'Data {data_time.avg:.3f}\t ' \
@@ -569,12 +525,9 @@ def train_dr_and_dme(train_data_loader, model, criterion, optimizer, epoch, disp
 
 def train_dme(train_data_loader, model, criterion, optimizer, epoch, display):
     model.train()
-    tot_pred_dr = np.array([], dtype=int)
-    tot_label_dr = np.array([], dtype=int)
-    tot_pred_dme = np.array([], dtype=int)
-    tot_label_dme = np.array([], dtype=int)
-    tot_pred_bin = np.array([], dtype=int)
-    tot_label_bin = np.array([], dtype=int)
+    confusion_dr = ConfusionMeter(5)
+    confusion_dme = ConfusionMeter(4)
+    confusion_bin = ConfusionMeter(2)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     accuracy = AverageMeter()
@@ -606,12 +559,9 @@ def train_dme(train_data_loader, model, criterion, optimizer, epoch, display):
         pred_bin = pred_bin.cpu().data.numpy().squeeze()
         label_bin = label_bin.numpy().squeeze()
 
-        tot_pred_dr = np.append(tot_pred_dr, pred_dr)
-        tot_label_dr = np.append(tot_label_dr, label_dr)
-        tot_pred_dme = np.append(tot_pred_dme, pred_dme)
-        tot_label_dme = np.append(tot_label_dme, label_dme)
-        tot_pred_bin = np.append(tot_pred_bin, pred_bin)
-        tot_label_bin = np.append(tot_label_bin, label_bin)
+        confusion_dr.update(label_dr, pred_dr)
+        confusion_dme.update(label_dme, pred_dme)
+        confusion_bin.update(label_bin, pred_bin)
 
 
         #precision
@@ -624,10 +574,10 @@ def train_dme(train_data_loader, model, criterion, optimizer, epoch, display):
 
 
         if index % display == 0:
-            dr_accuracy = np.equal(tot_pred_dr, tot_label_dr).sum()/len(tot_pred_dr)
-            dme_accuracy = np.equal(tot_pred_dme, tot_label_dme).sum()/len(tot_pred_dme)
-            dr_kappa = quadratic_weighted_kappa(tot_label_dr, tot_pred_dr)
-            dme_kappa = quadratic_weighted_kappa(tot_label_dme, tot_pred_dme)
+            dr_accuracy = confusion_dr.accuracy()
+            dme_accuracy = confusion_dme.accuracy()
+            dr_kappa = confusion_dr.kappa()
+            dme_kappa = confusion_dme.kappa()
             print_info = 'Epoch: [{epoch}][{iter}/{tot}]\t' \
                          'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t' \
                          'Data {data_time.avg:.3f}\t ' \
@@ -657,12 +607,9 @@ def train_dme(train_data_loader, model, criterion, optimizer, epoch, display):
 
 def train_bin(train_data_loader, model, criterion, optimizer, epoch, display, dme_weight_aug_ratio=1):
     model.train()
-    tot_pred_dr = np.array([], dtype=int)
-    tot_label_dr = np.array([], dtype=int)
-    tot_pred_dme = np.array([], dtype=int)
-    tot_label_dme = np.array([], dtype=int)
-    tot_pred_bin = np.array([], dtype=int)
-    tot_label_bin = np.array([], dtype=int)
+    confusion_dr = ConfusionMeter(5)
+    confusion_dme = ConfusionMeter(4)
+    confusion_bin = ConfusionMeter(2)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     accuracy = AverageMeter()
@@ -708,12 +655,9 @@ def train_bin(train_data_loader, model, criterion, optimizer, epoch, display, dm
         pred_bin = pred_bin.cpu().data.numpy().squeeze()
         label_bin = label_bin.numpy().squeeze()
 
-        tot_pred_dr = np.append(tot_pred_dr, pred_dr)
-        tot_label_dr = np.append(tot_label_dr, label_dr)
-        tot_pred_dme = np.append(tot_pred_dme, pred_dme)
-        tot_label_dme = np.append(tot_label_dme, label_dme)
-        tot_pred_bin = np.append(tot_pred_bin, pred_bin)
-        tot_label_bin = np.append(tot_label_bin, label_bin)
+        confusion_dr.update(label_dr, pred_dr)
+        confusion_dme.update(label_dme, pred_dme)
+        confusion_bin.update(label_bin, pred_bin)
 
 
         #precision
@@ -726,10 +670,10 @@ def train_bin(train_data_loader, model, criterion, optimizer, epoch, display, dm
 
 
         if index % display == 0:
-            dr_accuracy = np.equal(tot_pred_dr, tot_label_dr).sum()/len(tot_pred_dr)
-            dme_accuracy = np.equal(tot_pred_dme, tot_label_dme).sum()/len(tot_pred_dme)
-            dr_kappa = quadratic_weighted_kappa(tot_label_dr, tot_pred_dr)
-            dme_kappa = quadratic_weighted_kappa(tot_label_dme, tot_pred_dme)
+            dr_accuracy = confusion_dr.accuracy()
+            dme_accuracy = confusion_dme.accuracy()
+            dr_kappa = confusion_dr.kappa()
+            dme_kappa = confusion_dme.kappa()
             print_info = 'Epoch: [{epoch}][{iter}/{tot}]\t' \
                          'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t' \
                          'Data {data_time.avg:.3f}\t ' \
@@ -759,10 +703,12 @@ def train_bin(train_data_loader, model, criterion, optimizer, epoch, display, dm
 
 def eval(eval_data_loader, model, criterion):
     model.eval()
-    tot_pred_dr = np.array([], dtype=int)
-    tot_label_dr = np.array([], dtype=int)
-    tot_pred_dme = np.array([], dtype=int)
-    tot_label_dme = np.array([], dtype=int)
+    tot_pred_dr = []
+    tot_label_dr = []
+    confusion_dr = ConfusionMeter(5)
+    tot_pred_dme = []
+    tot_label_dme = []
+    confusion_dme = ConfusionMeter(4)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     accuracy = AverageMeter()
@@ -785,20 +731,22 @@ def eval(eval_data_loader, model, criterion):
         pred_dme = pred_dme.cpu().data.numpy().squeeze()
         label_dme = label_dme.numpy().squeeze()
 
-        tot_pred_dr = np.append(tot_pred_dr, pred_dr)
-        tot_label_dr = np.append(tot_label_dr, label_dr)
-        tot_pred_dme = np.append(tot_pred_dme, pred_dme)
-        tot_label_dme = np.append(tot_label_dme, label_dme)
+        tot_pred_dr.append(pred_dr)
+        tot_label_dr.append(label_dr)
+        confusion_dr.update(label_dr, pred_dr)
+        tot_pred_dme.append(pred_dme)
+        tot_label_dme.append(label_dme)
+        confusion_dme.update(label_dme, pred_dme)
 
         #precision
         losses_dr.update(loss_dr.data[0], len(image))
         losses_dme.update(loss_dme.data[0], len(image))
         losses.update(loss.data[0], len(image))
 
-        dr_accuracy = np.equal(tot_pred_dr, tot_label_dr).sum() / len(tot_pred_dr)
-        dme_accuracy = np.equal(tot_pred_dme, tot_label_dme).sum() / len(tot_pred_dme)
-        dr_kappa = quadratic_weighted_kappa(tot_label_dr, tot_pred_dr)
-        dme_kappa = quadratic_weighted_kappa(tot_label_dme, tot_pred_dme)
+        dr_accuracy = confusion_dr.accuracy()
+        dme_accuracy = confusion_dme.accuracy()
+        dr_kappa = confusion_dr.kappa()
+        dme_kappa = confusion_dme.kappa()
         print_info = 'Eval: [{iter}/{tot}]\t' \
                      'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t' \
                      'Data {data_time.avg:.3f}\t ' \
@@ -822,6 +770,11 @@ def eval(eval_data_loader, model, criterion):
         print(print_info)
         logger.append(print_info)
 
+    tot_pred_dr = np.hstack(tot_pred_dr)
+    tot_label_dr = np.hstack(tot_label_dr)
+    tot_pred_dme = np.hstack(tot_pred_dme)
+    tot_label_dme = np.hstack(tot_label_dme)
+
     return logger, dr_kappa, dme_kappa, tot_pred_dr, tot_label_dr, tot_pred_dme, tot_label_dme
 
 '''
@@ -860,14 +813,19 @@ def calc_sensitivity_specificity(pred, label):
 
     return sensitivity, specificity, f1
 
-def eval_bin(eval_data_loader, model, criterion):
+def eval_bin(eval_data_loader, model, criterion, store=None):
     model.eval()
-    tot_pred_dr = np.array([], dtype=int)
-    tot_label_dr = np.array([], dtype=int)
-    tot_pred_dme = np.array([], dtype=int)
-    tot_label_dme = np.array([], dtype=int)
-    tot_pred_bin = np.array([], dtype=int)
-    tot_label_bin = np.array([], dtype=int)
+    tot_pred_dr = []
+    tot_label_dr = []
+    confusion_dr = ConfusionMeter(5)
+    tot_pred_dme = []
+    tot_label_dme = []
+    confusion_dme = ConfusionMeter(4)
+    tot_pred_bin = []
+    tot_label_bin = []
+    confusion_bin = ConfusionMeter(2)
+    # (DR prediction, DME prediction, To_Treat label) counts for the referable rules
+    joint = JointMeter((5, 4, 2))
     batch_time = AverageMeter()
     data_time = AverageMeter()
     accuracy = AverageMeter()
@@ -880,6 +838,9 @@ def eval_bin(eval_data_loader, model, criterion):
     for index, (image, label_dr, label_dme, label_bin) in enumerate(eval_data_loader):
         data_time.update(time.time()-end)
         o_dr, o_dme, o_bin = model(Variable(image.cuda()))
+        if store is not None:
+            store.update({'dr': o_dr.cpu().data.numpy(), 'dme': o_dme.cpu().data.numpy(), 'bin': o_bin.cpu().data.numpy()},
+                         {'dr': label_dr.numpy(), 'dme': label_dme.numpy(), 'bin': label_bin.numpy()})
         loss_dr = criterion(o_dr, Variable(label_dr.cuda()))
         loss_dme = criterion(o_dme, Variable(label_dme.cuda()))
         loss_bin = criterion(o_bin, Variable(label_bin.cuda()))
@@ -895,12 +856,16 @@ def eval_bin(eval_data_loader, model, criterion):
         pred_bin = pred_bin.cpu().data.numpy().squeeze()
         label_bin = label_bin.numpy().squeeze()
 
-        tot_pred_dr = np.append(tot_pred_dr, pred_dr)
-        tot_label_dr = np.append(tot_label_dr, label_dr)
-        tot_pred_dme = np.append(tot_pred_dme, pred_dme)
-        tot_label_dme = np.append(tot_label_dme, label_dme)
-        tot_pred_bin = np.append(tot_pred_bin, pred_bin)
-        tot_label_bin = np.append(tot_label_bin, label_bin)
+        tot_pred_dr.append(pred_dr)
+        tot_label_dr.append(label_dr)
+        confusion_dr.update(label_dr, pred_dr)
+        tot_pred_dme.append(pred_dme)
+        tot_label_dme.append(label_dme)
+        confusion_dme.update(label_dme, pred_dme)
+        tot_pred_bin.append(pred_bin)
+        tot_label_bin.append(label_bin)
+        confusion_bin.update(label_bin, pred_bin)
+        joint.update(pred_dr, pred_dme, label_bin)
 
         #precision
         losses_dr.update(loss_dr.data[0], len(image))
@@ -908,10 +873,10 @@ def eval_bin(eval_data_loader, model, criterion):
         losses_bin.update(loss_bin.data[0], len(image))
         losses.update(loss.data[0], len(image))
 
-        dr_accuracy = np.equal(tot_pred_dr, tot_label_dr).sum() / len(tot_pred_dr)
-        dme_accuracy = np.equal(tot_pred_dme, tot_label_dme).sum() / len(tot_pred_dme)
-        dr_kappa = quadratic_weighted_kappa(tot_label_dr, tot_pred_dr)
-        dme_kappa = quadratic_weighted_kappa(tot_label_dme, tot_pred_dme)
+        dr_accuracy = confusion_dr.accuracy()
+        dme_accuracy = confusion_dme.accuracy()
+        dr_kappa = confusion_dr.kappa()
+        dme_kappa = confusion_dme.kappa()
 
         accuracy.update(np.equal(pred_bin, label_bin).sum() / len(label_bin), len(label_bin))
 
@@ -942,17 +907,24 @@ def eval_bin(eval_data_loader, model, criterion):
         print(print_info)
         logger.append(print_info)
 
-    sensitivity, specificity, f1 = calc_sensitivity_specificity(tot_pred_bin, tot_label_bin)
+    tot_pred_dr = np.hstack(tot_pred_dr)
+    tot_label_dr = np.hstack(tot_label_dr)
+    tot_pred_dme = np.hstack(tot_pred_dme)
+    tot_label_dme = np.hstack(tot_label_dme)
+    tot_pred_bin = np.hstack(tot_pred_bin)
+    tot_label_bin = np.hstack(tot_label_bin)
+
+    conf_bin = confusion_bin.conf_mat
+    _, sensitivity, specificity, f1 = binary_metrics(conf_bin[1, 1], conf_bin[0, 1], conf_bin[1, 0], conf_bin[0, 0])
     print_info1 = '\nbinary cls accuracy: {0:.4f}\tsensitivity: {1:.4f}\t specificity: {2:.4f}\tf1 score: {3:.4f}'.format(accuracy.avg, sensitivity, specificity, f1)
     logger.append(print_info1)
     print(print_info1)
 
-    tot_pred_dr_bin = [0 if x <=1 else 1 for x in tot_pred_dr]
-    # tot_label_dr_bin = [0 if x <= 1 else 1 for x in tot_label_dr]
-    tot_label_dr_bin = tot_label_bin
-    dr_bin_accuray = np.equal(tot_pred_dr_bin, tot_label_dr_bin).sum() / len(tot_label_dr_bin)
-    dr_s1, dr_s2, dr_f1 = calc_sensitivity_specificity(tot_pred_dr_bin, tot_label_dr_bin)
+    # referable rules over the (DR pred, DME pred) cells of the joint counts, scored against the To_Treat label
+    pred_dr_level = np.arange(5)[:, None]
+    pred_dme_level = np.arange(4)[None, :]
 
+    dr_bin_accuray, dr_s1, dr_s2, dr_f1 = joint.binary(pred_dr_level >= 2)
     log_dr_bin_cls = '\n[DR binary cls]: acc: {acc:.4f}\tsensitivity: {s1:.4f}\tspecificity: {s2:.4f}\tf1 score: {f1:.4f}'.format(
         acc = dr_bin_accuray,
         s1 = dr_s1,
@@ -964,12 +936,7 @@ def eval_bin(eval_data_loader, model, criterion):
     logger.append(log_dr_bin_cls)
 
 
-    tot_pred_dme_bin = [0 if x < 1 else 1 for x in tot_pred_dme]
-    # tot_label_dme_bin = [0 if x < 1 else 1 for x in tot_label_dme]
-    tot_label_dme_bin = tot_label_bin
-    dme_bin_accuray = np.equal(tot_pred_dme_bin, tot_label_dme_bin).sum() / len(tot_label_dme_bin)
-    calc_sensitivity_specificity(tot_pred_dme_bin, tot_label_dme_bin)
-    dme_s1, dme_s2, dme_f1 = calc_sensitivity_specificity(tot_pred_dme_bin, tot_label_dme_bin)
+    dme_bin_accuray, dme_s1, dme_s2, dme_f1 = joint.binary(pred_dme_level >= 1)
     log_dme_bin_cls = '\n[DME binary cls]: acc: {acc:.4f}\tsensitivity: {s1:.4f}\tspecificity: {s2:.4f}\tf1 score: {f1:.4f}'.format(
         acc=dme_bin_accuray,
         s1=dme_s1,
@@ -978,36 +945,11 @@ def eval_bin(eval_data_loader, model, criterion):
     print(log_dme_bin_cls)
     logger.append(log_dme_bin_cls)
 
-    # tot_pred_mix_bin = [0 if (x < 1 or y <=1) else 1 for x in tot_pred_dme for y in tot_pred_dr]
-    cnt = 0
-    for i in range(len(tot_pred_dr)):
-        numdr = tot_pred_dr[i]
-        numdme = tot_pred_dme[i]
-        if numdr < 2:
-            if numdme > 0:
-                cnt += 1
-
-    print('dr < 2 and dme >0 count is: {}'.format(cnt))
-
-    cnt = 0
-    for i in range(len(tot_pred_dr)):
-        if tot_pred_dme[i] == 0:
-            cnt += 1
-    print('pred dme 0 count is: {}'.format(cnt))
-
-    cnt = 0
-    for i in range(len(tot_pred_dr)):
-        if tot_label_dme[i] == 0:
-            cnt += 1
-    print('label dme 0 count is: {}'.format(cnt))
-
-    tot_pred_mix_bin = [0 if (tot_pred_dme[i] == 0 and tot_pred_dr[i] <= 1) else 1 for i in range(len(tot_pred_dme))]
-    # tot_label_mix_bin = [0 if (x < 1 or y <=1) else 1 for x in tot_label_dme for y in tot_label_dr]
-    # tot_label_mix_bin = [0 if (tot_label_dme[i] < 1 and tot_label_dr[i] <= 1) else 1 for i in range(len(tot_label_dme))]
-    tot_label_mix_bin = tot_label_bin
-    mix_bin_accuray = np.equal(tot_pred_mix_bin, tot_label_mix_bin).sum() / len(tot_label_mix_bin)
-    calc_sensitivity_specificity(tot_pred_mix_bin, tot_label_mix_bin)
-    mix_s1, mix_s2, mix_f1 = calc_sensitivity_specificity(tot_pred_mix_bin, tot_label_mix_bin)
+    print('dr < 2 and dme >0 count is: {}'.format(joint.counts[:2, 1:].sum()))
+    print('pred dme 0 count is: {}'.format(joint.counts[:, 0].sum()))
+    print('label dme 0 count is: {}'.format(confusion_dme.conf_mat[0].sum()))
+
+    mix_bin_accuray, mix_s1, mix_s2, mix_f1 = joint.binary(~((pred_dme_level == 0) & (pred_dr_level <= 1)))
     log_mix_bin_cls = '\n[MIX binary cls]: acc: {acc:.4f}\tsensitivity: {s1:.4f}\tspecificity: {s2:.4f}\tf1 score: {f1:.4f}'.format(
         acc=mix_bin_accuray,
         s1=mix_s1,
@@ -1208,7 +1150,9 @@ def main():
             dataset_test = DataLoader(MultiTaskClsValDataSet(opt.root, opt.testcsv, opt.crop, opt.size),
                                   batch_size=opt.batch,
                                   shuffle=False, num_workers=opt.workers, pin_memory=False)
-            logger_val, kp_dr, kp_dme, pred_dr, label_dr, pred_dme, label_dme, _ = eval_bin(dataset_test, nn.DataParallel(model).cuda(), criterion)
+            store = LogitWriter(os.path.join(output_dir, 'logits'))
+            logger_val, kp_dr, kp_dme, pred_dr, label_dr, pred_dme, label_dme, _ = eval_bin(dataset_test, nn.DataParallel(model).cuda(), criterion, store=store)
+            store.close([dataset_test.dataset.images_list[i][0] for i in range(len(dataset_test.dataset))])
             print('===> DR Kappa: %.4f' % kp_dr)
             print('===> Confusion Matrix:')
             dr_confusion_matrix = str(confusion_matrix(label_dr, pred_dr))
@@ -1230,8 +1174,8 @@ def main():
                 fp.write('\n====> DME Kappa: %.4f' % kp_dme)
                 fp.write('\n')
                 fp.write(dme_confusion_matrix)
-            np.save(os.path.join(output_dir, 'results_dr.npy'), pred_dr, label_dr, confusion_matrix(label_dr, pred_dr))
-            np.save(os.path.join(output_dir, 'results_dme.npy'), pred_dme, label_dme, confusion_matrix(label_dme, pred_dme))
+            np.savez(os.path.join(output_dir, 'results_dr.npz'), pred=pred_dr, label=label_dr, confusion=confusion_matrix(label_dr, pred_dr))
+            np.savez(os.path.join(output_dir, 'results_dme.npz'), pred=pred_dme, label=label_dme, confusion=confusion_matrix(label_dme, pred_dme))
         else:
             raise Exception('No weights found!')
     elif opt.phase == 'infer':
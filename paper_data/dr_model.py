@@ -4,11 +4,9 @@ import json
 import numpy as np
 import torchvision.transforms as transforms
 
-from utils import PILColorJitter, Lighting
+from utils import PILColorJitter, Lighting, LabelTable
+from image_decode import load_image
 
-from PIL import Image
-
-import pandas as pd
 import os
 
 from torch.utils.data import DataLoader
@@ -42,10 +40,7 @@ class SingleChannelClsDataSet(torch.utils.data.Dataset):
         self.crop_size = crop_size
         self.scale_size = scale_size
         self.baseline = baseline
-        df = pd.DataFrame.from_csv(config)
-        self.images_list = []
-        for index, row in df.iterrows():
-            self.images_list.append(row)
+        self.images_list = LabelTable(config)
         with open('info.json', 'r') as fp:
             info = json.load(fp)
         mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
@@ -78,7 +73,7 @@ class SingleChannelClsDataSet(torch.utils.data.Dataset):
 
     def __getitem__(self, item):
         return self.transform(
-            Image.open(os.path.join(self.root, self.images_list[item][0] + '_' + str(self.scale_size) + '.png'))), \
+            load_image(os.path.join(self.root, self.images_list[item][0] + '_' + str(self.scale_size) + '.png'))), \
                self.images_list[item][1], self.images_list[item][2], self.images_list[item][3]
 
     def __len__(self):
@@ -92,10 +87,7 @@ class SingleChannelClsValDataSet(torch.utils.data.Dataset):
         self.config = config
         self.crop_size = crop_size
         self.scale_size = scale_size
-        df = pd.DataFrame.from_csv(config)
-        self.images_list = []
-        for index, row in df.iterrows():
-            self.images_list.append(row)
+        self.images_list = LabelTable(config)
         with open('info.json', 'r') as fp:
             info = json.load(fp)
         mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
@@ -111,7 +103,7 @@ class SingleChannelClsValDataSet(torch.utils.data.Dataset):
         self.transform_ahe = self.transform
 
     def __getitem__(self, item):
-        return self.transform(Image.open(os.path.join(self.root, self.images_list[item][0]+'_'+str(self.scale_size)+'.png'))), \
+        return self.transform(load_image(os.path.join(self.root, self.images_list[item][0]+'_'+str(self.scale_size)+'.png'))), \
                self.images_list[item][1], self.images_list[item][2], self.images_list[item][3]
 
     def __len__(self):
@@ -3,8 +3,8 @@ sys.path.append('../')
 import torch
 import json
 import torchvision.transforms as transforms
-from utils import PILColorJitter, Lighting
-from PIL import Image
+from utils import PILColorJitter, Lighting, LabelTable
+from image_decode import load_image, load_square
 import os
 import pandas as pd
 import numpy as np
@@ -22,7 +22,8 @@ import math
 
 import torch.optim as optim
 
-from utils import quadratic_weighted_kappa, kappa_confusion_matrix, AverageMeter
+from utils import ConfusionMeter, kappa_confusion_matrix, AverageMeter
+from logit_store import LogitWriter
 from sklearn.metrics import confusion_matrix
 import time
 
@@ -72,10 +73,7 @@ class MultiTaskClsDataSet(torch.utils.data.Dataset):
         self.crop_size = crop_size
         self.scale_size = scale_size
         self.baseline = baseline
-        df = pd.DataFrame.from_csv(config)
-        self.images_list = []
-        for index, row in df.iterrows():
-            self.images_list.append(row)
+        self.images_list = LabelTable(config)
         with open('info.json', 'r') as fp:
             info = json.load(fp)
         mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
@@ -101,7 +99,7 @@ class MultiTaskClsDataSet(torch.utils.data.Dataset):
 
     def __getitem__(self, item):
         return self.transform(
-            Image.open(os.path.join(self.root, str(self.images_list[item][0]) + '_' + str(self.scale_size) + '.png'))), \
+            load_image(os.path.join(self.root, str(self.images_list[item][0]) + '_' + str(self.scale_size) + '.png'))), \
                int(self.images_list[item][1])
 
     def __len__(self):
@@ -114,10 +112,7 @@ class MultiTaskClsValDataSet(torch.utils.data.Dataset):
         self.config = config
         self.crop_size = crop_size
         self.scale_size = scale_size
-        df = pd.DataFrame.from_csv(config)
-        self.images_list = []
-        for index, row in df.iterrows():
-            self.images_list.append(row)
+        self.images_list = LabelTable(config)
         with open('info.json', 'r') as fp:
             info = json.load(fp)
         mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
@@ -132,7 +127,7 @@ class MultiTaskClsValDataSet(torch.utils.data.Dataset):
         ])
 
     def __getitem__(self, item):
-        return self.transform(Image.open(os.path.join(self.root, str(self.images_list[item][0])+'_'+str(self.scale_size)+'.png'))), int(self.images_list[item][1])
+        return self.transform(load_image(os.path.join(self.root, str(self.images_list[item][0])+'_'+str(self.scale_size)+'.png'))), int(self.images_list[item][1])
 
     def __len__(self):
         return len(self.images_list)
@@ -162,32 +157,8 @@ class MultiTaskClsInferenceDataSet(torch.utils.data.Dataset):
         return len(self.images_list)
 
     def _scale_image(self, imagepath, scale_size):
-        # image = Image.open(os.path.join(root, '{}.jpg'.format(index)))
-        image = Image.open(imagepath)
-        w, h = image.size
-        tw, th = (min(w, h), min(w, h))
-        image = image.crop((w // 2 - tw // 2, h // 2 - th // 2, w // 2 + tw // 2, h // 2 + th // 2))
-        # image = image.crop((max(w // 2 - tw // 2, 0), max(h // 2 - th // 2, 0), min(w // 2 + tw // 2, w-1), min(h // 2 + th // 2, h-1)))
-        w, h = image.size
-        tw, th = (scale_size, scale_size)
-        ratio = tw / w
-        assert ratio == th / h
-        if ratio < 1:
-            image = image.resize((tw, th), Image.ANTIALIAS)
-        elif ratio > 1:
-            image = image.resize((tw, th), Image.CUBIC)
-        w, h = image.size
-        tw, th = (min(w, h), min(w, h))
-        image = image.crop((w // 2 - tw // 2, h // 2 - th // 2, w // 2 + tw // 2, h // 2 + th // 2))
-        w, h = image.size
-        tw, th = (scale_size, scale_size)
-        ratio = tw / w
-        assert ratio == th / h
-        if ratio < 1:
-            image = image.resize((tw, th), Image.ANTIALIAS)
-        elif ratio > 1:
-            image = image.resize((tw, th), Image.CUBIC)
-        return image
+        # centered square crop resized to scale_size, the JPEG is decoded at a reduced DCT scale near scale_size
+        return load_square(imagepath, scale_size)
 
 def initialize_cls_weights(cls):
 	for m in cls.modules():
@@ -328,8 +299,7 @@ class multi_task_model(nn.Module):
 
 def train_bin(train_data_loader, model, criterion, optimizer, epoch, display, dme_weight_aug_ratio=1):
     model.train()
-    tot_pred_dr = np.array([], dtype=int)
-    tot_label_dr = np.array([], dtype=int)
+    confusion_dr = ConfusionMeter(7)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     accuracy = AverageMeter()
@@ -354,15 +324,14 @@ def train_bin(train_data_loader, model, criterion, optimizer, epoch, display, dm
         pred_dr = pred_dr.cpu().data.numpy().squeeze()
         label_dr = label_dr.numpy().squeeze()
 
-        tot_pred_dr = np.append(tot_pred_dr, pred_dr)
-        tot_label_dr = np.append(tot_label_dr, label_dr)
+        confusion_dr.update(label_dr, pred_dr)
 
         #precision
         losses_dr.update(loss_dr.data[0], len(image))
         losses.update(loss.data[0], len(image))
 
         if index % display == 0:
-            dr_accuracy = np.equal(tot_pred_dr, tot_label_dr).sum()/len(tot_pred_dr)
+            dr_accuracy = confusion_dr.accuracy()
             print_info = 'Epoch: [{epoch}][{iter}/{tot}]\t' \
                          'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t' \
                          'Data {data_time.avg:.3f}\t ' \
@@ -414,10 +383,9 @@ def calc_sensitivity_specificity(pred, label):
 
     return sensitivity, specificity, f1
 
-def eval_bin(eval_data_loader, model, criterion):
+def eval_bin(eval_data_loader, model, criterion, store=None):
     model.eval()
-    tot_pred_dr = np.array([], dtype=int)
-    tot_label_dr = np.array([], dtype=int)
+    confusion_dr = ConfusionMeter(7)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     accuracy = AverageMeter()
@@ -428,6 +396,8 @@ def eval_bin(eval_data_loader, model, criterion):
     for index, (image, label_dr) in enumerate(eval_data_loader):
         data_time.update(time.time()-end)
         o_dr = model(Variable(image.cuda()))
+        if store is not None:
+            store.update({'dr': o_dr.cpu().data.numpy()}, {'dr': label_dr.numpy()})
         loss_dr = criterion(o_dr, Variable(label_dr.cuda()))
         loss = loss_dr
         batch_time.update(time.time()-end)
@@ -435,14 +405,13 @@ def eval_bin(eval_data_loader, model, criterion):
         pred_dr = pred_dr.cpu().data.numpy().squeeze()
         label_dr = label_dr.numpy().squeeze()
 
-        tot_pred_dr = np.append(tot_pred_dr, pred_dr)
-        tot_label_dr = np.append(tot_label_dr, label_dr)
+        confusion_dr.update(label_dr, pred_dr)
 
         #precision
         losses_dr.update(loss_dr.data[0], len(image))
         losses.update(loss.data[0], len(image))
 
-        dr_accuracy = np.equal(tot_pred_dr, tot_label_dr).sum() / len(tot_pred_dr)
+        dr_accuracy = confusion_dr.accuracy()
 
         print_info = 'Eval: [{iter}/{tot}]\t' \
                      'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t' \
@@ -579,7 +548,9 @@ def main():
             dataset_test = DataLoader(MultiTaskClsValDataSet(opt.root, opt.testcsv, opt.crop, opt.size),
                                   batch_size=opt.batch,
                                   shuffle=False, num_workers=opt.workers, pin_memory=False)
-            logger_val, kp_dr, kp_dme, pred_dr, label_dr, pred_dme, label_dme, _ = eval_bin(dataset_test, nn.DataParallel(model).cuda(), criterion)
+            store = LogitWriter(os.path.join(output_dir, 'logits'))
+            logger_val, kp_dr, kp_dme, pred_dr, label_dr, pred_dme, label_dme, _ = eval_bin(dataset_test, nn.DataParallel(model).cuda(), criterion, store=store)
+            store.close([dataset_test.dataset.images_list[i][0] for i in range(len(dataset_test.dataset))])
             print('===> DR Kappa: %.4f' % kp_dr)
             print('===> Confusion Matrix:')
             dr_confusion_matrix = str(confusion_matrix(label_dr, pred_dr))
@@ -601,8 +572,8 @@ def main():
                 fp.write('\n====> DME Kappa: %.4f' % kp_dme)
                 fp.write('\n')
                 fp.write(dme_confusion_matrix)
-            np.save(os.path.join(output_dir, 'results_dr.npy'), pred_dr, label_dr, confusion_matrix(label_dr, pred_dr))
-            np.save(os.path.join(output_dir, 'results_dme.npy'), pred_dme, label_dme, confusion_matrix(label_dme, pred_dme))
+            np.savez(os.path.join(output_dir, 'results_dr.npz'), pred=pred_dr, label=label_dr, confusion=confusion_matrix(label_dr, pred_dr))
+            np.savez(os.path.join(output_dir, 'results_dme.npz'), pred=pred_dme, label=label_dme, confusion=confusion_matrix(label_dme, pred_dme))
         else:
             raise Exception('No weights found!')
     elif opt.phase == 'infer':
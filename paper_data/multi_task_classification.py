@@ -3,10 +3,9 @@ sys.path.append('../')
 import torch
 import json
 import torchvision.transforms as transforms
-from utils import PILColorJitter, Lighting
-from PIL import Image
+from utils import PILColorJitter, Lighting, LabelTable
+from image_decode import load_image
 import os
-import pandas as pd
 import numpy as np
 
 import argparse
@@ -22,7 +21,8 @@ import math
 
 import torch.optim as optim
 
-from utils import quadratic_weighted_kappa, kappa_confusion_matrix, AverageMeter
+from utils import ConfusionMeter, kappa_confusion_matrix, AverageMeter
+from logit_store import LogitWriter
 from sklearn.metrics import confusion_matrix
 import time
 
@@ -66,10 +66,7 @@ class MultiTaskClsDataSet(torch.utils.data.Dataset):
         self.crop_size = crop_size
         self.scale_size = scale_size
         self.baseline = baseline
-        df = pd.DataFrame.from_csv(config)
-        self.images_list = []
-        for index, row in df.iterrows():
-            self.images_list.append(row)
+        self.images_list = LabelTable(config)
         with open('info.json', 'r') as fp:
             info = json.load(fp)
         mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
@@ -95,7 +92,7 @@ class MultiTaskClsDataSet(torch.utils.data.Dataset):
 
     def __getitem__(self, item):
         return self.transform(
-            Image.open(os.path.join(self.root, self.images_list[item][0] + '_' + str(self.scale_size) + '.png'))), \
+            load_image(os.path.join(self.root, self.images_list[item][0] + '_' + str(self.scale_size) + '.png'))), \
                self.images_list[item][1], self.images_list[item][2]
 
     def __len__(self):
@@ -108,10 +105,7 @@ class MultiTaskClsValDataSet(torch.utils.data.Dataset):
         self.config = config
         self.crop_size = crop_size
         self.scale_size = scale_size
-        df = pd.DataFrame.from_csv(config)
-        self.images_list = []
-        for index, row in df.iterrows():
-            self.images_list.append(row)
+        self.images_list = LabelTable(config)
         with open('info.json', 'r') as fp:
             info = json.load(fp)
         mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
@@ -126,7 +120,7 @@ class MultiTaskClsValDataSet(torch.utils.data.Dataset):
         ])
 
     def __getitem__(self, item):
-        return self.transform(Image.open(os.path.join(self.root, self.images_list[item][0]+'_'+str(self.scale_size)+'.png'))), self.images_list[item][1], self.images_list[item][2]
+        return self.transform(load_image(os.path.join(self.root, self.images_list[item][0]+'_'+str(self.scale_size)+'.png'))), self.images_list[item][1], self.images_list[item][2]
 
     def __len__(self):
         return len(self.images_list)
@@ -256,10 +250,8 @@ def model_test():
 
 def train(train_data_loader, model, criterion, optimizer, epoch, display):
     model.train()
-    tot_pred_dr = np.array([], dtype=int)
-    tot_label_dr = np.array([], dtype=int)
-    tot_pred_dme = np.array([], dtype=int)
-    tot_label_dme = np.array([], dtype=int)
+    confusion_dr = ConfusionMeter(5)
+    confusion_dme = ConfusionMeter(4)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     accuracy = AverageMeter()
@@ -285,10 +277,8 @@ def train(train_data_loader, model, criterion, optimizer, epoch, display):
         pred_dme = pred_dme.cpu().data.numpy().squeeze()
         label_dme = label_dme.numpy().squeeze()
 
-        tot_pred_dr = np.append(tot_pred_dr, pred_dr)
-        tot_label_dr = np.append(tot_label_dr, label_dr)
-        tot_pred_dme = np.append(tot_pred_dme, pred_dme)
-        tot_label_dme = np.append(tot_label_dme, label_dme)
+        confusion_dr.update(label_dr, pred_dr)
+        confusion_dme.update(label_dme, pred_dme)
 
         #precision
         losses_dr.update(loss_dr.data[0], len(image))
@@ -297,10 +287,10 @@ def train(train_data_loader, model, criterion, optimizer, epoch, display):
 
 
         if index % display == 0:
-            dr_accuracy = np.equal(tot_pred_dr, tot_label_dr).sum()/len(tot_pred_dr)
-            dme_accuracy = np.equal(tot_pred_dme, tot_label_dme).sum()/len(tot_pred_dme)
-            dr_kappa = quadratic_weighted_kappa(tot_label_dr, tot_pred_dr)
-            dme_kappa = quadratic_weighted_kappa(tot_label_dme, tot_pred_dme)
+            dr_accuracy = confusion_dr.accuracy()
+            dme_accuracy = confusion_dme.accuracy()
+            dr_kappa = confusion_dr.kappa()
+            dme_kappa = confusion_dme.kappa()
             print_info = 'Epoch: [{epoch}][{iter}/{tot}]\t' \
                          'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t' \
                          'Data {data_time.avg:.3f}\t ' \
@@ -326,12 +316,14 @@ def train(train_data_loader, model, criterion, optimizer, epoch, display):
     return logger
 
 
-def eval(eval_data_loader, model, criterion):
+def eval(eval_data_loader, model, criterion, store=None):
     model.eval()
-    tot_pred_dr = np.array([], dtype=int)
-    tot_label_dr = np.array([], dtype=int)
-    tot_pred_dme = np.array([], dtype=int)
-    tot_label_dme = np.array([], dtype=int)
+    tot_pred_dr = []
+    tot_label_dr = []
+    confusion_dr = ConfusionMeter(5)
+    tot_pred_dme = []
+    tot_label_dme = []
+    confusion_dme = ConfusionMeter(4)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     accuracy = AverageMeter()
@@ -343,6 +335,8 @@ def eval(eval_data_loader, model, criterion):
     for index, (image, label_dr, label_dme) in enumerate(eval_data_loader):
         data_time.update(time.time()-end)
         o_dr, o_dme = model(Variable(image.cuda()))
+        if store is not None:
+            store.update({'dr': o_dr.cpu().data.numpy(), 'dme': o_dme.cpu().data.numpy()}, {'dr': label_dr.numpy(), 'dme': label_dme.numpy()})
         loss_dr = criterion(o_dr, Variable(label_dr.cuda()))
         loss_dme = criterion(o_dme, Variable(label_dme.cuda()))
         loss = 0.5 * loss_dr + 0.5 * loss_dme
@@ -354,20 +348,22 @@ def eval(eval_data_loader, model, criterion):
         pred_dme = pred_dme.cpu().data.numpy().squeeze()
         label_dme = label_dme.numpy().squeeze()
 
-        tot_pred_dr = np.append(tot_pred_dr, pred_dr)
-        tot_label_dr = np.append(tot_label_dr, label_dr)
-        tot_pred_dme = np.append(tot_pred_dme, pred_dme)
-        tot_label_dme = np.append(tot_label_dme, label_dme)
+        tot_pred_dr.append(pred_dr)
+        tot_label_dr.append(label_dr)
+        confusion_dr.update(label_dr, pred_dr)
+        tot_pred_dme.append(pred_dme)
+        tot_label_dme.append(label_dme)
+        confusion_dme.update(label_dme, pred_dme)
 
         #precision
         losses_dr.update(loss_dr.data[0], len(image))
         losses_dme.update(loss_dme.data[0], len(image))
         losses.update(loss.data[0], len(image))
 
-        dr_accuracy = np.equal(tot_pred_dr, tot_label_dr).sum() / len(tot_pred_dr)
-        dme_accuracy = np.equal(tot_pred_dme, tot_label_dme).sum() / len(tot_pred_dme)
-        dr_kappa = quadratic_weighted_kappa(tot_label_dr, tot_pred_dr)
-        dme_kappa = quadratic_weighted_kappa(tot_label_dme, tot_pred_dme)
+        dr_accuracy = confusion_dr.accuracy()
+        dme_accuracy = confusion_dme.accuracy()
+        dr_kappa = confusion_dr.kappa()
+        dme_kappa = confusion_dme.kappa()
         print_info = 'Eval: [{iter}/{tot}]\t' \
                      'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t' \
                      'Data {data_time.avg:.3f}\t ' \
@@ -391,6 +387,11 @@ def eval(eval_data_loader, model, criterion):
         print(print_info)
         logger.append(print_info)
 
+    tot_pred_dr = np.hstack(tot_pred_dr)
+    tot_label_dr = np.hstack(tot_label_dr)
+    tot_pred_dme = np.hstack(tot_pred_dme)
+    tot_label_dme = np.hstack(tot_label_dme)
+
     return logger, dr_kappa, dme_kappa, tot_pred_dr, tot_label_dr, tot_pred_dme, tot_label_dme
 
 
@@ -481,7 +482,9 @@ def main():
             dataset_test = DataLoader(MultiTaskClsValDataSet(opt.root, opt.testcsv, opt.crop, opt.size),
                                   batch_size=opt.batch,
                                   shuffle=False, num_workers=opt.workers, pin_memory=False)
-            logger_val, kp_dr, kp_dme, pred_dr, label_dr, pred_dme, label_dme = eval(dataset_test, nn.DataParallel(model).cuda(), criterion)
+            store = LogitWriter(os.path.join(output_dir, 'logits'))
+            logger_val, kp_dr, kp_dme, pred_dr, label_dr, pred_dme, label_dme = eval(dataset_test, nn.DataParallel(model).cuda(), criterion, store=store)
+            store.close([dataset_test.dataset.images_list[i][0] for i in range(len(dataset_test.dataset))])
             print('===> DR Kappa: %.4f' % kp_dr)
             print('===> Confusion Matrix:')
             dr_confusion_matrix = str(confusion_matrix(label_dr, pred_dr))
@@ -502,8 +505,8 @@ def main():
                 fp.write('\n====> DME Kappa: %.4f' % kp_dme)
                 fp.write('\n')
                 fp.write(dme_confusion_matrix)
-            np.save(os.path.join(output_dir, 'results_dr.npy'), pred_dr, label_dr, confusion_matrix(label_dr, pred_dr))
-            np.save(os.path.join(output_dir, 'results_dme.npy'), pred_dme, label_dme, confusion_matrix(label_dme, pred_dme))
+            np.savez(os.path.join(output_dir, 'results_dr.npz'), pred=pred_dr, label=label_dr, confusion=confusion_matrix(label_dr, pred_dr))
+            np.savez(os.path.join(output_dir, 'results_dme.npz'), pred=pred_dme, label=label_dme, confusion=confusion_matrix(label_dme, pred_dme))
         else:
             raise Exception('No weights found!')
     else:
@@ -3,8 +3,8 @@ sys.path.append('../')
 import torch
 import json
 import torchvision.transforms as transforms
-from utils import PILColorJitter, Lighting
-from PIL import Image
+from utils import PILColorJitter, Lighting, LabelTable, prefetch, ResumableSampler
+from image_decode import load_image, load_square
 import os
 import pandas as pd
 import numpy as np
@@ -22,15 +22,17 @@ import math
 
 import torch.optim as optim
 
-from utils import quadratic_weighted_kappa, kappa_confusion_matrix, AverageMeter
+from utils import ConfusionMeter, RocMeter, JointMeter, MetricState, binary_metrics, kappa_confusion_matrix, AverageMeter, bootstrap_metrics, load_operating_point
 from sklearn.metrics import confusion_matrix
 import time
 
 import torch.backends.cudnn as cudnn
+import torch.distributed as dist
 
 from glob import glob
+from logit_store import LogitWriter
+from image_cache import SharedImageCache, open_image
 
-from sklearn.metrics import roc_curve, auc
 
 def parse_args():
     parser = argparse.ArgumentParser(description='multi-task classification options')
@@ -54,14 +56,23 @@ def parse_args():
         'rsn18', 'rsn34', 'rsn50', 'rsn101', 'rsn150', 'dsn121', 'dsn161', 'dsn169', 'dsn201',
     ])
     parser.add_argument('--seed', default=111, type=int)
-    parser.add_argument('--phase', default='train', choices=['train', 'test', 'infer'])
+    parser.add_argument('--phase', default='train', choices=['train', 'test', 'infer', 'merge'])
     parser.add_argument('--display', default=100, type=int)
+    parser.add_argument('--cache', default=0, type=float, help='GB of shared memory for decoded validation images, 0 disables the cache')
     parser.add_argument('--workers', default=1, type=int)
+    parser.add_argument('--prefetch', default=0, type=int, help='The number of batches to load and copy to the GPU ahead on a background thread, 0 disables')
+    parser.add_argument('--save_every', default=0, type=int, help='Write <output_dir>/resume.pth every this many training batches and after every epoch, 0 disables')
+    parser.add_argument('--resume', default=None, help='A resume.pth to continue the run from, mid-epoch at the next unseen sample')
     parser.add_argument('--baseline', action='store_true')
     parser.add_argument('--output', default='output', help='The output dir')
 
     parser.add_argument('--infer_root', default=None)
     parser.add_argument('--dme_weight_aug', default=1.0, type=float)
+    parser.add_argument('--bootstrap', default=0, type=int, help='The number of bootstrap resamples for test confidence intervals')
+    parser.add_argument('--world_size', default=1, type=int, help='The number of test shards')
+    parser.add_argument('--rank', default=0, type=int, help='The test shard of this process')
+    parser.add_argument('--dist_url', default=None, help='torch.distributed init method, e.g. tcp://host:port, to all-reduce the test metrics')
+    parser.add_argument('--states', nargs='+', default=[], help='The metric_state_*.pkl files of the test shards to merge')
 
     return parser.parse_args()
 
@@ -73,10 +84,7 @@ class MultiTaskClsDataSet(torch.utils.data.Dataset):
         self.crop_size = crop_size
         self.scale_size = scale_size
         self.baseline = baseline
-        df = pd.DataFrame.from_csv(config)
-        self.images_list = []
-        for index, row in df.iterrows():
-            self.images_list.append(row)
+        self.images_list = LabelTable(config)
         with open('info.json', 'r') as fp:
             info = json.load(fp)
         mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
@@ -102,23 +110,20 @@ class MultiTaskClsDataSet(torch.utils.data.Dataset):
 
     def __getitem__(self, item):
         return self.transform(
-            Image.open(os.path.join(self.root, self.images_list[item][0] + '_' + str(self.scale_size) + '.png'))), \
+            load_image(os.path.join(self.root, self.images_list[item][0] + '_' + str(self.scale_size) + '.png'))), \
                self.images_list[item][1], self.images_list[item][2], self.images_list[item][3]
 
     def __len__(self):
         return len(self.images_list)
 
 class MultiTaskClsValDataSet(torch.utils.data.Dataset):
-    def __init__(self, root, config, crop_size, scale_size, baseline=False):
+    def __init__(self, root, config, crop_size, scale_size, baseline=False, cache_bytes=0):
         super(MultiTaskClsValDataSet, self).__init__()
         self.root = root
         self.config = config
         self.crop_size = crop_size
         self.scale_size = scale_size
-        df = pd.DataFrame.from_csv(config)
-        self.images_list = []
-        for index, row in df.iterrows():
-            self.images_list.append(row)
+        self.images_list = LabelTable(config)
         with open('info.json', 'r') as fp:
             info = json.load(fp)
         mean_values = torch.from_numpy(np.array(info['mean'], dtype=np.float32) / 255)
@@ -132,8 +137,11 @@ class MultiTaskClsValDataSet(torch.utils.data.Dataset):
             transforms.Normalize(mean=mean_values, std=std_values),
         ])
 
+        # decoded images shared by the loader workers and kept across epochs
+        self.cache = SharedImageCache(len(self.images_list), cache_bytes, (scale_size, scale_size, 3)) if cache_bytes > 0 else None
+
     def __getitem__(self, item):
-        return self.transform(Image.open(os.path.join(self.root, self.images_list[item][0]+'_'+str(self.scale_size)+'.png'))), self.images_list[item][1], self.images_list[item][2], self.images_list[item][3]
+        return self.transform(open_image(os.path.join(self.root, self.images_list[item][0]+'_'+str(self.scale_size)+'.png'), self.cache, item)), self.images_list[item][1], self.images_list[item][2], self.images_list[item][3]
 
     def __len__(self):
         return len(self.images_list)
@@ -163,31 +171,8 @@ class MultiTaskClsInferenceDataSet(torch.utils.data.Dataset):
         return len(self.images_list)
 
     def _scale_image(self, imagepath, scale_size):
-        # image = Image.open(os.path.join(root, '{}.jpg'.format(index)))
-        image = Image.open(imagepath)
-        w, h = image.size
-        tw, th = (min(w, h), min(w, h))
-        image = image.crop((w // 2 - tw // 2, h // 2 - th // 2, w // 2 + tw // 2, h // 2 + th // 2))
-        w, h = image.size
-        tw, th = (scale_size, scale_size)
-        ratio = tw / w
-        assert ratio == th / h
-        if ratio < 1:
-            image = image.resize((tw, th), Image.ANTIALIAS)
-        elif ratio > 1:
-            image = image.resize((tw, th), Image.CUBIC)
-        w, h = image.size
-        tw, th = (min(w, h), min(w, h))
-        image = image.crop((w // 2 - tw // 2, h // 2 - th // 2, w // 2 + tw // 2, h // 2 + th // 2))
-        w, h = image.size
-        tw, th = (scale_size, scale_size)
-        ratio = tw / w
-        assert ratio == th / h
-        if ratio < 1:
-            image = image.resize((tw, th), Image.ANTIALIAS)
-        elif ratio > 1:
-            image = image.resize((tw, th), Image.CUBIC)
-        return image
+        # centered square crop resized to scale_size, the JPEG is decoded at a reduced DCT scale near scale_size
+        return load_square(imagepath, scale_size)
 
 def initialize_cls_weights(cls):
 	for m in cls.modules():
@@ -324,10 +309,8 @@ def model_test():
 
 def train(train_data_loader, model, criterion, optimizer, epoch, display):
     model.train()
-    tot_pred_dr = np.array([], dtype=int)
-    tot_label_dr = np.array([], dtype=int)
-    tot_pred_dme = np.array([], dtype=int)
-    tot_label_dme = np.array([], dtype=int)
+    confusion_dr = ConfusionMeter(5)
+    confusion_dme = ConfusionMeter(4)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     accuracy = AverageMeter()
@@ -353,10 +336,8 @@ def train(train_data_loader, model, criterion, optimizer, epoch, display):
         pred_dme = pred_dme.cpu().data.numpy().squeeze()
         label_dme = label_dme.numpy().squeeze()
 
-        tot_pred_dr = np.append(tot_pred_dr, pred_dr)
-        tot_label_dr = np.append(tot_label_dr, label_dr)
-        tot_pred_dme = np.append(tot_pred_dme, pred_dme)
-        tot_label_dme = np.append(tot_label_dme, label_dme)
+        confusion_dr.update(label_dr, pred_dr)
+        confusion_dme.update(label_dme, pred_dme)
 
         #precision
         losses_dr.update(loss_dr.data[0], len(image))
@@ -365,10 +346,10 @@ def train(train_data_loader, model, criterion, optimizer, epoch, display):
 
 
         if index % display == 0:
-            dr_accuracy = np.equal(tot_pred_dr, tot_label_dr).sum()/len(tot_pred_dr)
-            dme_accuracy = np.equal(tot_pred_dme, tot_label_dme).sum()/len(tot_pred_dme)
-            dr_kappa = quadratic_weighted_kappa(tot_label_dr, tot_pred_dr)
-            dme_kappa = quadratic_weighted_kappa(tot_label_dme, tot_pred_dme)
+            dr_accuracy = confusion_dr.accuracy()
+            dme_accuracy = confusion_dme.accuracy()
+            dr_kappa = confusion_dr.kappa()
+            dme_kappa = confusion_dme.kappa()
             print_info = 'Epoch: [{epoch}][{iter}/{tot}]\t' \
                          'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t' \
                          'Data {data_time.avg:.3f}\t ' \
@@ -395,12 +376,9 @@ def train(train_data_loader, model, criterion, optimizer, epoch, display):
 
 def train_dr(train_data_loader, model, criterion, optimizer, epoch, display):
     model.train()
-    tot_pred_dr = np.array([], dtype=int)
-    tot_label_dr = np.array([], dtype=int)
-    tot_pred_dme = np.array([], dtype=int)
-    tot_label_dme = np.array([], dtype=int)
-    tot_pred_bin = np.array([], dtype=int)
-    tot_label_bin = np.array([], dtype=int)
+    confusion_dr = ConfusionMeter(5)
+    confusion_dme = ConfusionMeter(4)
+    confusion_bin = ConfusionMeter(2)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     accuracy = AverageMeter()
@@ -432,12 +410,9 @@ def train_dr(train_data_loader, model, criterion, optimizer, epoch, display):
         pred_bin = pred_bin.cpu().data.numpy().squeeze()
         label_bin = label_bin.numpy().squeeze()
 
-        tot_pred_dr = np.append(tot_pred_dr, pred_dr)
-        tot_label_dr = np.append(tot_label_dr, label_dr)
-        tot_pred_dme = np.append(tot_pred_dme, pred_dme)
-        tot_label_dme = np.append(tot_label_dme, label_dme)
-        tot_pred_bin = np.append(tot_pred_bin, pred_bin)
-        tot_label_bin = np.append(tot_label_bin, label_bin)
+        confusion_dr.update(label_dr, pred_dr)
+        confusion_dme.update(label_dme, pred_dme)
+        confusion_bin.update(label_bin, pred_bin)
 
 
         #precision
@@ -450,10 +425,10 @@ def train_dr(train_data_loader, model, criterion, optimizer, epoch, display):
 
 
         if index % display == 0:
-            dr_accuracy = np.equal(tot_pred_dr, tot_label_dr).sum()/len(tot_pred_dr)
-            dme_accuracy = np.equal(tot_pred_dme, tot_label_dme).sum()/len(tot_pred_dme)
-            dr_kappa = quadratic_weighted_kappa(tot_label_dr, tot_pred_dr)
-            dme_kappa = quadratic_weighted_kappa(tot_label_dme, tot_pred_dme)
+            dr_accuracy = confusion_dr.accuracy()
+            dme_accuracy = confusion_dme.accuracy()
+            dr_kappa = confusion_dr.kappa()
+            dme_kappa = confusion_dme.kappa()
             print_info = 'Epoch: [{epoch}][{iter}/{tot}]\t' \
                          'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t' \
                          'Data {data_time.avg:.3f}\t ' \
@@ -483,12 +458,9 @@ def train_dr(train_data_loader, model, criterion, optimizer, epoch, display):
 
 def train_dr_and_dme(train_data_loader, model, criterion, optimizer, epoch, display):
     model.train()
-    tot_pred_dr = np.array([], dtype=int)
-    tot_label_dr = np.array([], dtype=int)
-    tot_pred_dme = np.array([], dtype=int)
-    tot_label_dme = np.array([], dtype=int)
-    tot_pred_bin = np.array([], dtype=int)
-    tot_label_bin = np.array([], dtype=int)
+    confusion_dr = ConfusionMeter(5)
+    confusion_dme = ConfusionMeter(4)
+    confusion_bin = ConfusionMeter(2)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     accuracy = AverageMeter()
@@ -520,12 +492,9 @@ def train_dr_and_dme(train_data_loader, model, criterion, optimizer, epoch, disp
         pred_bin = pred_bin.cpu().data.numpy().squeeze()
         label_bin = label_bin.numpy().squeeze()
 
-        tot_pred_dr = np.append(tot_pred_dr, pred_dr)
-        tot_label_dr = np.append(tot_label_dr, label_dr)
-        tot_pred_dme = np.append(tot_pred_dme, pred_dme)
-        tot_label_dme = np.append(tot_label_dme, label_dme)
-        tot_pred_bin = np.append(tot_pred_bin, pred_bin)
-        tot_label_bin = np.append(tot_label_bin, label_bin)
+        confusion_dr.update(label_dr, pred_dr)
+        confusion_dme.update(label_dme, pred_dme)
+        confusion_bin.update(label_bin, pred_bin)
 
 
         #precision
@@ -538,10 +507,10 @@ def train_dr_and_dme(train_data_loader, model, criterion, optimizer, epoch, disp
 
 
         if index % display == 0:
-            dr_accuracy = np.equal(tot_pred_dr, tot_label_dr).sum()/len(tot_pred_dr)
-            dme_accuracy = np.equal(tot_pred_dme, tot_label_dme).sum()/len(tot_pred_dme)
-            dr_kappa = quadratic_weighted_kappa(tot_label_dr, tot_pred_dr)
-            dme_kappa = quadratic_weighted_kappa(tot_label_dme, tot_pred_dme)
+            dr_accuracy = confusion_dr.accuracy()
+            dme_accuracy = confusion_dme.accuracy()
+            dr_kappa = confusion_dr.kappa()
+            dme_kappa = confusion_dme.kappa()
             print_info = 'Epoch: [{epoch}][{iter}/{tot}]\t' \
                          'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t' \
                          'Data {data_time.avg:.3f}\t ' \
@@ -571,12 +540,9 @@ def train_dr_and_dme(train_data_loader, model, criterion, optimizer, epoch, disp
 
 def train_dme(train_data_loader, model, criterion, optimizer, epoch, display):
     model.train()
-    tot_pred_dr = np.array([], dtype=int)
-    tot_label_dr = np.array([], dtype=int)
-    tot_pred_dme = np.array([], dtype=int)
-    tot_label_dme = np.array([], dtype=int)
-    tot_pred_bin = np.array([], dtype=int)
-    tot_label_bin = np.array([], dtype=int)
+    confusion_dr = ConfusionMeter(5)
+    confusion_dme = ConfusionMeter(4)
+    confusion_bin = ConfusionMeter(2)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     accuracy = AverageMeter()
@@ -608,12 +574,9 @@ def train_dme(train_data_loader, model, criterion, optimizer, epoch, display):
         pred_bin = pred_bin.cpu().data.numpy().squeeze()
         label_bin = label_bin.numpy().squeeze()
 
-        tot_pred_dr = np.append(tot_pred_dr, pred_dr)
-        tot_label_dr = np.append(tot_label_dr, label_dr)
-        tot_pred_dme = np.append(tot_pred_dme, pred_dme)
-        tot_label_dme = np.append(tot_label_dme, label_dme)
-        tot_pred_bin = np.append(tot_pred_bin, pred_bin)
-        tot_label_bin = np.append(tot_label_bin, label_bin)
+        confusion_dr.update(label_dr, pred_dr)
+        confusion_dme.update(label_dme, pred_dme)
+        confusion_bin.update(label_bin, pred_bin)
 
 
         #precision
@@ -626,10 +589,10 @@ def train_dme(train_data_loader, model, criterion, optimizer, epoch, display):
 
 
         if index % display == 0:
-            dr_accuracy = np.equal(tot_pred_dr, tot_label_dr).sum()/len(tot_pred_dr)
-            dme_accuracy = np.equal(tot_pred_dme, tot_label_dme).sum()/len(tot_pred_dme)
-            dr_kappa = quadratic_weighted_kappa(tot_label_dr, tot_pred_dr)
-            dme_kappa = quadratic_weighted_kappa(tot_label_dme, tot_pred_dme)
+            dr_accuracy = confusion_dr.accuracy()
+            dme_accuracy = confusion_dme.accuracy()
+            dr_kappa = confusion_dr.kappa()
+            dme_kappa = confusion_dme.kappa()
             print_info = 'Epoch: [{epoch}][{iter}/{tot}]\t' \
                          'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t' \
                          'Data {data_time.avg:.3f}\t ' \
@@ -657,14 +620,11 @@ def train_dme(train_data_loader, model, criterion, optimizer, epoch, display):
 
     return logger
 
-def train_bin(train_data_loader, model, criterion, optimizer, epoch, display, dme_weight_aug_ratio=1):
+def train_bin(train_data_loader, model, criterion, optimizer, epoch, display, dme_weight_aug_ratio=1, checkpoint=None):
     model.train()
-    tot_pred_dr = np.array([], dtype=int)
-    tot_label_dr = np.array([], dtype=int)
-    tot_pred_dme = np.array([], dtype=int)
-    tot_label_dme = np.array([], dtype=int)
-    tot_pred_bin = np.array([], dtype=int)
-    tot_label_bin = np.array([], dtype=int)
+    confusion_dr = ConfusionMeter(5)
+    confusion_dme = ConfusionMeter(4)
+    confusion_bin = ConfusionMeter(2)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     accuracy = AverageMeter()
@@ -709,12 +669,9 @@ def train_bin(train_data_loader, model, criterion, optimizer, epoch, display, dm
         pred_bin = pred_bin.cpu().data.numpy().squeeze()
         label_bin = label_bin.numpy().squeeze()
 
-        tot_pred_dr = np.append(tot_pred_dr, pred_dr)
-        tot_label_dr = np.append(tot_label_dr, label_dr)
-        tot_pred_dme = np.append(tot_pred_dme, pred_dme)
-        tot_label_dme = np.append(tot_label_dme, label_dme)
-        tot_pred_bin = np.append(tot_pred_bin, pred_bin)
-        tot_label_bin = np.append(tot_label_bin, label_bin)
+        confusion_dr.update(label_dr, pred_dr)
+        confusion_dme.update(label_dme, pred_dme)
+        confusion_bin.update(label_bin, pred_bin)
 
 
         #precision
@@ -727,10 +684,10 @@ def train_bin(train_data_loader, model, criterion, optimizer, epoch, display, dm
 
 
         if index % display == 0:
-            dr_accuracy = np.equal(tot_pred_dr, tot_label_dr).sum()/len(tot_pred_dr)
-            dme_accuracy = np.equal(tot_pred_dme, tot_label_dme).sum()/len(tot_pred_dme)
-            dr_kappa = quadratic_weighted_kappa(tot_label_dr, tot_pred_dr)
-            dme_kappa = quadratic_weighted_kappa(tot_label_dme, tot_pred_dme)
+            dr_accuracy = confusion_dr.accuracy()
+            dme_accuracy = confusion_dme.accuracy()
+            dr_kappa = confusion_dr.kappa()
+            dme_kappa = confusion_dme.kappa()
             print_info = 'Epoch: [{epoch}][{iter}/{tot}]\t' \
                          'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t' \
                          'Data {data_time.avg:.3f}\t ' \
@@ -755,15 +712,19 @@ def train_bin(train_data_loader, model, criterion, optimizer, epoch, display, dm
                                                                )
             print(print_info)
             logger.append(print_info)
+        if checkpoint is not None:
+            checkpoint(index + 1)
 
     return logger
 
 def eval(eval_data_loader, model, criterion):
     model.eval()
-    tot_pred_dr = np.array([], dtype=int)
-    tot_label_dr = np.array([], dtype=int)
-    tot_pred_dme = np.array([], dtype=int)
-    tot_label_dme = np.array([], dtype=int)
+    tot_pred_dr = []
+    tot_label_dr = []
+    confusion_dr = ConfusionMeter(5)
+    tot_pred_dme = []
+    tot_label_dme = []
+    confusion_dme = ConfusionMeter(4)
     batch_time = AverageMeter()
     data_time = AverageMeter()
     accuracy = AverageMeter()
@@ -786,20 +747,22 @@ def eval(eval_data_loader, model, criterion):
         pred_dme = pred_dme.cpu().data.numpy().squeeze()
         label_dme = label_dme.numpy().squeeze()
 
-        tot_pred_dr = np.append(tot_pred_dr, pred_dr)
-        tot_label_dr = np.append(tot_label_dr, label_dr)
-        tot_pred_dme = np.append(tot_pred_dme, pred_dme)
-        tot_label_dme = np.append(tot_label_dme, label_dme)
+        tot_pred_dr.append(pred_dr)
+        tot_label_dr.append(label_dr)
+        confusion_dr.update(label_dr, pred_dr)
+        tot_pred_dme.append(pred_dme)
+        tot_label_dme.append(label_dme)
+        confusion_dme.update(label_dme, pred_dme)
 
         #precision
         losses_dr.update(loss_dr.data[0], len(image))
         losses_dme.update(loss_dme.data[0], len(image))
         losses.update(loss.data[0], len(image))
 
-        dr_accuracy = np.equal(tot_pred_dr, tot_label_dr).sum() / len(tot_pred_dr)
-        dme_accuracy = np.equal(tot_pred_dme, tot_label_dme).sum() / len(tot_pred_dme)
-        dr_kappa = quadratic_weighted_kappa(tot_label_dr, tot_pred_dr)
-        dme_kappa = quadratic_weighted_kappa(tot_label_dme, tot_pred_dme)
+        dr_accuracy = confusion_dr.accuracy()
+        dme_accuracy = confusion_dme.accuracy()
+        dr_kappa = confusion_dr.kappa()
+        dme_kappa = confusion_dme.kappa()
         print_info = 'Eval: [{iter}/{tot}]\t' \
                      'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t' \
                      'Data {data_time.avg:.3f}\t ' \
@@ -823,6 +786,11 @@ def eval(eval_data_loader, model, criterion):
         print(print_info)
         logger.append(print_info)
 
+    tot_pred_dr = np.hstack(tot_pred_dr)
+    tot_label_dr = np.hstack(tot_label_dr)
+    tot_pred_dme = np.hstack(tot_pred_dme)
+    tot_label_dme = np.hstack(tot_label_dme)
+
     return logger, dr_kappa, dme_kappa, tot_pred_dr, tot_label_dr, tot_pred_dme, tot_label_dme
 
 '''
@@ -861,24 +829,67 @@ def calc_sensitivity_specificity(pred, label):
 
     return sensitivity, specificity, f1
 
-def eval_bin(eval_data_loader, model, criterion):
+def eval_bin_state():
+    return MetricState(dr=ConfusionMeter(5), dme=ConfusionMeter(4), bin=ConfusionMeter(2), roc_bin=RocMeter(),
+                       joint=JointMeter((5, 4, 2)),
+                       accuracy=AverageMeter(), loss=AverageMeter(), loss_dr=AverageMeter(), loss_dme=AverageMeter(),
+                       loss_bin=AverageMeter())
+
+
+def eval_bin_state_info(state):
+    return '\n[DR kappa: {dr_kappa:.4f}\tDME kappa: {dme_kappa:.4f}\tTo_Treat accuracy: {acc.avg:.4f}\tTo_Treat auc: {auc:.4f}' \
+           '\tLoss {loss.avg:.4f}\tDR_Loss {dr_loss.avg:.4f}\tDME_Loss {dme_loss.avg:.4f}\tTo_Treat_Loss {bin_loss.avg:.4f}' \
+           '\ton {num} images]'.format(dr_kappa=state['dr'].kappa(), dme_kappa=state['dme'].kappa(), acc=state['accuracy'],
+                                      auc=state['roc_bin'].auc(), loss=state['loss'], dr_loss=state['loss_dr'],
+                                      dme_loss=state['loss_dme'], bin_loss=state['loss_bin'], num=state['dr'].count)
+
+
+def eval_bin_state_referable(state):
+    # To_Treat head and the referable rules over the (DR pred, DME pred) cells of the joint counts, scored against the To_Treat label
+    conf_bin = state['bin'].conf_mat
+    joint = state['joint']
+    _, sensitivity, specificity, f1 = binary_metrics(conf_bin[1, 1], conf_bin[0, 1], conf_bin[1, 0], conf_bin[0, 0])
+    logs = ['\nbinary cls accuracy: {0:.4f}\tsensitivity: {1:.4f}\t specificity: {2:.4f}\tf1 score: {3:.4f}'.format(
+        state['accuracy'].avg, sensitivity, specificity, f1)]
+    pred_dr_level = np.arange(5)[:, None]
+    pred_dme_level = np.arange(4)[None, :]
+    rules = [('DR', pred_dr_level >= 2), ('DME', pred_dme_level >= 1),
+             ('MIX', ~((pred_dme_level == 0) & (pred_dr_level <= 1)))]
+    for name, positive in rules:
+        logs.append('\n[{name} binary cls]: acc: {0:.4f}\tsensitivity: {1:.4f}\tspecificity: {2:.4f}\tf1 score: {3:.4f}'.format(
+            *joint.binary(positive), name=name))
+    logs.append('dr < 2 and dme >0 count is: {}'.format(joint.counts[:2, 1:].sum()))
+    logs.append('pred dme 0 count is: {}'.format(joint.counts[:, 0].sum()))
+    logs.append('label dme 0 count is: {}'.format(state['dme'].conf_mat[0].sum()))
+    return logs
+
+
+def eval_bin(eval_data_loader, model, criterion, num_boot=0, state_path=None, distributed=False, store=None):
     model.eval()
-    tot_pred_dr = np.array([], dtype=int)
-    tot_label_dr = np.array([], dtype=int)
-    tot_pred_dme = np.array([], dtype=int)
-    tot_label_dme = np.array([], dtype=int)
-    tot_pred_bin = np.array([], dtype=int)
-    tot_label_bin = np.array([], dtype=int)
-
-    tot_prob_bin = np.array([], dtype=float)
+    # every summary metric lives in the mergeable state, so test shards can be combined
+    state = eval_bin_state()
+    tot_pred_dr = []
+    tot_label_dr = []
+    confusion_dr = state['dr']
+    tot_pred_dme = []
+    tot_label_dme = []
+    confusion_dme = state['dme']
+    tot_pred_bin = []
+    tot_label_bin = []
+    confusion_bin = state['bin']
+    roc_bin = state['roc_bin']
+    # (DR prediction, DME prediction, To_Treat label) counts for the referable rules
+    joint = state['joint']
+    # per-sample probabilities are only kept when the bootstrap needs them
+    tot_prob_bin = []
 
     batch_time = AverageMeter()
     data_time = AverageMeter()
-    accuracy = AverageMeter()
-    losses_dr = AverageMeter()
-    losses_dme = AverageMeter()
-    losses_bin = AverageMeter()
-    losses = AverageMeter()
+    accuracy = state['accuracy']
+    losses_dr = state['loss_dr']
+    losses_dme = state['loss_dme']
+    losses_bin = state['loss_bin']
+    losses = state['loss']
     end = time.time()
     logger = []
     for index, (image, label_dr, label_dme, label_bin) in enumerate(eval_data_loader):
@@ -892,12 +903,17 @@ def eval_bin(eval_data_loader, model, criterion):
         _,pred_dr = torch.max(o_dr, 1)
         _,pred_dme = torch.max(o_dme, 1)
         _, pred_bin = torch.max(o_bin, 1)
+        if store is not None:
+            store.update({'dr': o_dr.cpu().data.numpy(), 'dme': o_dme.cpu().data.numpy(), 'bin': o_bin.cpu().data.numpy()},
+                         {'dr': label_dr.numpy(), 'dme': label_dme.numpy(), 'bin': label_bin.numpy()})
 
         m = torch.nn.Softmax()
         prop = m(o_bin).data
         res_prop = prop.cpu().numpy()
         res_prop = res_prop[:,1]
-        tot_prob_bin = np.append(tot_prob_bin, res_prop)
+        roc_bin.update(label_bin.numpy(), res_prop)
+        if num_boot > 0:
+            tot_prob_bin.append(res_prop)
 
         pred_dr = pred_dr.cpu().data.numpy().squeeze()
         label_dr = label_dr.numpy().squeeze()
@@ -906,12 +922,16 @@ def eval_bin(eval_data_loader, model, criterion):
         pred_bin = pred_bin.cpu().data.numpy().squeeze()
         label_bin = label_bin.numpy().squeeze()
 
-        tot_pred_dr = np.append(tot_pred_dr, pred_dr)
-        tot_label_dr = np.append(tot_label_dr, label_dr)
-        tot_pred_dme = np.append(tot_pred_dme, pred_dme)
-        tot_label_dme = np.append(tot_label_dme, label_dme)
-        tot_pred_bin = np.append(tot_pred_bin, pred_bin)
-        tot_label_bin = np.append(tot_label_bin, label_bin)
+        tot_pred_dr.append(pred_dr)
+        tot_label_dr.append(label_dr)
+        confusion_dr.update(label_dr, pred_dr)
+        tot_pred_dme.append(pred_dme)
+        tot_label_dme.append(label_dme)
+        confusion_dme.update(label_dme, pred_dme)
+        tot_pred_bin.append(pred_bin)
+        tot_label_bin.append(label_bin)
+        confusion_bin.update(label_bin, pred_bin)
+        joint.update(pred_dr, pred_dme, label_bin)
 
         #precision
         losses_dr.update(loss_dr.data[0], len(image))
@@ -919,10 +939,10 @@ def eval_bin(eval_data_loader, model, criterion):
         losses_bin.update(loss_bin.data[0], len(image))
         losses.update(loss.data[0], len(image))
 
-        dr_accuracy = np.equal(tot_pred_dr, tot_label_dr).sum() / len(tot_pred_dr)
-        dme_accuracy = np.equal(tot_pred_dme, tot_label_dme).sum() / len(tot_pred_dme)
-        dr_kappa = quadratic_weighted_kappa(tot_label_dr, tot_pred_dr)
-        dme_kappa = quadratic_weighted_kappa(tot_label_dme, tot_pred_dme)
+        dr_accuracy = confusion_dr.accuracy()
+        dme_accuracy = confusion_dme.accuracy()
+        dr_kappa = confusion_dr.kappa()
+        dme_kappa = confusion_dme.kappa()
 
         accuracy.update(np.equal(pred_bin, label_bin).sum() / len(label_bin), len(label_bin))
 
@@ -953,13 +973,30 @@ def eval_bin(eval_data_loader, model, criterion):
         print(print_info)
         logger.append(print_info)
 
-    fpr, tpr, _ = roc_curve(tot_label_bin, tot_prob_bin)
-    roc_auc = auc(fpr, tpr)
+    if state_path is not None:
+        state.save(state_path)
+    if distributed:
+        # kappa/auc/accuracy/loss below cover every shard, the per-image lists stay local
+        state.all_reduce()
+        dr_kappa = confusion_dr.kappa()
+        dme_kappa = confusion_dme.kappa()
+        log_state = '\n[all-reduced over {} processes]'.format(dist.get_world_size()) + eval_bin_state_info(state)
+        print(log_state)
+        logger.append(log_state)
+
+    tot_pred_dr = np.hstack(tot_pred_dr)
+    tot_label_dr = np.hstack(tot_label_dr)
+    tot_pred_dme = np.hstack(tot_pred_dme)
+    tot_label_dme = np.hstack(tot_label_dme)
+    tot_pred_bin = np.hstack(tot_pred_bin)
+    tot_label_bin = np.hstack(tot_label_bin)
+
+    fpr, tpr, _ = roc_bin.curve()
+    roc_auc = roc_bin.auc()
     print('fpr: {}'.format(fpr))
     print('tpr: {}'.format(tpr))
     print('ground truth label: {}'.format(tot_label_bin))
-    print('probability label: {}'.format(tot_prob_bin))
-    print('roc_auc: {}'.format(roc_auc))
+    print('roc_auc: {} (+/- {:.5f} from {} score bins)'.format(roc_auc, roc_bin.auc_error(), roc_bin.num_bins))
 
 
     import matplotlib.pyplot as plt
@@ -992,83 +1029,24 @@ def eval_bin(eval_data_loader, model, criterion):
     plt.show()
 
 
-    sensitivity, specificity, f1 = calc_sensitivity_specificity(tot_pred_bin, tot_label_bin)
-    print_info1 = '\nbinary cls accuracy: {0:.4f}\tsensitivity: {1:.4f}\t specificity: {2:.4f}\tf1 score: {3:.4f}'.format(accuracy.avg, sensitivity, specificity, f1)
-    logger.append(print_info1)
-    print(print_info1)
-
-    tot_pred_dr_bin = [0 if x <=1 else 1 for x in tot_pred_dr]
-    # tot_label_dr_bin = [0 if x <= 1 else 1 for x in tot_label_dr]
-    tot_label_dr_bin = tot_label_bin
-    dr_bin_accuray = np.equal(tot_pred_dr_bin, tot_label_dr_bin).sum() / len(tot_label_dr_bin)
-    dr_s1, dr_s2, dr_f1 = calc_sensitivity_specificity(tot_pred_dr_bin, tot_label_dr_bin)
-
-    log_dr_bin_cls = '\n[DR binary cls]: acc: {acc:.4f}\tsensitivity: {s1:.4f}\tspecificity: {s2:.4f}\tf1 score: {f1:.4f}'.format(
-        acc = dr_bin_accuray,
-        s1 = dr_s1,
-        s2 = dr_s2, f1 = dr_f1
-    )
-
-    print(log_dr_bin_cls)
-
-    logger.append(log_dr_bin_cls)
-
-
-    tot_pred_dme_bin = [0 if x < 1 else 1 for x in tot_pred_dme]
-    # tot_label_dme_bin = [0 if x < 1 else 1 for x in tot_label_dme]
-    tot_label_dme_bin = tot_label_bin
-    dme_bin_accuray = np.equal(tot_pred_dme_bin, tot_label_dme_bin).sum() / len(tot_label_dme_bin)
-    calc_sensitivity_specificity(tot_pred_dme_bin, tot_label_dme_bin)
-    dme_s1, dme_s2, dme_f1 = calc_sensitivity_specificity(tot_pred_dme_bin, tot_label_dme_bin)
-    log_dme_bin_cls = '\n[DME binary cls]: acc: {acc:.4f}\tsensitivity: {s1:.4f}\tspecificity: {s2:.4f}\tf1 score: {f1:.4f}'.format(
-        acc=dme_bin_accuray,
-        s1=dme_s1,
-        s2=dme_s2, f1 = dme_f1
-    )
-    print(log_dme_bin_cls)
-    logger.append(log_dme_bin_cls)
-
-    # tot_pred_mix_bin = [0 if (x < 1 or y <=1) else 1 for x in tot_pred_dme for y in tot_pred_dr]
-    cnt = 0
-    for i in range(len(tot_pred_dr)):
-        numdr = tot_pred_dr[i]
-        numdme = tot_pred_dme[i]
-        if numdr < 2:
-            if numdme > 0:
-                cnt += 1
-
-    print('dr < 2 and dme >0 count is: {}'.format(cnt))
-
-    cnt = 0
-    for i in range(len(tot_pred_dr)):
-        if tot_pred_dme[i] == 0:
-            cnt += 1
-    print('pred dme 0 count is: {}'.format(cnt))
-
-    cnt = 0
-    for i in range(len(tot_pred_dr)):
-        if tot_label_dme[i] == 0:
-            cnt += 1
-    print('label dme 0 count is: {}'.format(cnt))
-
-    tot_pred_mix_bin = [0 if (tot_pred_dme[i] == 0 and tot_pred_dr[i] <= 1) else 1 for i in range(len(tot_pred_dme))]
-    # tot_label_mix_bin = [0 if (x < 1 or y <=1) else 1 for x in tot_label_dme for y in tot_label_dr]
-    # tot_label_mix_bin = [0 if (tot_label_dme[i] < 1 and tot_label_dr[i] <= 1) else 1 for i in range(len(tot_label_dme))]
-    tot_label_mix_bin = tot_label_bin
-    mix_bin_accuray = np.equal(tot_pred_mix_bin, tot_label_mix_bin).sum() / len(tot_label_mix_bin)
-    calc_sensitivity_specificity(tot_pred_mix_bin, tot_label_mix_bin)
-    mix_s1, mix_s2, mix_f1 = calc_sensitivity_specificity(tot_pred_mix_bin, tot_label_mix_bin)
-    log_mix_bin_cls = '\n[MIX binary cls]: acc: {acc:.4f}\tsensitivity: {s1:.4f}\tspecificity: {s2:.4f}\tf1 score: {f1:.4f}'.format(
-        acc=mix_bin_accuray,
-        s1=mix_s1,
-        s2=mix_s2, f1 = mix_f1
-    )
-    print(log_mix_bin_cls)
-    logger.append(log_mix_bin_cls)
+    for log_referable in eval_bin_state_referable(state):
+        print(log_referable)
+        logger.append(log_referable)
+
+    if num_boot > 0:
+        tot_prob_bin = np.hstack(tot_prob_bin)
+        bootstrap_res = [('DR', bootstrap_metrics(tot_label_dr, tot_pred_dr, num_classes=5, num_boot=num_boot)),
+                         ('DME', bootstrap_metrics(tot_label_dme, tot_pred_dme, num_classes=4, num_boot=num_boot)),
+                         ('To_Treat', bootstrap_metrics(tot_label_bin, tot_pred_bin, tot_prob_bin, num_classes=2, num_boot=num_boot))]
+        for name, res in bootstrap_res:
+            log_bootstrap = '\n[{name} bootstrap 95% CI, {num} resamples]: '.format(name=name, num=num_boot) + \
+                            '\t'.join('{0}: {1:.4f} ({2:.4f}-{3:.4f})'.format(metric, *res[metric]) for metric in sorted(res))
+            print(log_bootstrap)
+            logger.append(log_bootstrap)
 
     return logger, dr_kappa, dme_kappa, tot_pred_dr, tot_label_dr, tot_pred_dme, tot_label_dme, accuracy.avg
 
-def infer_bin(eval_data_loader, model, refer_root):
+def infer_bin(eval_data_loader, model, refer_root, threshold=None):
     model.eval()
     tot_pred_dr = np.array([], dtype=int)
     tot_label_dr = np.array([], dtype=int)
@@ -1093,6 +1071,8 @@ def infer_bin(eval_data_loader, model, refer_root):
         pred_dr = pred_dr.cpu().data.numpy().squeeze()
         pred_dme = pred_dme.cpu().data.numpy().squeeze()
         pred_bin = pred_bin.cpu().data.numpy().squeeze()
+        if threshold is not None:
+            pred_bin = (F.softmax(o_bin).data.cpu().numpy()[:, 1] >= threshold).astype(int)
 
         tot_pred_dr = np.append(tot_pred_dr, pred_dr)
         tot_pred_dme = np.append(tot_pred_dme, pred_dme)
@@ -1130,6 +1110,30 @@ def train_test():
     for epoch in range(3):
         logger = train(train_dataloader, nn.DataParallel(model).cuda(), criterion, optimizer, epoch, 10)
 
+def save_resume(path, epoch, model, optimizer, sampler, best):
+    '''
+    Everything a preempted run needs to continue mid-epoch: the weights, the optimizer momentum, the sampler
+    permutation, position and RNG, and the best metrics so far. Written to a temporary file first, so a job killed
+    while saving keeps the previous checkpoint.
+    '''
+    torch.save({'epoch': epoch, 'model': model.state_dict(), 'optimizer': optimizer.state_dict(),
+                'sampler': sampler.state_dict(), 'best': [float(b) for b in best]}, path + '.tmp')
+    os.rename(path + '.tmp', path)
+
+
+def load_resume(path, model, sampler, device='cuda'):
+    '''
+    Restores a save_resume checkpoint into model and sampler and returns it. The model is moved to device here,
+    before any optimizer is built: Optimizer.load_state_dict casts the momentum buffers to the device of the
+    params at that moment, and a later .cuda() only moves the params.
+    '''
+    resume = torch.load(path, map_location=lambda storage, loc: storage)
+    model.load_state_dict(resume['model'])
+    model.to(device)
+    sampler.load_state_dict(resume['sampler'])
+    return resume
+
+
 def main():
     print('===> Parsing options')
     opt = parse_args()
@@ -1141,26 +1145,52 @@ def main():
     time_stamp = time.strftime('%Y%m%d%H%M%S', time.localtime(time.time()))
     output_dir = os.path.join(opt.output,
                               opt.dataset + '_multi_task_cls_' + opt.phase + '_' + time_stamp + '_' + opt.model + '_' + opt.exp)
+    if opt.resume:
+        # a resumed run keeps writing to the directory of the interrupted one
+        output_dir = os.path.dirname(os.path.abspath(opt.resume))
     if not os.path.exists(output_dir):
         print('====> Creating ', output_dir)
         os.makedirs(output_dir)
 
+    if opt.phase == 'merge':
+        # combine the metric states written by sharded test runs, no model needed
+        state = eval_bin_state().merge_files(opt.states)
+        logger = ['\n[merged {} test shards]'.format(len(opt.states)) + eval_bin_state_info(state),
+                  '\nroc_auc: {} (+/- {:.5f} from {} score bins)'.format(state['roc_bin'].auc(), state['roc_bin'].auc_error(),
+                                                                      state['roc_bin'].num_bins)]
+        logger += eval_bin_state_referable(state)
+        print('\n'.join(logger))
+        with open(os.path.join(output_dir, 'test.log'), 'w') as fp:
+            fp.write(str(opt) + '\n')
+            fp.write('\n'.join(logger))
+        return
+
     print('====> Building model:')
     model = multi_task_model(opt.model, inmap=opt.crop, multi_classes=[5, 4], weights=opt.weight)
     criterion = nn.CrossEntropyLoss().cuda()
 
     if opt.phase == 'train':
         print('====> Training model:')
-        dataset_train = DataLoader(MultiTaskClsDataSet(opt.root, opt.traincsv, opt.crop, opt.size),
+        train_set = MultiTaskClsDataSet(opt.root, opt.traincsv, opt.crop, opt.size)
+        train_sampler = ResumableSampler(len(train_set), opt.seed)
+        dataset_train = prefetch(DataLoader(train_set,
+                                  batch_size=opt.batch, sampler=train_sampler,
+                                  num_workers=opt.workers, pin_memory=True), opt.prefetch)
+        dataset_val = prefetch(DataLoader(MultiTaskClsValDataSet(opt.root, opt.valcsv, opt.crop, opt.size, cache_bytes=int(opt.cache * (1 << 30))),
                                   batch_size=opt.batch,
-                                  shuffle=True, num_workers=opt.workers, pin_memory=True)
-        dataset_val = DataLoader(MultiTaskClsValDataSet(opt.root, opt.valcsv, opt.crop, opt.size),
-                                  batch_size=opt.batch,
-                                  shuffle=False, num_workers=opt.workers, pin_memory=False)
+                                  shuffle=False, num_workers=opt.workers, pin_memory=False), opt.prefetch)
         kp_dr_best = 0
         kp_dme_best = 0
         bin_acc_best = 0
-        for epoch in range(opt.epoch):
+        resume_path = os.path.join(output_dir, 'resume.pth')
+        resume = None
+        start_epoch = 0
+        if opt.resume:
+            resume = load_resume(opt.resume, model, train_sampler)
+            kp_dr_best, kp_dme_best, bin_acc_best = resume['best']
+            start_epoch = resume['epoch']
+            print('====> Resuming epoch {} at sample {} of {}'.format(start_epoch, train_sampler.position, len(train_set)))
+        for epoch in range(start_epoch, opt.epoch):
             if epoch < opt.fix:
                 lr = opt.lr
             else:
@@ -1216,11 +1246,27 @@ def main():
             # logger = train_dr_and_dme(dataset_train, nn.DataParallel(model).cuda(), criterion, optimizer, epoch,
             #                           opt.display)
 
+            if resume is not None and resume['epoch'] == epoch and resume['sampler']['position'] < len(train_set):
+                # the optimizers are rebuilt every epoch, the momentum only carries over within one
+                optimizer_bin_con.load_state_dict(resume['optimizer'])
+
+            def checkpoint(batches, epoch=epoch, optimizer=optimizer_bin_con):
+                train_sampler.advance(batches * opt.batch)
+                if opt.save_every > 0 and batches % opt.save_every == 0 and train_sampler.position < len(train_set):
+                    save_resume(resume_path, epoch, model, optimizer, train_sampler, [kp_dr_best, kp_dme_best, bin_acc_best])
+
             logger = train_bin(dataset_train, nn.DataParallel(model).cuda(), criterion, optimizer_bin_con, epoch,
-                                      opt.display, opt.dme_weight_aug)
+                                      opt.display, opt.dme_weight_aug, checkpoint)
+            if opt.prefetch:
+                logger.append('Prefetch: {}'.format(dataset_train.stats()))
+                print('====> ' + logger[-1])
 
             # logger_val, kp_dr, kp_dme, _,_,_,_ = eval(dataset_val, nn.DataParallel(model).cuda(), criterion)
             logger_val, kp_dr, kp_dme, _, _, _, _, acc = eval_bin(dataset_val, nn.DataParallel(model).cuda(), criterion)
+            if dataset_val.dataset.cache is not None:
+                print('====> Val image cache: {}'.format(dataset_val.dataset.cache.stats()))
+            if opt.prefetch:
+                print('====> Val prefetch: {}'.format(dataset_val.stats()))
 
             if kp_dr > kp_dr_best:
                 print('\ncurrent best dr kappa is: {}\n'.format(kp_dr))
@@ -1253,13 +1299,24 @@ def main():
             with open(os.path.join(output_dir, 'train.log'), 'a') as fp:
                 fp.write('\n' + '\n'.join(logger))
                 fp.write('\n' + '\n'.join(logger_val))
+            if opt.save_every > 0:
+                save_resume(resume_path, epoch + 1, model, optimizer_bin_con, train_sampler, [kp_dr_best, kp_dme_best, bin_acc_best])
     elif opt.phase == 'test':
         if opt.weight:
             print('====> Evaluating model')
-            dataset_test = DataLoader(MultiTaskClsValDataSet(opt.root, opt.testcsv, opt.crop, opt.size),
-                                  batch_size=opt.batch,
-                                  shuffle=False, num_workers=opt.workers, pin_memory=False)
-            logger_val, kp_dr, kp_dme, pred_dr, label_dr, pred_dme, label_dme, _ = eval_bin(dataset_test, nn.DataParallel(model).cuda(), criterion)
+            test_set = MultiTaskClsValDataSet(opt.root, opt.testcsv, opt.crop, opt.size)
+            # shard i of n evaluates every n-th image starting at i
+            test_sampler = list(range(opt.rank, len(test_set), opt.world_size)) if opt.world_size > 1 else None
+            dataset_test = prefetch(DataLoader(test_set,
+                                  batch_size=opt.batch, sampler=test_sampler,
+                                  shuffle=False, num_workers=opt.workers, pin_memory=False), opt.prefetch)
+            distributed = opt.world_size > 1 and opt.dist_url is not None
+            if distributed:
+                dist.init_process_group('gloo', init_method=opt.dist_url, world_size=opt.world_size, rank=opt.rank)
+            store = LogitWriter(os.path.join(output_dir, 'logits'))
+            logger_val, kp_dr, kp_dme, pred_dr, label_dr, pred_dme, label_dme, _ = eval_bin(dataset_test, nn.DataParallel(model).cuda(), criterion, opt.bootstrap,
+                                                                                            os.path.join(output_dir, 'metric_state_%03d.pkl' % opt.rank), distributed, store)
+            store.close([test_set.images_list[i][0] for i in (test_sampler or range(len(test_set)))])
             print('===> DR Kappa: %.4f' % kp_dr)
             print('===> Confusion Matrix:')
             dr_confusion_matrix = str(confusion_matrix(label_dr, pred_dr))
@@ -1281,8 +1338,8 @@ def main():
                 fp.write('\n====> DME Kappa: %.4f' % kp_dme)
                 fp.write('\n')
                 fp.write(dme_confusion_matrix)
-            np.save(os.path.join(output_dir, 'results_dr.npy'), pred_dr, label_dr, confusion_matrix(label_dr, pred_dr))
-            np.save(os.path.join(output_dir, 'results_dme.npy'), pred_dme, label_dme, confusion_matrix(label_dme, pred_dme))
+            np.savez(os.path.join(output_dir, 'results_dr.npz'), pred=pred_dr, label=label_dr, confusion=confusion_matrix(label_dr, pred_dr))
+            np.savez(os.path.join(output_dir, 'results_dme.npz'), pred=pred_dme, label=label_dme, confusion=confusion_matrix(label_dme, pred_dme))
         else:
             raise Exception('No weights found!')
     elif opt.phase == 'infer':
@@ -1291,7 +1348,7 @@ def main():
             dataset_refer = DataLoader(MultiTaskClsInferenceDataSet(opt.infer_root, opt.crop, opt.size),
                                   batch_size=opt.batch,
                                   shuffle=False, num_workers=opt.workers, pin_memory=False)
-            logger_val = infer_bin(dataset_refer, nn.DataParallel(model).cuda(), opt.infer_root)
+            logger_val = infer_bin(dataset_refer, nn.DataParallel(model).cuda(), opt.infer_root, load_operating_point(opt.weight))
         else:
             raise Exception('No weights found!')
     else:
@@ -0,0 +1,188 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import argparse
+from glob import glob
+
+'''
+Indexes the run directories written by the training scripts (output/<dataset>_..._<timestamp>_<model>_<exp>/)
+into a sqlite database:
+
+runs:        one row per run directory with its model, dataset, phase, timestamp and options (the
+             Namespace(...) line the scripts write at the top of every log)
+metrics:     per phase ('train', 'val', 'test'), epoch and head the last value of every metric of
+             that epoch, e.g. ('val', 12, 'dme', 'kappa', 0.71); a summary line tagged with a head, e.g.
+             "[DME binary cls]: acc: 0.93", is stored under that head with the rest of the tag in the metric
+             name: ('val', 12, 'dme', 'binary_cls_acc', 0.93)
+checkpoints: the *_best.pth files with their epoch
+files:       size and mtime of every indexed log, only logs that changed are parsed again
+
+python experiment_index.py --output ../output ../paper_data/output
+python experiment_index.py --output ../paper_data/output --best dme_kappa --phase val
+'''
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, path TEXT UNIQUE, name TEXT, model TEXT, dataset TEXT,
+                                 phase TEXT, exp TEXT, timestamp TEXT, options TEXT);
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, run_id INTEGER, size INTEGER, mtime REAL);
+CREATE TABLE IF NOT EXISTS metrics (run_id INTEGER, file TEXT, phase TEXT, epoch INTEGER, head TEXT, metric TEXT, value REAL);
+CREATE TABLE IF NOT EXISTS checkpoints (run_id INTEGER, path TEXT UNIQUE, head TEXT, epoch INTEGER);
+CREATE INDEX IF NOT EXISTS metrics_key ON metrics (head, metric, phase);
+CREATE INDEX IF NOT EXISTS metrics_run ON metrics (run_id);
+CREATE INDEX IF NOT EXISTS metrics_file ON metrics (file);
+'''
+
+LOG_PHASES = {'train.log': 'train', 'val.log': 'val', 'test.log': 'test'}
+# timing columns of the progress lines are not metrics
+SKIPPED = {'time', 'data'}
+HEADS = ['to_treat', 'dr', 'dme', 'bin', 'mix']
+
+epoch_pattern = re.compile(r'Epoch: \[(\d+)\]')
+value_pattern = re.compile(r'([A-Za-z][A-Za-z0-9_ ]*?)\s*:?\s+(-?\d+\.\d+)(?:\s*\((-?\d+\.\d+)\))?')
+# a leading "[DR binary cls]:" or "[DME Referable:]" tag, not a bracketed list of metrics like "[DR kappa: 0.7 ...]"
+tag_pattern = re.compile(r'^\s*\[([^\]:]*):?\]\s*:?')
+option_pattern = re.compile(r'(\w+)=(\'[^\']*\'|"[^"]*"|\[[^\]]*\]|[^,)]+)')
+timestamp_pattern = re.compile(r'_(\d{14})_')
+checkpoint_pattern = re.compile(r'_(\d{3})_best\.pth$')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='index training/eval logs into sqlite')
+    parser.add_argument('--output', nargs='+', default=['output'], help='The output dirs holding the run directories')
+    parser.add_argument('--db', default='experiments.db', help='The sqlite database')
+    parser.add_argument('--best', default=None, help='Print the best value of <head>_<metric> (e.g. dme_kappa) per model')
+    parser.add_argument('--phase', default='val', help='The phase of the --best query')
+    parser.add_argument('--lowest', action='store_true', help='Lower is better for the --best metric, e.g. loss')
+    return parser.parse_args()
+
+
+def split_metric(name):
+    name = name.strip().lower().replace(' ', '_')
+    for head in HEADS:
+        if name.startswith(head + '_'):
+            return head, name[len(head) + 1:]
+    return '', name
+
+
+def split_tag(line):
+    '''
+    (prefix, rest of the line): the tag words without numbers when the tag starts with one of HEADS
+    ("[DR bootstrap 95% CI, 1000 resamples]:" -> 'dr bootstrap ci resamples'), else '' and the tag is dropped
+    '''
+    match = tag_pattern.match(line)
+    if not match:
+        return '', line
+    words = [word for word in match.group(1).lower().replace(',', ' ').split() if re.match(r'^[a-z_]+$', word)]
+    prefix = ' '.join(words) if words and words[0] in HEADS else ''
+    return prefix, line[match.end():]
+
+
+def parse_options(line):
+    line = line.strip()
+    if not line.startswith('Namespace('):
+        return None
+    return dict((k, v.strip('\'"')) for k, v in option_pattern.findall(line[len('Namespace('):]))
+
+
+def parse_log(path, phase):
+    '''
+    Returns the run options and {(phase, epoch, head, metric): value}; progress lines are running
+    averages, so the last line of an epoch is kept. In train.log the Eval lines and the summary lines
+    after them, up to the next Epoch line, belong to the validation of the last training epoch.
+    '''
+    options = None
+    values = {}
+    epoch = None
+    in_eval = False
+    with open(path, 'r') as fp:
+        for line in fp:
+            if options is None:
+                options = parse_options(line)
+            match = epoch_pattern.search(line)
+            if match:
+                epoch = int(match.group(1))
+                in_eval = False
+            elif line.lstrip().startswith('Eval') and phase == 'train':
+                in_eval = True
+            line_phase = 'val' if in_eval else phase
+            prefix, line = split_tag(line.lstrip('=> '))
+            for name, value, avg in value_pattern.findall(line):
+                head, metric = split_metric((prefix + ' ' + name.lstrip('[ ')).strip())
+                if not metric or metric in SKIPPED:
+                    continue
+                values[(line_phase, epoch, head, metric)] = float(avg or value)
+    return options, values
+
+
+def run_info(path):
+    name = os.path.basename(os.path.normpath(path))
+    match = timestamp_pattern.search(name)
+    return name, match.group(1) if match else None
+
+
+def index_runs(conn, outputs):
+    cur = conn.cursor()
+    num_parsed = 0
+    for output in outputs:
+        for run_dir in sorted(glob(os.path.join(output, '*'))):
+            if not os.path.isdir(run_dir):
+                continue
+            run_dir = os.path.abspath(run_dir)
+            name, timestamp = run_info(run_dir)
+            cur.execute('INSERT OR IGNORE INTO runs (path, name, timestamp) VALUES (?, ?, ?)', (run_dir, name, timestamp))
+            run_id = cur.execute('SELECT id FROM runs WHERE path = ?', (run_dir,)).fetchone()[0]
+            for log_name, phase in LOG_PHASES.items():
+                log = os.path.join(run_dir, log_name)
+                if not os.path.isfile(log):
+                    continue
+                stat = os.stat(log)
+                known = cur.execute('SELECT size, mtime FROM files WHERE path = ?', (log,)).fetchone()
+                if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime:
+                    continue
+                options, values = parse_log(log, phase)
+                cur.execute('DELETE FROM metrics WHERE file = ?', (log,))
+                cur.executemany('INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                [(run_id, log, p, e, h, m, v) for (p, e, h, m), v in values.items()])
+                if options:
+                    cur.execute('UPDATE runs SET model = ?, dataset = ?, phase = ?, exp = ?, options = ? WHERE id = ?',
+                                (options.get('model'), options.get('dataset'), options.get('phase'), options.get('exp'),
+                                 json.dumps(options, sort_keys=True), run_id))
+                cur.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (log, run_id, stat.st_size, stat.st_mtime))
+                num_parsed += 1
+            for checkpoint in glob(os.path.join(run_dir, '*_best.pth')):
+                match = checkpoint_pattern.search(checkpoint)
+                head = [h for h in HEADS if '_' + h + '_' in os.path.basename(checkpoint)]
+                cur.execute('INSERT OR IGNORE INTO checkpoints VALUES (?, ?, ?, ?)',
+                            (run_id, checkpoint, head[0] if head else '', int(match.group(1)) if match else None))
+    conn.commit()
+    return num_parsed
+
+
+def best_per_model(conn, name, phase, lowest=False):
+    head, metric = split_metric(name)
+    order = 'MIN' if lowest else 'MAX'
+    return conn.execute('SELECT runs.model, {0}(metrics.value), runs.name, metrics.epoch FROM metrics JOIN runs ON runs.id = metrics.run_id '
+                        'WHERE metrics.head = ? AND metrics.metric = ? AND metrics.phase = ? '
+                        'GROUP BY runs.model ORDER BY {0}(metrics.value) {1}'.format(order, 'ASC' if lowest else 'DESC'), (head, metric, phase)).fetchall()
+
+
+def main():
+    opt = parse_args()
+    conn = sqlite3.connect(opt.db)
+    conn.executescript(SCHEMA)
+    start = time.time()
+    num_parsed = index_runs(conn, opt.output)
+    print('====> indexed {} changed logs in {:.2f}s'.format(num_parsed, time.time() - start))
+    if opt.best:
+        start = time.time()
+        rows = best_per_model(conn, opt.best, opt.phase, opt.lowest)
+        print('====> best {} ({}) per model, {:.1f}ms'.format(opt.best, opt.phase, 1000 * (time.time() - start)))
+        for model, value, run, epoch in rows:
+            print('{}\t{:.4f}\t{}\tepoch {}'.format(model, value, run, epoch))
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,119 +1,33 @@
 import numpy as np
-import math, random, torch, pickle
+import math, random, torch, pickle, time, threading
+import torch.nn.functional as F
+from torch.utils.data.dataloader import default_collate
+from queue import Queue, Full
 from PIL import Image, ImageOps, ImageFilter, ImageEnhance
+from metrics import *
 
 
-class AverageMeter(object):
-	"""Computes and stores the average and current value"""
-
-	def __init__(self):
-		self.reset()
+class LabelTable(object):
+	"""
+	The rows of a dataset csv (index, image, label columns...) kept as two arrays: the image ids packed
+	into one fixed-width utf-8 bytes array and the labels in one (rows, columns) int64 array. Loader
+	workers forked from the dataset then share the pages instead of touching one pandas Series per row.
+	table[i] is (image, label0, label1, ...) like the iterrows() rows the datasets used to keep.
+	"""
 
-	def reset(self):
-		self.val = 0
-		self.avg = 0
-		self.sum = 0
-		self.count = 0
+	def __init__(self, config):
+		import pandas as pd
+		df = pd.read_csv(config, index_col=0)
+		self.ids = np.array([str(image).encode('utf-8') for image in df.iloc[:, 0]], dtype=np.bytes_)
+		self.labels = np.ascontiguousarray(df.iloc[:, 1:].values, dtype=np.int64)
+		self.columns = list(df.columns)
 
-	def update(self, val, n=1):
-		self.val = val
-		self.sum += val * n
-		self.count += n
-		self.avg = self.sum / self.count
+	def __getitem__(self, item):
+		return (self.ids[item].decode('utf-8'),) + tuple(self.labels[item])
 
+	def __len__(self):
+		return len(self.ids)
 
-"""Quadratic weighted kappa metric.
-   Source: https://github.com/sveitser/kaggle_diabetic/blob/master/quadratic_weighted_kappa.py
-   Origin: https://github.com/benhamner/Metrics/blob/master/Python/ml_metrics/quadratic_weighted_kappa.py
-"""
-
-
-def kappa_confusion_matrix(rater_a, rater_b, min_rating=None, max_rating=None):
-	"""
-	Returns the confusion matrix between rater's ratings
-	"""
-	assert (len(rater_a) == len(rater_b))
-	if min_rating is None:
-		min_rating = min(rater_a + rater_b)
-	if max_rating is None:
-		max_rating = max(rater_a + rater_b)
-	num_ratings = int(max_rating - min_rating + 1)
-	conf_mat = [[0 for i in range(num_ratings)]
-	            for j in range(num_ratings)]
-	for a, b in zip(rater_a, rater_b):
-		conf_mat[a - min_rating][b - min_rating] += 1
-	return conf_mat
-
-
-def kappa_histogram(ratings, min_rating=None, max_rating=None):
-	"""
-	Returns the counts of each type of rating that a rater made
-	"""
-	if min_rating is None:
-		min_rating = min(ratings)
-	if max_rating is None:
-		max_rating = max(ratings)
-	num_ratings = int(max_rating - min_rating + 1)
-	hist_ratings = [0 for x in range(num_ratings)]
-	for r in ratings:
-		hist_ratings[r - min_rating] += 1
-	return hist_ratings
-
-
-def quadratic_weighted_kappa(rater_a, rater_b, min_rating=0, max_rating=4):
-	"""
-	Calculates the quadratic weighted kappa
-	quadratic_weighted_kappa calculates the quadratic weighted kappa
-	value, which is a measure of inter-rater agreement between two raters
-	that provide discrete numeric ratings.  Potential values range from -1
-	(representing complete disagreement) to 1 (representing complete
-	agreement).  A kappa value of 0 is expected if all agreement is due to
-	chance.
-
-	quadratic_weighted_kappa(rater_a, rater_b), where rater_a and rater_b
-	each correspond to a list of integer ratings.  These lists must have the
-	same lengtorch.
-
-	The ratings should be integers, and it is assumed that they contain
-	the complete range of possible ratings.
-
-	quadratic_weighted_kappa(X, min_rating, max_rating), where min_rating
-	is the minimum possible rating, and max_rating is the maximum possible
-	rating
-	"""
-	rater_a = np.clip(rater_a, min_rating, max_rating)
-	rater_b = np.clip(rater_b, min_rating, max_rating)
-
-	rater_a = np.round(rater_a).astype(int).ravel()
-	rater_a[~np.isfinite(rater_a)] = 0
-	rater_b = np.round(rater_b).astype(int).ravel()
-	rater_b[~np.isfinite(rater_b)] = 0
-
-	assert (len(rater_a) == len(rater_b))
-	if min_rating is None:
-		min_rating = min(min(rater_a), min(rater_b))
-	if max_rating is None:
-		max_rating = max(max(rater_a), max(rater_b))
-	conf_mat = kappa_confusion_matrix(rater_a, rater_b, min_rating, max_rating)
-	num_ratings = len(conf_mat)
-	num_scored_items = float(len(rater_a))
-
-	hist_rater_a = kappa_histogram(rater_a, min_rating, max_rating)
-	hist_rater_b = kappa_histogram(rater_b, min_rating, max_rating)
-
-	numerator = 0.0
-	denominator = 0.0
-
-	for i in range(num_ratings):
-		for j in range(num_ratings):
-			expected_count = (hist_rater_a[i] * hist_rater_b[j] / num_scored_items)
-			d = pow(i - j, 2.0) / pow(num_ratings - 1, 2.0)
-			numerator += d * conf_mat[i][j] / num_scored_items
-			denominator += d * expected_count / num_scored_items
-	if denominator<1e-11:
-		return -1.0
-	else:
-		return 1.0 - numerator / denominator
 
 
 def Tensor2PILImage(pic):
@@ -191,6 +105,33 @@ class TenCrop(object):
 		return img.crop(self.crop)
 
 
+class TenCropStack(object):
+	"""
+	All the ten-crop test views of one image as an (11, 3, crop_size, crop_size) tensor: the center crop of the
+	plain val transform, then the five TenCrop crops, each as is and flipped (the order of crop_idx). The image is
+	decoded, converted and normalized once and every view is a slice of it, so averaging the model outputs over
+	the first dimension gives the old 11-view average.
+	"""
+
+	def __init__(self, crop_size, scale_size, mean, std):
+		self.scale_size = scale_size
+		self.crops = [TenCrop(index, crop_size, scale_size).crop for index in range(5)]
+		self.mean = torch.from_numpy(np.array(mean, dtype=np.float32)).view(3, 1, 1)
+		self.std = torch.from_numpy(np.array(std, dtype=np.float32)).view(3, 1, 1)
+
+	def __call__(self, img):
+		img = img.convert('RGB')
+		if img.size != (self.scale_size, self.scale_size):
+			img = img.resize((self.scale_size, self.scale_size), Image.BILINEAR)
+		image = torch.from_numpy(np.asarray(img, dtype=np.uint8).transpose(2, 0, 1).copy()).float().div_(255)
+		image = image.sub_(self.mean).div_(self.std)
+		views = []
+		for left, top, right, bottom in self.crops:
+			view = image[:, top:bottom, left:right]
+			views += [view, view.flip(2)]
+		return torch.stack(views[:1] + views)
+
+
 class HorizontalFlip(object):
 	def __init__(self, flag):
 		self.flag = flag
@@ -372,6 +313,297 @@ class ColorJitter(object):
 		return img
 
 
+class ToByteTensor(object):
+	"""PIL image -> (3, H, W) uint8 tensor, the per-sample half of BatchAugment"""
+
+	def __call__(self, img):
+		return torch.from_numpy(np.ascontiguousarray(np.asarray(img.convert('RGB'), dtype=np.uint8).transpose(2, 0, 1)))
+
+
+def _box_sums(x, sizes):
+	# k x k box sums for each k in sizes over a replicate padded x, so the output keeps its size; the values on
+	# the outer max(sizes) // 2 rows and columns are not the ones PIL gives, see _keep_border
+	radius = max(sizes) // 2
+	padded = F.pad(x, (radius,) * 4, mode='replicate')
+	height, width = x.size(2), x.size(3)
+	sums = []
+	for size in sizes:
+		offset = radius - size // 2
+		rows = padded[:, :, :, offset:offset + width].clone()
+		for i in range(1, size):
+			rows += padded[:, :, :, offset + i:offset + i + width]
+		box = rows[:, :, offset:offset + height].clone()
+		for i in range(1, size):
+			box += rows[:, :, offset + i:offset + i + height]
+		sums.append(box)
+	return sums
+
+
+def _keep_border(out, x, radius):
+	# the PIL kernel filters leave the outer radius rows and columns of the image as they are
+	out[:, :, :radius] = x[:, :, :radius]
+	out[:, :, -radius:] = x[:, :, -radius:]
+	out[:, :, :, :radius] = x[:, :, :, :radius]
+	out[:, :, :, -radius:] = x[:, :, :, -radius:]
+	return out
+
+
+class BatchAugment(object):
+	"""
+	The RandomHorizontalFlip, PILColorJitter, ToTensor, Lighting and Normalize tail of the training transforms,
+	run with torch ops over a whole (B, 3, H, W) uint8 batch, each sample with its own random parameters:
+	a flip, ImageFilter.BLUR with probability blur, the ImageEnhance sharpness, brightness, color and contrast
+	factors in 1 +- var and the PCA lighting noise. It is not the same augmentation as PILColorJitter, which
+	runs all five steps in a per-sample random order and rounds and clips to uint8 after each: here the two
+	filters always run first and the three color ones, in a per-sample random order, fold into one per-sample
+	3x3 transform, clipped to [0, 255] once. Used as a DataLoader collate_fn
+	through collate, after a per-sample ToByteTensor; works the same on a cuda batch.
+	"""
+
+	def __init__(self, mean, std, eigval=None, eigvec=None, alphastd=0.1, flip=True,
+	             blur=0.5, brightness=0.4, color=0.4, contrast=0.4, sharpness=0.4):
+		self.mean = torch.from_numpy(np.array(mean, dtype=np.float32))
+		self.std = torch.from_numpy(np.array(std, dtype=np.float32))
+		self.eigval = None if eigval is None else torch.from_numpy(np.array(eigval, dtype=np.float32))
+		self.eigvec = None if eigvec is None else torch.from_numpy(np.array(eigvec, dtype=np.float32))
+		self.alphastd = alphastd
+		self.flip = flip
+		self.blur = blur
+		self.sharpness = sharpness
+		self.colors = [(name, var) for name, var in [('brightness', brightness), ('color', color), ('contrast', contrast)] if var > 0]
+		# ITU-R 601-2 luma, as Image.convert('L')
+		self.gray = torch.FloatTensor([0.299, 0.587, 0.114])
+
+	def _filters(self, x):
+		# on int16 (a 5x5 sum of uint8 fits), the float image is only formed with the sharpness blend
+		num = x.size(0)
+		x = x.short()
+		blurred = torch.nonzero(torch.rand(num) < self.blur).view(-1)
+		if len(blurred) > 0:
+			# BLUR is the ring of a 5x5 box, rounded like PIL: (box5 - box3 + 8) // 16
+			box3, box5 = _box_sums(x[blurred], [3, 5])
+			x[blurred] = _keep_border(box5.sub_(box3).add_(8) // 16, x[blurred], 2)
+		if self.sharpness <= 0:
+			return x.float()
+		# SMOOTH is (box3 + 4 x) / 13, sharpness a gives x + (1 - a) (SMOOTH - x)
+		alpha = (torch.rand(num) * 2 - 1) * self.sharpness + 1
+		box3, = _box_sums(x, [3])
+		detail = _keep_border(box3.sub_(x * 9), torch.zeros_like(x), 1)
+		detail = detail.float().mul_(((1 - alpha) / 13).view(-1, 1, 1, 1).to(x.device))
+		return x.float().add_(detail)
+
+	def _color_transform(self, x):
+		"""Per-sample (M, c) of the brightness, color and contrast steps in a random order"""
+		num = x.size(0)
+		eye = torch.eye(3).unsqueeze(0)
+		matrix = eye.repeat(num, 1, 1)
+		offset = torch.zeros(num, 3)
+		means = x.mean(3).mean(2).cpu()
+		order = torch.rand(num, len(self.colors)).sort(1)[1]
+		for stage in range(len(self.colors)):
+			for op, (name, var) in enumerate(self.colors):
+				index = torch.nonzero(order[:, stage] == op).view(-1)
+				if len(index) == 0:
+					continue
+				alpha = ((torch.rand(len(index)) * 2 - 1) * var + 1).view(-1, 1, 1)
+				if name == 'brightness':
+					step, shift = alpha * eye, torch.zeros(len(index), 3)
+				elif name == 'color':
+					step, shift = alpha * eye + (1 - alpha) * self.gray.view(1, 1, 3), torch.zeros(len(index), 3)
+				else:
+					# blend towards the gray mean of the image as it is at this step
+					current = torch.bmm(matrix[index], means[index].unsqueeze(2)).squeeze(2) + offset[index]
+					step = alpha * eye
+					shift = (1 - alpha.view(-1, 1)) * (current * self.gray.view(1, 3)).sum(1, keepdim=True).expand(len(index), 3)
+				matrix[index] = torch.bmm(step, matrix[index])
+				offset[index] = torch.bmm(step, offset[index].unsqueeze(2)).squeeze(2) + shift
+		return matrix, offset
+
+	def __call__(self, images):
+		x = images.clone()
+		num, height, width = x.size(0), x.size(2), x.size(3)
+		if self.flip:
+			flipped = torch.nonzero(torch.rand(num) < 0.5).view(-1)
+			if len(flipped) > 0:
+				x[flipped] = x[flipped].flip(3)
+		x = self._filters(x)
+		matrix, offset = self._color_transform(x)
+		x = torch.bmm(matrix.to(x.device), x.view(num, 3, -1)).add_(offset.to(x.device).unsqueeze(2)).clamp_(0, 255)
+		# ToTensor, Lighting and Normalize as one per-sample, per-channel scale and shift
+		shift = -self.mean.view(1, 3).expand(num, 3)
+		if self.alphastd > 0 and self.eigval is not None:
+			alpha = torch.randn(num, 3) * self.alphastd
+			shift = shift + torch.mm(alpha * self.eigval.view(1, 3), self.eigvec.t())
+		scale = (1 / (255 * self.std)).view(1, 3, 1).to(x.device)
+		x = x.mul_(scale).add_((shift / self.std.view(1, 3)).unsqueeze(2).to(x.device))
+		return x.view(num, 3, height, width)
+
+	def collate(self, samples):
+		"""collate_fn: stacks the uint8 images of (image, label, ...) samples and augments the batch"""
+		images = self(torch.stack([sample[0] for sample in samples]))
+		return [images] + list(default_collate([sample[1:] for sample in samples]))
+
+
+
+class Prefetcher(object):
+	"""
+	Iterates a DataLoader on a background thread, up to depth batches ahead of the loop. On a GPU the image
+	(floating point) tensors of each batch are pinned and copied to the device on a side stream, so `image.cuda()`
+	in the loop is a no-op and the copy overlaps the previous step; label tensors are only pinned, the loops still
+	read them with .numpy(). On CPU-only hosts the batches are passed on as they are. Every pass counts
+	the batches served, the mean number of batches waiting when one was taken (depth) and the seconds the loop
+	stalled waiting for the next one, see stats().
+	"""
+
+	def __init__(self, loader, device=None, depth=2):
+		self.loader = loader
+		self.dataset = getattr(loader, 'dataset', None)
+		if device is None:
+			device = 'cuda' if torch.cuda.is_available() else 'cpu'
+		self.device = torch.device(device)
+		self.depth = depth
+		self.batches, self.queued, self.stall = 0, 0, 0.0
+
+	def __len__(self):
+		return len(self.loader)
+
+	def stats(self):
+		return {'batches': self.batches, 'depth': self.queued / float(max(self.batches, 1)), 'stall': self.stall}
+
+	def _move(self, batch):
+		if torch.is_tensor(batch):
+			if batch.is_floating_point():
+				return batch.pin_memory().to(self.device, non_blocking=True)
+			return batch.pin_memory()
+		if isinstance(batch, (list, tuple)):
+			return type(batch)([self._move(b) for b in batch])
+		if isinstance(batch, dict):
+			return dict((k, self._move(v)) for k, v in batch.items())
+		return batch
+
+	def _record(self, batch, stream):
+		# the copies were allocated on the side stream, keep them alive until the loop's stream is done with them
+		if torch.is_tensor(batch):
+			if batch.is_cuda:
+				batch.record_stream(stream)
+		elif isinstance(batch, (list, tuple)):
+			for b in batch:
+				self._record(b, stream)
+		elif isinstance(batch, dict):
+			for b in batch.values():
+				self._record(b, stream)
+
+	@staticmethod
+	def _put(queue, stop, item):
+		while not stop.is_set():
+			try:
+				queue.put(item, timeout=0.1)
+				return True
+			except Full:
+				pass
+		return False
+
+	def _produce(self, queue, stop):
+		stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+		try:
+			for batch in self.loader:
+				event = None
+				if stream is not None:
+					with torch.cuda.stream(stream):
+						batch = self._move(batch)
+						event = torch.cuda.Event()
+						event.record(stream)
+				if not self._put(queue, stop, (batch, event, None)):
+					return
+		except Exception as e:
+			self._put(queue, stop, (None, None, e))
+			return
+		self._put(queue, stop, None)
+
+	def __iter__(self):
+		self.batches, self.queued, self.stall = 0, 0, 0.0
+		queue = Queue(max(self.depth, 1))
+		stop = threading.Event()
+		thread = threading.Thread(target=self._produce, args=(queue, stop))
+		thread.daemon = True
+		thread.start()
+		try:
+			while True:
+				waiting = queue.qsize()
+				start = time.time()
+				item = queue.get()
+				self.stall += time.time() - start
+				if item is None:
+					break
+				batch, event, error = item
+				if error is not None:
+					raise error
+				if event is not None:
+					current = torch.cuda.current_stream(self.device)
+					current.wait_event(event)
+					self._record(batch, current)
+				self.batches += 1
+				self.queued += waiting
+				yield batch
+		finally:
+			stop.set()
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+	"""
+	Shuffles like DataLoader(shuffle=True), with the permutation, the position in it and the RNG state in
+	state_dict(), so a run preempted mid-epoch resumes the same order. The loop reports the samples it has consumed
+	with advance(); a new pass starts at that position, so the skipped indices are never handed to the workers and
+	never decoded, whatever num_workers is. A permutation is drawn once the previous one is used up.
+	"""
+
+	def __init__(self, num, seed=0):
+		self.num = num
+		self.rng = np.random.RandomState(seed)
+		self.perm = None
+		self.position = 0
+		self.start = 0
+
+	def _next_perm(self):
+		if self.perm is None or self.position >= self.num:
+			self.perm = self.rng.permutation(self.num)
+			self.position = 0
+
+	def __iter__(self):
+		self._next_perm()
+		self.start = self.position
+		return iter(self.perm[self.start:].tolist())
+
+	def __len__(self):
+		if self.perm is None or self.position >= self.num:
+			return self.num
+		return self.num - self.position
+
+	def advance(self, consumed):
+		"""consumed samples of the current pass have been trained on"""
+		self.position = min(self.start + consumed, self.num)
+
+	def state_dict(self):
+		# tensors and plain numbers only, the state goes into torch.save checkpoints
+		name, keys, pos, has_gauss, cached_gaussian = self.rng.get_state()
+		return {'num': self.num, 'perm': None if self.perm is None else torch.from_numpy(self.perm.astype(np.int64)),
+		        'position': int(self.position), 'rng': (name, torch.from_numpy(keys.astype(np.int64)), int(pos), int(has_gauss), float(cached_gaussian))}
+
+	def load_state_dict(self, state):
+		if state['num'] != self.num:
+			raise Exception('The sampler state is for {} samples, not {}'.format(state['num'], self.num))
+		self.perm = None if state['perm'] is None else state['perm'].numpy()
+		self.position = state['position']
+		self.start = self.position
+		name, keys, pos, has_gauss, cached_gaussian = state['rng']
+		self.rng.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+
+
+def prefetch(loader, depth):
+	"""loader behind a Prefetcher of depth batches, the loader itself when depth is 0"""
+	return Prefetcher(loader, depth=depth) if depth > 0 else loader
+
+
 # Source: https://github.com/ncullen93/torchsample/blob/master/torchsample/utils.py
 
 def th_allclose(x, y):
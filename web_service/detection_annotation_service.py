@@ -2,8 +2,6 @@ import http.server
 import socketserver
 from http.server import BaseHTTPRequestHandler
 from http import HTTPStatus
-from PIL import Image
-from io import BytesIO
 import io
 import os
 
@@ -14,10 +12,26 @@ PORT = 8002
 import os
 
 import math
-from glob import glob
+import sys
+sys.path.append('../')
+from manifest import ImageManifest
+from image_decode import load_image
 
 image_root = './zhizhen'
 
+# the image folders are indexed in a manifest instead of globbed per request; a request re-stats them at
+# most every REFRESH_SECONDS so files added while serving show up. The indices clients page through
+# follow the sorted file names, the old glob order was whatever order the file system listed
+REFRESH_SECONDS = 30
+manifest = ImageManifest(os.path.join('./detection', 'manifest.db'))
+manifest.refresh('./detection', hash=False)
+
+
+def list_images(images_path):
+    manifest.refresh('./detection', hash=False, max_age=REFRESH_SECONDS)
+    return manifest.files(images_path, '.jpeg')
+
+
 class ImageHTTPRequestHandler(BaseHTTPRequestHandler):
 
     """Simple HTTP request handler with GET and HEAD commands.
@@ -89,9 +103,9 @@ class ImageHTTPRequestHandler(BaseHTTPRequestHandler):
 
     def _classify(self):
         data1 = self.rfile.read(int(self.headers['Content-Length']))
-        stream = BytesIO(data1)
-        img = Image.open(stream)
-        image_id = imagehash.average_hash(img)
+        # the upload is handed to the classifier as bytes and decoded there at a reduced JPEG scale; the image
+        # id is an 8x8 average hash, a 1/8 scale decode is enough for it
+        image_id = imagehash.average_hash(load_image(data1, min_size=64))
 
         algo = self.headers['algo']
         classifier = kaggle_classifier
@@ -102,7 +116,7 @@ class ImageHTTPRequestHandler(BaseHTTPRequestHandler):
         elif algo == 'all':
             classifier = all_classifier
 
-        idx,prop= classifier.classifyImage(img)
+        idx,prop= classifier.classifyImage(data1)
         print(prop)
 
         try:
@@ -112,7 +126,8 @@ class ImageHTTPRequestHandler(BaseHTTPRequestHandler):
             assert len(query) <= 1
             if len(query) == 0:
                 imagepath = os.path.join(image_root, '{}.jpeg'.format(image_id))
-                img.save(imagepath)
+                with open(imagepath, 'wb') as fp:
+                    fp.write(data1)
                 cmd_insert = """insert into dr_image_tb (id, imagepath, algolevel) values ('{0}', '{1}', {2})""".format(
                     image_id, imagepath, idx
                 )
@@ -163,10 +178,9 @@ class ImageHTTPRequestHandler(BaseHTTPRequestHandler):
         img_idx = cmd.split(' ')[2]
         images_path = os.path.join(self.root, 'train/' + str(folder_index) + '/')
         #print('images path: ' + images_path)
-        images_list = glob(os.path.join(images_path, '*.jpeg'))
+        images_list = list_images(images_path)
         image = images_list[int(img_idx)]
         data = open(image, 'rb').read()
-        pil_img = Image.open(image)
         image_uid = os.path.basename(image)
         self.send_response(HTTPStatus.OK)
         self.send_header("Content-type", 'image/jpeg')
@@ -183,7 +197,7 @@ class ImageHTTPRequestHandler(BaseHTTPRequestHandler):
         img_idx = cmd.split(' ')[2]
         doctor_id = cmd.split(' ')[3]
         images_path = os.path.join(self.root, 'train/' + str(folder_index))
-        images_list = glob(os.path.join(images_path, '*.jpeg'))
+        images_list = list_images(images_path)
         image = images_list[int(img_idx)]
         image_uid = os.path.basename(image)
 
@@ -11,6 +11,8 @@ import torchvision.transforms as transforms
 import torch.nn as nn
 
 import drn
+from utils import apply_cut_points, default_cut_points, load_cut_points
+from image_decode import load_image
 
 import numpy as np
 
@@ -100,6 +102,9 @@ class cls_model(nn.Module):
 		return x
 
 def get_input_image(image):
+    # a path or the encoded bytes are decoded at a reduced JPEG DCT scale, at least 512 on the short side
+    if not isinstance(image, Image.Image):
+        image = load_image(image, min_size=512)
     w,h = image.size
     tw, th = (min(w, h), min(w, h))
     image = image.crop((w // 2 - tw // 2, h // 2 - th // 2, w // 2 + tw // 2, h // 2 + th // 2))
@@ -112,10 +117,13 @@ def get_input_image(image):
     return image
 
 class DrImageClassifier(object):
-    def __init__(self, arch, weights, devs=[0]):
+    def __init__(self, arch, weights, devs=[0], cls2reg=False):
         self.arch = arch
         self.weights = weights
         self.devs =devs
+        self.cls2reg = cls2reg
+        # regression models grade through the cut points fitted in cls.py --fitcuts
+        self.cut_points = load_cut_points(weights, default_cut_points()) if cls2reg else None
         self.init_crop = get_input_image
         self.rescale_size = 512
         self.crop_size = 512
@@ -133,7 +141,7 @@ class DrImageClassifier(object):
         ])
 
     def load_model(self, arch, weights, devs=[0]):
-        model = cls_model(arch, self.crop_size, 5, weights, True, False)
+        model = cls_model(arch, self.crop_size, 5, weights, True, self.cls2reg)
         print('device id is: '.format(devs))
         return torch.nn.DataParallel(model, devs).cuda()
 
@@ -150,6 +158,9 @@ class DrImageClassifier(object):
         input = self.image_preprocessed(image)
         input_var = torch.autograd.Variable(input.cuda(), volatile=True)
         output = self.model(input_var)
+        if self.cls2reg:
+            res_prop = output.data.cpu().numpy()
+            return apply_cut_points(res_prop.ravel(), self.cut_points)[0], res_prop
         pred = output.data.max(1)[1]
         m = torch.nn.Softmax()
         # prop = m(output).data.max(1)[0]
@@ -322,9 +333,8 @@ def main():
     classifier = DrImageClassifier('rsn34', 'kaggle.pth', args.devlist)
 
     imagepath = 'test.jpeg'
-    image = Image.open(imagepath)
 
-    idx, prop = classifier.classifyImage(image)
+    idx, prop = classifier.classifyImage(imagepath)
 
     print('DR level is: {}'.format(idx))
     print('propobality distribution is: {}'.format(prop))
@@ -7,7 +7,6 @@ from http import HTTPStatus
 
 from PIL import Image
 
-from io import BytesIO
 
 import io
 
@@ -16,12 +15,26 @@ PORT = 8003
 
 import os
 import math
-from glob import glob
+import sys
+sys.path.append('../')
+from manifest import ImageManifest
 import imagehash
 
 
 image_root = './zhizhen'
 
+# the image folders are indexed in a manifest instead of globbed per request; a request re-stats them at
+# most every REFRESH_SECONDS so files added while serving show up. The indices clients page through
+# follow the sorted file names, the old glob order was whatever order the file system listed
+REFRESH_SECONDS = 30
+manifest = ImageManifest(os.path.join('./kaggle', 'manifest.db'))
+manifest.refresh('./kaggle', hash=False)
+
+
+def list_images(images_path):
+    manifest.refresh('./kaggle', hash=False, max_age=REFRESH_SECONDS)
+    return manifest.files(images_path, '.jpeg')
+
 
 import mdb
 db, cursor = mdb.start_db_conn1()
@@ -119,7 +132,7 @@ class ImageHTTPRequestHandler(BaseHTTPRequestHandler):
         folder_index = self.headers['folder_index']
         images_path = os.path.join(self.root, 'train/'+str(folder_index))
         print('images path: ' + images_path)
-        images_list = glob(os.path.join(images_path, '*.jpeg'))
+        images_list = list_images(images_path)
         image = images_list[int(sub_idx)]
         # image = '/home/weidong/code/dr/DiabeticRetinopathy_solution/data/dme/dme/33_dr_0_dme_0.jpg'
         data = open(image, 'rb').read()
@@ -140,7 +153,7 @@ class ImageHTTPRequestHandler(BaseHTTPRequestHandler):
         folder_index = self.headers['folder_index']
         images_path = os.path.join(self.root, 'test/'+str(folder_index))
         print('images path: ' + images_path)
-        images_list = glob(os.path.join(images_path, '*.jpeg'))
+        images_list = list_images(images_path)
         image = images_list[int(sub_idx)]
         # image = '/home/weidong/code/dr/DiabeticRetinopathy_solution/data/dme/dme/34_dr_2_dme_1.jpg'
         data = open(image, 'rb').read()
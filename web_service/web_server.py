@@ -4,16 +4,12 @@ import socketserver
 from http.server import BaseHTTPRequestHandler
 from http import HTTPStatus
 
-
-from PIL import Image
-
-from io import BytesIO
-
 import io
 
 PORT = 8002
 
 from image_preprocessing import DrImageClassifier, get_kaggle_classifier, get_zz_classifier, get_all_classifier
+from image_decode import load_image
 
 # from utils import mdb
 
@@ -86,9 +82,9 @@ class ImageHTTPRequestHandler(BaseHTTPRequestHandler):
 
     def _classify(self):
         data1 = self.rfile.read(int(self.headers['Content-Length']))
-        stream = BytesIO(data1)
-        img = Image.open(stream)
-        image_id = imagehash.average_hash(img)
+        # the upload is handed to the classifier as bytes and decoded there at a reduced JPEG scale; the image
+        # id is an 8x8 average hash, a 1/8 scale decode is enough for it
+        image_id = imagehash.average_hash(load_image(data1, min_size=64))
 
         algo = self.headers['algo']
         classifier = kaggle_classifier
@@ -99,7 +95,7 @@ class ImageHTTPRequestHandler(BaseHTTPRequestHandler):
         elif algo == 'all':
             classifier = all_classifier
 
-        idx,prop= classifier.classifyImage(img)
+        idx,prop= classifier.classifyImage(data1)
         print(prop)
 
         try:
@@ -109,7 +105,8 @@ class ImageHTTPRequestHandler(BaseHTTPRequestHandler):
             assert len(query) <= 1
             if len(query) == 0:
                 imagepath = os.path.join(image_root, '{}.jpeg'.format(image_id))
-                img.save(imagepath)
+                with open(imagepath, 'wb') as fp:
+                    fp.write(data1)
                 cmd_insert = """insert into dr_image_tb (id, imagepath, algolevel) values ('{0}', '{1}', {2})""".format(
                     image_id, imagepath, idx
                 )